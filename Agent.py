@@ -27,6 +27,11 @@ class Agent:
                 func=lambda hours: get_recent_messages(dl, hours),
                 name="get_recent_messages",
                 description="Get all messages from the past specified hours."
+            ),
+            StructuredTool.from_function(
+                func=lambda message_ids, n: get_message_context(dl, message_ids, n),
+                name="get_message_context",
+                description="Get the n messages before and after each of the given message ids (shown in [brackets] in other tool results)."
             )
         ]
         
@@ -75,13 +80,26 @@ def get_messages_for_users(dl: DataLayer, usernames: List[str]):
     """Get all messages from specified users within an optional time frame."""
     print("Getting messages for users", usernames)
     messages = dl.get_messages_by_user(usernames)
-    return [f"{message.sender.username}, {message.sent}: {message.text}" for message in messages]
+    return [format_message(message) for message in messages]
 
 def get_recent_messages(dl: DataLayer, hours: int = 24) -> list[str]:
     """Get all messages from the past specified hours."""
     print(f"Getting recent messages for the last {hours} hours")
     messages = dl.get_recent_messages(hours)
-    return [f"{message.sender.username}, {message.sent}: {message.text}" for message in messages]
-
-
+    return [format_message(message) for message in messages]
+
+def get_message_context(dl: DataLayer, message_ids: List[str], n: int = 3) -> list[str]:
+    """Get the n messages before and after each of the given message ids."""
+    print(f"Getting context of {n} messages around {message_ids}")
+    contexts = dl.get_message_context(message_ids, before=n, after=n)
+    return [
+        "\n".join(
+            [format_message(message) for message in context.previous_messages]
+            + [f">>> message {message_id}"]
+            + [format_message(message) for message in context.next_messages]
+        )
+        for message_id, context in contexts.items()
+    ]
 
+def format_message(message) -> str:
+    return f"[{message.id}] {message.sender.username}, {message.sent}: {message.text}"
@@ -0,0 +1,931 @@
+import psycopg
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+from pgvector.psycopg import register_vector_async
+from Cache import MetadataCache
+from ChannelIndex import ChannelIndex, CHANNEL_INDEX_DIR
+from EventBus import EventBus
+from Models import *
+from DataLayer import *
+import asyncio
+import hashlib
+import json
+import os
+import time
+from datetime import datetime
+from typing import List, Dict
+
+# Seconds over which reacted-to messages are collected before their counts are recounted; 0 writes them per request
+REACTION_FLUSH_INTERVAL = float(os.getenv("REACTION_FLUSH_INTERVAL", "0"))
+# Flushes a batch of reaction recounts gets before it is dropped
+REACTION_FLUSH_ATTEMPTS = int(os.getenv("REACTION_FLUSH_ATTEMPTS", "3"))
+# Seconds new messages wait to be committed together, and the most per commit; 0 commits each on its own
+MESSAGE_BATCH_WINDOW = float(os.getenv("MESSAGE_BATCH_WINDOW", "0"))
+MESSAGE_BATCH_SIZE = int(os.getenv("MESSAGE_BATCH_SIZE", "100"))
+
+
+class ReactionCoalescer:
+    """
+    Collects the (message, emoji) pairs reactions were recorded for and
+    recounts them from message_reactions into messages.reactions in one
+    UPDATE per flush, so a burst of reactions on a hot message takes its row
+    lock once rather than once per reaction. Recounting rather than applying
+    deltas means a flush lost to a crash is corrected by the next reaction
+    with the same emoji.
+    """
+
+    def __init__(self, pool: AsyncConnectionPool, interval: float, attempts: int = REACTION_FLUSH_ATTEMPTS):
+        self.pool = pool
+        self.interval = interval
+        self.attempts = attempts
+        self.pending = set()  # (message_id, emoji)
+        self.failures = 0
+        self.flush_task = None
+        self.lock = asyncio.Lock()
+
+    def add(self, message_id: str, emoji: str):
+        self.pending.add((message_id, emoji))
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        try:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+        finally:
+            self.flush_task = None
+            if self.pending:
+                self.flush_task = asyncio.create_task(self._flush_later())
+
+    async def flush(self):
+        async with self.lock:
+            pending, self.pending = self.pending, set()
+            if not pending:
+                return
+            message_ids, emojis = map(list, zip(*pending))
+            try:
+                async with self.pool.connection() as conn:
+                    async with conn.cursor() as cur:
+                        await cur.execute(RECOUNT_REACTIONS_QUERY, {'message_ids': message_ids, 'emojis': emojis})
+                    await conn.commit()
+                self.failures = 0
+            except Exception as e:
+                self.failures += 1
+                if self.failures >= self.attempts:
+                    print(f"Error recounting reactions, dropping {len(pending)}: {e}")
+                    self.failures = 0
+                else:
+                    print(f"Error recounting reactions, retrying: {e}")
+                    self.pending |= pending
+
+
+class MessageWriteBuffer:
+    """
+    Group commit for new messages: inserts arriving within `window` seconds,
+    up to `max_rows` of them, are written by one multi-row INSERT and one
+    COMMIT. Each caller's await resolves once the batch holding its row has
+    committed, so a returned message is as durable as an unbuffered one.
+    """
+
+    def __init__(self, pool: AsyncConnectionPool, window: float, max_rows: int):
+        self.pool = pool
+        self.window = window
+        self.max_rows = max_rows
+        self.pending = []  # (params, future) in arrival order
+        self.flush_task = None
+        self.flushes = set()
+
+    async def post(self, params: tuple) -> dict | None:
+        """Queue a row of POST_MESSAGE_QUERY params; returns its hydrated row, or None if a foreign key is missing."""
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((params, future))
+        if len(self.pending) >= self.max_rows:
+            self._start_flush()
+        elif self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_later())
+        return await future
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self.flush_task = None
+        self._start_flush()
+
+    def _start_flush(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.create_task(self._write(batch))
+            self.flushes.add(task)
+            task.add_done_callback(self.flushes.discard)
+
+    async def flush(self):
+        """Write everything queued so far and wait for all in-flight batches."""
+        self._start_flush()
+        if self.flushes:
+            await asyncio.gather(*self.flushes, return_exceptions=True)
+
+    async def _write(self, batch: list):
+        try:
+            try:
+                rows = await self._insert([params for params, _ in batch])
+            except psycopg.errors.ForeignKeyViolation as e:
+                # One bad row aborts the whole statement; commit the rest one by one
+                print(f"Error posting message batch, retrying rows individually: {e}")
+                rows = {}
+                for params, _ in batch:
+                    try:
+                        rows.update(await self._insert([params]))
+                    except psycopg.errors.ForeignKeyViolation as e:
+                        print(f"Error posting message: {e}")
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for params, future in batch:
+            if not future.done():
+                future.set_result(rows.get(params[0]))
+
+    async def _insert(self, rows: list[tuple]) -> dict[str, dict]:
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(post_messages_query(len(rows)), [value for params in rows for value in params])
+                inserted = await cur.fetchall()
+            await conn.commit()
+        return {row['message_id']: row for row in inserted}
+
+
+class AsyncDataLayer:
+    """
+    The DataLayer method surface on top of an AsyncConnectionPool, for use from
+    the FastAPI handlers so a database round-trip never blocks the event loop.
+    SQL and row mapping are shared with DataLayer.
+
+    The pool is opened lazily by open(), which must be awaited from the running
+    event loop (the app's startup hook) before any other method is used.
+    """
+
+    def __init__(self, min_size: int = 1, max_size: int = 10, reaction_flush_interval: float = REACTION_FLUSH_INTERVAL,
+                 message_batch_window: float = MESSAGE_BATCH_WINDOW, message_batch_size: int = MESSAGE_BATCH_SIZE,
+                 channel_index_dir: str = CHANNEL_INDEX_DIR):
+        self.conn_string = f"host={DB_HOST} dbname={DB_NAME} user={DB_USER} password={DB_PASSWORD}"
+        # Users, channels and memberships are read far more often than written
+        self.cache = MetadataCache()
+        self.pool = AsyncConnectionPool(
+            self.conn_string,
+            min_size=min_size,
+            max_size=max_size,
+            timeout=30,
+            kwargs={'row_factory': dict_row},
+            configure=self._configure_connection,
+            open=False
+        )
+        self.reactions = ReactionCoalescer(self.pool, reaction_flush_interval) if reaction_flush_interval > 0 else None
+        self.messages = MessageWriteBuffer(self.pool, message_batch_window, message_batch_size) if message_batch_window > 0 else None
+        # Channel-scoped similarity search in process, when a snapshot directory is configured
+        self.channel_index = ChannelIndex(self, channel_index_dir) if channel_index_dir else None
+        # Chunks bulk loaded by copy_chunks, and seconds spent streaming and merging them
+        self.copied_rows = 0
+        self.copy_seconds = 0.0
+        self.merge_seconds = 0.0
+        # Writes other processes need to know about are published here; see EventBus.start
+        self.events = EventBus(self)
+        self.events.subscribe("user", self._on_user_event)
+        self.events.subscribe("channel", self._on_channel_event)
+        self.events.subscribe("membership", self._on_membership_event)
+        self.events.on_listening(self.cache.clear)  # Invalidations may have been missed
+
+    async def _configure_connection(self, conn):
+        await register_vector_async(conn)  # Register vector type for every pooled connection
+
+    async def open(self):
+        """Open the pool and print a message once the database is reachable"""
+        try:
+            await self.pool.open(wait=True)
+            async with self.pool.connection() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute("SELECT count(*) FROM users")
+                    count = (await cur.fetchone())['count']
+                    print(f"Successfully connected to the database. {count} users found.")
+        except Exception as e:
+            print(f"Failed to connect to database: {str(e)}")
+            raise
+
+    async def close(self):
+        if self.messages:
+            await self.messages.flush()
+        if self.reactions:
+            await self.reactions.flush()
+        await self.events.stop()
+        await self.pool.close()
+
+    async def _fetchone(self, query: str, params=None) -> dict | None:
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(query, params)
+                return await cur.fetchone()
+
+    async def _fetchall(self, query: str, params=None, binary: bool = False) -> list[dict]:
+        async with self.pool.connection() as conn:
+            async with conn.cursor(binary=binary) as cur:
+                await cur.execute(query, params)
+                return await cur.fetchall()
+
+    async def _fetchone_and_commit(self, query: str, params=None) -> dict | None:
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(query, params)
+                row = await cur.fetchone()
+            await conn.commit()
+            return row
+
+    async def _execute(self, query: str, params=None):
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(query, params)
+            await conn.commit()
+
+
+    async def add_user(self, user: User):
+        try:
+            await self._execute(
+                INSERT_USER_QUERY,
+                (user.id, user.created_at, user.username, user.password, user.token, user.status, user.profile_picture)
+            )
+            self._invalidate_user(user.id, user.username)
+            return True  # Indicate success
+        except Exception as e:
+            print(f"Error adding user: {e}")
+            return False
+
+
+    async def get_user(self, user_id: str) -> User | None:
+        """Get a user by their ID."""
+        user = self.cache.get_user(user_id)
+        if user:
+            return user
+        try:
+            user_data = await self._fetchone("SELECT * FROM users WHERE id = %s", (user_id,))
+            user = user_from_row(user_data) if user_data else None
+            self.cache.put_user(user)
+            return user
+        except Exception as e:
+            print(f"Error getting user: {e}")
+            return None
+
+
+    async def get_user_by_username(self, username: str) -> User | None:
+        """Get a user by their username."""
+        user = self.cache.get_user_by_username(username)
+        if user:
+            return user
+        user_data = await self._fetchone("SELECT * FROM users WHERE username = %s", (username,))
+        user = user_from_row(user_data) if user_data else None
+        self.cache.put_user(user)
+        return user
+
+
+    async def add_channel(self, channel: Channel):
+        try:
+            await self._execute(INSERT_CHANNEL_QUERY, insert_channel_params(channel))
+            self._invalidate_channel(channel.id)
+            return True  # Indicate success
+        except Exception as e:
+            print(f"Error adding channel: {e}")
+            return False
+
+
+    async def get_channel(self, channel_id: str) -> Channel | None:
+        """Get a channel by its ID."""
+        channel = self.cache.get_channel(channel_id)
+        if channel:
+            return channel
+        try:
+            channel_data = await self._fetchone("SELECT * FROM channels WHERE id = %s", (channel_id,))
+            channel = channel_from_row(channel_data) if channel_data else None
+            self.cache.put_channel(channel)
+            return channel
+        except Exception as e:
+            print(f"Error getting channel: {e}")
+            return None
+
+
+    async def get_channel_by_name(self, channel_name: str) -> Channel | None:
+        """Get a channel by its name."""
+        channel = self.cache.get_channel_by_name(channel_name)
+        if channel:
+            return channel
+        channel_data = await self._fetchone("SELECT * FROM channels WHERE name = %s", (channel_name,))
+        channel = channel_from_row(channel_data) if channel_data else None
+        self.cache.put_channel(channel, by_name=True)
+        return channel
+
+
+    async def get_channel_by_id(self, channel_id: str) -> Channel | None:
+        """Get a channel by its ID."""
+        channel = self.cache.get_channel(channel_id)
+        if channel:
+            return channel
+        channel_data = await self._fetchone("SELECT * FROM channels WHERE id = %s", (channel_id,))
+        channel = channel_from_row(channel_data) if channel_data else None
+        self.cache.put_channel(channel)
+        return channel
+
+
+    async def add_thread(self, message: Message):
+        try:
+            thread_id = message.thread_id if message.thread_id else None
+            await self._execute("UPDATE messages SET thread_id = %s, has_thread = TRUE WHERE id = %s", (thread_id, message.id))
+            return True
+        except Exception as e:
+            print(f"Error adding thread: {e}")
+            return False
+
+
+    async def get_messages_in_channel(self, channel_id: str, before: str = None, after: str = None, limit: int = None) -> list[Message]:
+        """Get messages for a specific channel, oldest first. See channel_messages_query for paging."""
+        query, params, descending = channel_messages_query(channel_id, before, after, limit)
+        try:
+            message_data = await self._fetchall(query, params)
+            if descending:
+                message_data.reverse()
+            return [message_from_row(msg) for msg in message_data]
+        except Exception as e:
+            print(f"Error getting messages in channel: {e}")
+            return []
+
+
+    async def get_messages_by_user(self, user_id: str) -> list[Message]:
+        """Get all messages sent by a specific user."""
+        message_data = await self._fetchall(f"{MESSAGE_SELECT} WHERE m.sender_id = %s", (user_id,))
+        return [message_from_row(msg) for msg in message_data]
+
+
+    async def add_channel_membership(self, membership: ChannelMembership):
+        try:
+            async with self.pool.connection() as conn:
+                async with conn.cursor() as cur:
+                    # Add the membership
+                    await cur.execute("INSERT INTO channel_memberships (user_id, channel_id) VALUES (%s, %s)",
+                                      (membership.user_id, membership.channel_id))
+
+                    # Update the channel's member count and flags
+                    await cur.execute(ADD_MEMBER_TO_CHANNEL_QUERY, (membership.user_id, AI_USERNAME, membership.channel_id))
+
+                await conn.commit()
+            self.cache.invalidate_membership(membership.user_id, membership.channel_id)
+            self.events.publish("membership", user_id=membership.user_id, channel_id=membership.channel_id)
+            return True
+        except Exception as e:
+            print(f"Error adding channel membership: {e}")
+            return False
+
+
+    def _on_membership_event(self, event: dict):
+        if event["origin"] != self.events.worker_id:
+            self.cache.invalidate_membership(event["user_id"], event["channel_id"])
+
+
+    def _invalidate_user(self, user_id: str, username: str = None):
+        """Drop a changed user from this process's cache and the other processes'."""
+        self.cache.invalidate_user(user_id, username)
+        self.events.publish("user", user_id=user_id, username=username)
+
+
+    def _on_user_event(self, event: dict):
+        if event["origin"] != self.events.worker_id:
+            self.cache.invalidate_user(event["user_id"], event["username"])
+
+
+    def _invalidate_channel(self, channel_id: str):
+        """Drop a changed channel from this process's cache and the other processes'."""
+        self.cache.invalidate_channel(channel_id)
+        self.events.publish("channel", channel_id=channel_id)
+
+
+    def _on_channel_event(self, event: dict):
+        if event["origin"] != self.events.worker_id:
+            self.cache.invalidate_channel(event["channel_id"])
+
+
+    async def get_users_in_channel(self, channel_id: str) -> list[User]:
+        """Get all users in a specific channel."""
+        users = self.cache.get_channel_users(channel_id)
+        if users is not None:
+            return users
+        user_data = await self._fetchall(USERS_IN_CHANNEL_QUERY, (channel_id,))
+        users = [user_from_row(user) for user in user_data]
+        self.cache.put_channel_users(channel_id, users)
+        return users
+
+
+    async def is_channel_member(self, user_id: str, channel_id: str) -> bool:
+        """Check whether a user is a member of a channel."""
+        is_member = self.cache.get_membership(user_id, channel_id)
+        if is_member is not None:
+            return is_member
+        row = await self._fetchone(
+            "SELECT 1 FROM channel_memberships WHERE user_id = %s AND channel_id = %s",
+            (user_id, channel_id)
+        )
+        is_member = row is not None
+        self.cache.put_membership(user_id, channel_id, is_member)
+        return is_member
+
+
+    async def get_channels_for_user(self, user_id: str, channel_type: ChannelType) -> list[Channel]:
+        """Get all channels a specific user is part of."""
+        channel_data = await self._fetchall(*channels_for_user_query(user_id, channel_type))
+        return [channel_from_row(channel) for channel in channel_data]
+
+
+    async def get_message(self, message_id: str) -> Message | None:
+        """Get a message by its ID."""
+        msg = await self._fetchone(f"{MESSAGE_SELECT} WHERE m.id = %s", (message_id,))
+        if msg:
+            return message_from_row(msg)
+        print(f"No message found with ID: {message_id}")
+        return None
+
+
+    async def get_user_status(self, user_id: str) -> str | None:
+        """Get the status of a specific user."""
+        user = await self.get_user(user_id)
+        return user.status if user else None
+
+
+    async def get_my_channels(self, user_id: str, channel_type: ChannelType) -> list[Channel]:
+        """Get all channels a specific user is part of."""
+        return await self.get_channels_for_user(user_id, channel_type)
+
+
+    async def create_channel(self, name: str, channel_type: str, creator_id: str, description: str, channel_id: str = None) -> Channel:
+        """Create a new channel."""
+        try:
+            channel = new_channel(name, channel_type, creator_id, description, channel_id)
+            await self._execute(INSERT_CHANNEL_QUERY, insert_channel_params(channel))
+            self._invalidate_channel(channel.id)
+            return channel
+        except Exception as e:
+            print(f"Error creating channel: {e}")
+            return None
+
+
+    async def join_channel(self, user_id: str, channel_id: str) -> ChannelMembership:
+        """Join a channel."""
+        membership = ChannelMembership(user_id=user_id, channel_id=channel_id)
+        await self.add_channel_membership(membership)
+        return membership
+
+
+    async def send_message(self, message: Message):
+        """Send a message to a channel."""
+        if self.messages:
+            row = await self.messages.post(insert_message_params(message))
+        else:
+            async with self.pool.connection() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(POST_MESSAGE_QUERY, insert_message_params(message))
+                    row = await cur.fetchone()
+                await conn.commit()
+        if row is None:
+            return None
+        self._publish_message(row)
+        return message_from_row(row)  # Return the full message with sender info
+
+
+    async def post_message(self, channel_id: str, sender_id: str, content: str, file_id: str = None) -> PostedMessage | None:
+        """
+        Create a message and return it hydrated, along with the channel flags
+        the send path needs, in a single round-trip.
+        Returns None if the sender, channel or file doesn't exist.
+        With group commit on, the row is written with others queued alongside it.
+        """
+        params = post_message_params(channel_id, sender_id, content, file_id)
+        if self.messages:
+            row = await self.messages.post(params)
+        else:
+            try:
+                async with self.pool.connection() as conn:
+                    async with conn.cursor() as cur:
+                        await cur.execute(POST_MESSAGE_QUERY, params)
+                        row = await cur.fetchone()
+                    await conn.commit()
+            except psycopg.errors.ForeignKeyViolation as e:
+                print(f"Error posting message: {e}")
+                return None
+        if row is None:
+            return None
+        self._publish_message(row)
+        return posted_message_from_row(row)
+
+
+    def _publish_message(self, row: dict):
+        self.events.publish("message", channel_id=row['channel_id'], message_id=row['message_id'])
+
+
+    async def get_channel_messages(self, channel_id: str, before: str = None, after: str = None, limit: int = None) -> list[Message]:
+        """Get messages for a specific channel, optionally one page at a time."""
+        return await self.get_messages_in_channel(channel_id, before=before, after=after, limit=limit)
+
+
+    async def get_channel_messages_page(self, channel_id: str, before: str = None, after: str = None,
+                                        limit: int = 50) -> tuple[list[Message], str | None, str | None]:
+        """Get one page of channel messages, the cursor for the next page and the cursor to poll for newer messages from."""
+        messages = await self.get_messages_in_channel(channel_id, before=before, after=after, limit=limit + 1)
+        return messages_page(messages, limit, after)
+
+
+    async def search_channels(self, prefix: str) -> list[Channel]:
+        """Search for channels by name prefix."""
+        channel_data = await self._fetchall("SELECT * FROM channels WHERE LOWER(name) LIKE %s", (prefix.lower() + "%",))
+        return [channel_from_row(channel) for channel in channel_data]
+
+
+    async def save_file(self, file_id: str, filename: str, content_type: str, data: bytes, associated_channel: str) -> bool:
+        sha256 = hashlib.sha256(data).hexdigest()
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(INSERT_BLOB_QUERY, (sha256, len(data), data))
+                await cur.execute(INSERT_FILE_QUERY, insert_file_params(file_id, filename, content_type, len(data), sha256, associated_channel))
+            await conn.commit()
+        return True
+
+
+    async def save_file_stream(self, file_id: str, filename: str, content_type: str, stream, associated_channel: str,
+                               max_size: int = MAX_FILE_SIZE, chunk_size: int = FILE_CHUNK_SIZE) -> bool:
+        """
+        Save a file read from a seekable async binary stream (e.g. an UploadFile)
+        chunk_size bytes at a time, so memory stays flat whatever the file size.
+        The stream is hashed first: content that is already stored just gains a
+        reference, and only new content is read again and copied in.
+        Raises FileTooLargeError, saving nothing, once more than max_size bytes have been read.
+        """
+        size, sha256 = 0, hashlib.sha256()
+        while chunk := await stream.read(chunk_size):
+            size += len(chunk)
+            if size > max_size:
+                raise FileTooLargeError(f"File is larger than {max_size} bytes")
+            sha256.update(chunk)
+        sha256 = sha256.hexdigest()
+
+        for attempt in range(2):
+            try:
+                async with self.pool.connection() as conn:
+                    async with conn.cursor() as cur:
+                        await cur.execute(ACQUIRE_BLOB_QUERY, (sha256,))
+                        if await cur.fetchone() is None:
+                            await stream.seek(0)
+                            async with cur.copy(COPY_BLOB_QUERY) as copy:
+                                await copy.write(copy_blob_head(sha256, size))
+                                while chunk := await stream.read(chunk_size):
+                                    await copy.write(chunk.hex())
+                                await copy.write("\n")
+                        await cur.execute(INSERT_FILE_QUERY, insert_file_params(file_id, filename, content_type, size, sha256, associated_channel))
+                    await conn.commit()
+                return True
+            except psycopg.errors.UniqueViolation:
+                # A concurrent upload of the same content stored it first; reference that
+                if attempt:
+                    raise
+
+
+    async def delete_file(self, file_id: str) -> bool:
+        """Delete a file, and its data once no other file references it."""
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(DELETE_FILE_QUERY, (file_id,))
+                row = await cur.fetchone()
+                if row is None:
+                    return False
+                await cur.execute(RELEASE_BLOB_QUERY, (row['sha256'],))
+                await cur.execute(DELETE_BLOB_QUERY, (row['sha256'],))
+            await conn.commit()
+        if self.channel_index and row['associated_channel']:
+            self.channel_index.invalidate(row['associated_channel'])  # Its chunks went with it
+        return True
+
+
+    async def get_associated_files(self, channel_id: str) -> list[FileDescription]:
+        file_data = await self._fetchall(ASSOCIATED_FILES_QUERY, (channel_id,))
+        return [file_description_from_row(file) for file in file_data]
+
+
+    async def get_file(self, file_id: str) -> dict | None:
+        return await self._fetchone(FILE_QUERY, (file_id,))
+
+
+    async def get_file_handle(self, file_id: str) -> FileHandle | None:
+        """A file's metadata, with its bytes left to be fetched on demand."""
+        row = await self._fetchone(FILE_HANDLE_QUERY, (file_id,))
+        return FileHandle(self, row) if row else None
+
+
+    async def read_file(self, file_id: str) -> bytes | None:
+        row = await self._fetchone(FILE_DATA_QUERY, (file_id,))
+        return row['data'] if row else None
+
+
+    async def iter_file(self, file_id: str, start: int = 0, end: int = None, chunk_size: int = FILE_CHUNK_SIZE):
+        """
+        Yield bytes start..end (inclusive) of a file, reading at most chunk_size
+        bytes at a time. Each read checks a connection out of the pool on its
+        own, so a slow client doesn't hold one for the whole download.
+        """
+        if end is None:
+            end = (await self.get_file_handle(file_id)).size - 1
+        while start <= end:
+            row = await self._fetchone(FILE_CHUNK_QUERY, file_chunk_params(file_id, start, min(chunk_size, end - start + 1)))
+            if not row or not row['data']:
+                return
+            yield row['data']
+            start += len(row['data'])
+
+
+    async def search_messages(self, search_query: str, limit: int = 20, offset: int = 0) -> List[dict]:
+        """
+        Full-text search for messages, best matches first, one page at a time.
+        Accepts web search syntax ("quoted phrases", or, -excluded).
+        """
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cur:
+                # Query 1: Find matching messages
+                await cur.execute(SEARCH_MESSAGES_QUERY, (search_query, limit, offset))
+                results = await cur.fetchall()
+                if not results:
+                    return []
+
+                # Query 2: The previous and next message around every hit
+                message_ids = [result['message_id'] for result in results]
+                await cur.execute(MESSAGE_CONTEXT_QUERY, {'message_ids': message_ids, 'before': 1, 'after': 1})
+                contexts = message_contexts_from_rows(message_ids, await cur.fetchall())
+                return [search_result(result, contexts[result['message_id']]) for result in results]
+
+
+    async def get_message_context(self, message_ids: List[str], before: int = 5, after: int = 5) -> dict[str, MessageContext]:
+        """
+        Get the messages surrounding each of the given messages in its channel,
+        in a single query however many ids are given.
+        """
+        rows = await self._fetchall(MESSAGE_CONTEXT_QUERY, {'message_ids': message_ids, 'before': before, 'after': after})
+        return message_contexts_from_rows(message_ids, rows)
+
+
+    async def add_reaction(self, message_id: str, user_id: str, emoji: str) -> bool | None:
+        """
+        Record a user's reaction and bump its count, in a single statement.
+        With coalescing on, the count is recounted by the next reaction flush.
+        Returns False if the user already reacted with this emoji and None if the message doesn't exist.
+        Raises UnknownUserError if the user doesn't exist.
+        """
+        query = RECORD_REACTION_QUERY if self.reactions else ADD_REACTION_QUERY
+        try:
+            row = await self._fetchone_and_commit(query, (message_id, user_id, emoji))
+        except psycopg.errors.ForeignKeyViolation as e:
+            if e.diag.constraint_name == REACTION_USER_CONSTRAINT:
+                raise UnknownUserError(f"User {user_id} not found") from e
+            print(f"Error adding reaction: {e}")
+            return None
+        if row is None:
+            return False
+        if self.reactions:
+            self.reactions.add(message_id, emoji)
+        self.events.publish("reaction", channel_id=row['channel_id'], message_id=message_id, user_id=user_id, emoji=emoji, delta=1)
+        return True
+
+
+    async def remove_reaction(self, message_id: str, user_id: str, emoji: str) -> bool:
+        """Remove a user's reaction and drop its count, in a single statement. Returns False if there was none."""
+        query = DELETE_REACTION_QUERY if self.reactions else REMOVE_REACTION_QUERY
+        row = await self._fetchone_and_commit(query, (message_id, user_id, emoji))
+        if row is None:
+            return False
+        if self.reactions:
+            self.reactions.add(message_id, emoji)
+        self.events.publish("reaction", channel_id=row['channel_id'], message_id=message_id, user_id=user_id, emoji=emoji, delta=-1)
+        return True
+
+
+    async def update_channel_members_count(self, channel_id: str, count: int) -> bool:
+        """Update the members count for a channel."""
+        await self._execute("UPDATE channels SET members_count = %s WHERE id = %s", (count, channel_id))
+        self._invalidate_channel(channel_id)
+        return True
+
+
+    async def reuse_chunks(self, file_id: str, channel_id: str = None) -> int:
+        """Copy the chunks of an already ingested file with the same content; returns how many were added."""
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(REUSE_CHUNKS_QUERY, {'file_id': file_id, 'channel_id': channel_id})
+                added = cur.rowcount
+            await conn.commit()
+        if self.channel_index and added and channel_id:
+            self.channel_index.mark_stale(channel_id)
+        return added
+
+
+    async def copy_chunks(self, chunks: List[Chunk], upsert: bool = False) -> int | None:
+        """
+        Bulk insert chunks with binary COPY. Chunks already stored are
+        skipped, or replaced with upsert. Returns the number of rows written,
+        or None on error. Throughput is reported by copy_stats().
+        """
+        start = time.perf_counter()
+        try:
+            async with self.pool.connection() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(CREATE_CHUNK_STAGING_QUERY)
+                    async with cur.copy(COPY_CHUNKS_QUERY) as copy:
+                        copy.set_types(COPY_CHUNK_TYPES)
+                        for chunk in chunks:
+                            await copy.write_row(chunk_params(chunk))
+                    copied = time.perf_counter()
+                    await cur.execute(merge_chunks_query(upsert))
+                    written = cur.rowcount
+                await conn.commit()
+        except Exception as e:
+            print(f"Error copying chunks: {e}")
+            return None
+        # Most of a large load is usually the merge, maintaining the ANN index row by row
+        self.copied_rows += len(chunks)
+        self.copy_seconds += copied - start
+        self.merge_seconds += time.perf_counter() - copied
+        if self.channel_index:
+            for channel_id in {chunk.channel_id for chunk in chunks if chunk.channel_id}:
+                # Replaced rows keep their ids, which incremental syncing wouldn't notice
+                if upsert:
+                    self.channel_index.invalidate(channel_id)
+                else:
+                    self.channel_index.mark_stale(channel_id)
+        return written
+
+
+    def copy_stats(self) -> dict:
+        elapsed = self.copy_seconds + self.merge_seconds
+        return {
+            "rows": self.copied_rows,
+            "copy_seconds": self.copy_seconds,
+            "merge_seconds": self.merge_seconds,
+            "rows_per_second": self.copied_rows / elapsed if elapsed else 0.0,
+        }
+
+
+    async def get_channel_chunks(self, channel_id: str, after_id: int = 0) -> list[dict]:
+        """A channel's chunks with ids above after_id, in id order, embeddings as pgvector Vectors."""
+        return await self._fetchall(CHANNEL_CHUNKS_QUERY, (channel_id, after_id), binary=True)
+
+
+    async def get_file_chunk_numbers(self, file_id: str) -> set[int]:
+        """The file_chunk numbers already stored for a file."""
+        return {row['file_chunk'] for row in await self._fetchall(FILE_CHUNK_NUMBERS_QUERY, (file_id,))}
+
+
+    async def count_channel_chunks(self, channel_id: str) -> int:
+        return (await self._fetchone(CHANNEL_CHUNK_COUNT_QUERY, (channel_id,)))['count']
+
+
+    async def save_presence(self, worker_id: str, changes: dict[str, tuple[int, float]]):
+        """Store this process's {user_id: (status, last_seen)} changes and announce them as 'presence' events."""
+        user_ids = list(changes)
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(SAVE_PRESENCE_QUERY, (
+                    worker_id,
+                    user_ids,
+                    [changes[user_id][0] for user_id in user_ids],
+                    [changes[user_id][1] for user_id in user_ids],
+                ))
+                # Delivered on commit, in order, to every listening process
+                payloads = presence_notifications(worker_id, {user_id: changes[user_id][0] for user_id in user_ids})
+                await cur.execute(NOTIFY_MANY_QUERY, (EVENTS_CHANNEL, payloads))
+            await conn.commit()
+
+
+    async def touch_presence_worker(self, worker_id: str, timeout: float) -> list[str]:
+        """Check this process in, and drop the presence of processes silent for `timeout` seconds; returns their ids."""
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(TOUCH_PRESENCE_WORKER_QUERY, (worker_id,))
+                await cur.execute(EXPIRE_PRESENCE_WORKERS_QUERY, (timeout,))
+                dead = [row['worker_id'] for row in await cur.fetchall()]
+                if dead:
+                    await cur.execute(DELETE_WORKER_PRESENCE_QUERY, (dead,))
+            await conn.commit()
+        return dead
+
+
+    async def remove_presence_worker(self, worker_id: str):
+        await self._execute(DELETE_WORKER_PRESENCE_QUERY, ([worker_id],))
+        await self._execute("DELETE FROM presence_workers WHERE worker_id = %s", (worker_id,))
+
+
+    async def get_presence_snapshot(self, worker_id: str) -> list[dict]:
+        return await self._fetchall(PRESENCE_SNAPSHOT_QUERY, (worker_id,))
+
+
+    async def notify(self, channel: str, payloads: list[str]):
+        """NOTIFY listeners on a channel of each payload, in order."""
+        await self._execute(NOTIFY_MANY_QUERY, (channel, payloads))
+
+
+    async def listen(self, channel: str):
+        """
+        Yield the payloads NOTIFY'd on a channel, on a dedicated connection
+        outside the pool; listening has started by the time the first
+        value, None, is yielded.
+        """
+        async with await psycopg.AsyncConnection.connect(self.conn_string, autocommit=True) as conn:
+            await conn.execute(f"LISTEN {channel}")
+            yield None
+            async for notify in conn.notifies():
+                yield notify.payload
+
+
+    async def get_cached_embeddings(self, model: str, text_hashes: List[str]) -> Dict[str, List[float]]:
+        try:
+            rows = await self._fetchall(CACHED_EMBEDDINGS_QUERY, (model, text_hashes), binary=True)
+            return {row['text_sha256']: row['embedding'].to_list() for row in rows}
+        except Exception as e:
+            print(f"Error reading cached embeddings: {e}")
+            return {}
+
+
+    async def put_cached_embeddings(self, model: str, embeddings: Dict[str, List[float]]) -> bool:
+        try:
+            async with self.pool.connection() as conn:
+                async with conn.cursor() as cur:
+                    await cur.executemany(INSERT_CACHED_EMBEDDING_QUERY, [(model, text_hash, as_vector(vector)) for text_hash, vector in embeddings.items()])
+                await conn.commit()
+            return True
+        except Exception as e:
+            print(f"Error caching embeddings: {e}")
+            return False
+
+
+    async def similarity_search(self, query_vector: List[float], top_k: int = 10, ef_search: int = None, probes: int = None,
+                                exact: bool = None, include_embeddings: bool = False) -> List[Chunk]:
+        try:
+            query = similarity_search_query(include_embeddings=include_embeddings)
+            return await self._vector_search(query, (as_vector(query_vector), top_k), ef_search, probes, exact)
+        except Exception as e:
+            print(f"Error in similarity search: {e}")
+            return []
+
+
+    async def similarity_search_in_channel(self, query_vector: List[float], channel_id: str, top_k: int = 10,
+                                           ef_search: int = None, probes: int = None, exact: bool = None,
+                                           include_embeddings: bool = False) -> List[Chunk]:
+        """
+        Served from the in-process channel index when there is one, unless
+        index settings are given or the channel is too large to hold. Otherwise
+        small channels are searched exactly (EXACT_CHANNEL_SEARCH_ROWS).
+        """
+        try:
+            if self.channel_index and ef_search is None and probes is None and exact is None:
+                chunks = await self.channel_index.search(channel_id, query_vector, top_k, include_embeddings)
+                if chunks is not None:
+                    return chunks
+            if exact is None:
+                exact = await self.count_channel_chunks(channel_id) <= EXACT_CHANNEL_SEARCH_ROWS or None
+            query = similarity_search_query(in_channel=True, include_embeddings=include_embeddings)
+            return await self._vector_search(query, (as_vector(query_vector), channel_id, top_k), ef_search, probes,
+                                             exact, filtered=True)
+        except Exception as e:
+            print(f"Error in channel similarity search: {e}")
+            return []
+
+
+    async def _vector_search(self, query: str, params: tuple, ef_search: int = None, probes: int = None,
+                             exact: bool = None, filtered: bool = False) -> List[Chunk]:
+        async with self.pool.connection() as conn:
+            async with conn.cursor(binary=True) as cur:
+                for setting in vector_search_settings(ef_search, probes, exact, filtered):
+                    await cur.execute(SET_LOCAL_QUERY, setting)
+                await cur.execute(query, params)
+                return [chunk_from_row(chunk) for chunk in await cur.fetchall()]
+
+
+    async def get_recent_messages(self, hours: int = 24) -> list[Message]:
+        """Get all messages from the past specified hours."""
+        try:
+            message_data = await self._fetchall(RECENT_MESSAGES_QUERY, (hours,))
+            print(f"Query executed. Found {len(message_data)} messages")
+            return [message_from_row(msg) for msg in message_data]
+        except Exception as e:
+            print(f"Error in get_recent_messages: {e}")
+            import traceback
+            traceback.print_exc()
+            return []
+
+
+    async def get_messages_for_users(self, user_ids: List[str], start_time: datetime = None, end_time: datetime = None) -> list[Message]:
+        """Get all messages from specified users within an optional time frame."""
+        try:
+            message_data = await self._fetchall(*messages_for_users_query(user_ids, start_time, end_time))
+            return [message_from_row(msg) for msg in message_data]
+        except Exception as e:
+            print(f"Error getting messages for users: {e}")
+            return []
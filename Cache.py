@@ -0,0 +1,217 @@
+import threading
+import time
+from collections import OrderedDict
+from Models import User, Channel
+
+
+class TTLCache:
+    """
+    A bounded in-process cache with LRU eviction where every entry also
+    expires `ttl` seconds after it was written. Safe to share between threads.
+    """
+
+    def __init__(self, max_size: int = 10_000, ttl: float = 300.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value), least recently used first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class ByteCache:
+    """
+    An LRU cache for small immutable payloads, bounded by their total size in
+    bytes rather than by count. Values bigger than `max_item_bytes` are never
+    cached. Safe to share between threads.
+    """
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024, max_item_bytes: int = 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self._entries = OrderedDict()  # key -> (size, value), least recently used first
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, size: int) -> bool:
+        """Cache `value`, which takes `size` bytes. Returns False if it is too big to cache."""
+        if size > self.max_item_bytes:
+            return False
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous:
+                self.total_bytes -= previous[0]
+            self._entries[key] = (size, value)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, (evicted_size, _) = self._entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+                self.evictions += 1
+            return True
+
+    def invalidate(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry:
+                self.total_bytes -= entry[0]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class MetadataCache:
+    """
+    Read-through cache for the user, channel and membership lookups on the hot
+    paths. Only rows that exist are cached, except memberships, where a cached
+    "not a member" is dropped by the same invalidation as a new membership.
+
+    Models are copied on the way in and out so callers can't mutate cached state.
+    """
+
+    def __init__(self, max_size: int = 10_000, user_ttl: float = 300.0, channel_ttl: float = 60.0, membership_ttl: float = 60.0):
+        self.users = TTLCache(max_size, user_ttl)  # user_id -> User
+        self.user_ids_by_name = TTLCache(max_size, user_ttl)  # username -> user_id
+        self.channels = TTLCache(max_size, channel_ttl)  # channel_id -> Channel
+        self.channel_ids_by_name = TTLCache(max_size, channel_ttl)  # channel name -> channel_id
+        self.channel_users = TTLCache(max_size, membership_ttl)  # channel_id -> list[User]
+        self.memberships = TTLCache(max_size, membership_ttl)  # (user_id, channel_id) -> bool
+
+    def get_user(self, user_id: str) -> User | None:
+        user = self.users.get(user_id)
+        return user.model_copy() if user else None
+
+    def get_user_by_username(self, username: str) -> User | None:
+        user_id = self.user_ids_by_name.get(username)
+        return self.get_user(user_id) if user_id else None
+
+    def put_user(self, user: User | None):
+        if user:
+            self.users.set(user.id, user.model_copy())
+            self.user_ids_by_name.set(user.username, user.id)
+
+    def invalidate_user(self, user_id: str, username: str = None):
+        self.users.invalidate(user_id)
+        if username:
+            self.user_ids_by_name.invalidate(username)
+
+    def get_channel(self, channel_id: str) -> Channel | None:
+        channel = self.channels.get(channel_id)
+        return channel.model_copy() if channel else None
+
+    def get_channel_by_name(self, name: str) -> Channel | None:
+        channel_id = self.channel_ids_by_name.get(name)
+        return self.get_channel(channel_id) if channel_id else None
+
+    def put_channel(self, channel: Channel | None, by_name: bool = False):
+        if channel:
+            self.channels.set(channel.id, channel.model_copy())
+            if by_name:
+                self.channel_ids_by_name.set(channel.name, channel.id)
+
+    def invalidate_channel(self, channel_id: str):
+        self.channels.invalidate(channel_id)
+
+    def get_channel_users(self, channel_id: str) -> list[User] | None:
+        users = self.channel_users.get(channel_id)
+        return [user.model_copy() for user in users] if users is not None else None
+
+    def put_channel_users(self, channel_id: str, users: list[User]):
+        self.channel_users.set(channel_id, [user.model_copy() for user in users])
+
+    def get_membership(self, user_id: str, channel_id: str) -> bool | None:
+        return self.memberships.get((user_id, channel_id))
+
+    def put_membership(self, user_id: str, channel_id: str, is_member: bool):
+        self.memberships.set((user_id, channel_id), is_member)
+
+    def invalidate_membership(self, user_id: str, channel_id: str):
+        """A user joined or left a channel: its count, member list and the pair are stale."""
+        self.memberships.invalidate((user_id, channel_id))
+        self.channel_users.invalidate(channel_id)
+        self.channels.invalidate(channel_id)
+
+    def clear(self):
+        for cache in self._caches().values():
+            cache.clear()
+
+    def stats(self) -> dict:
+        return {name: cache.stats() for name, cache in self._caches().items()}
+
+    def _caches(self) -> dict[str, TTLCache]:
+        return {
+            "users": self.users,
+            "user_ids_by_name": self.user_ids_by_name,
+            "channels": self.channels,
+            "channel_ids_by_name": self.channel_ids_by_name,
+            "channel_users": self.channel_users,
+            "memberships": self.memberships,
+        }
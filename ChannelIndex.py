@@ -0,0 +1,290 @@
+import asyncio
+import fcntl
+import json
+import os
+import tempfile
+import time
+import uuid
+from collections import OrderedDict
+from typing import List
+import numpy as np
+from Models import Chunk
+
+# Directory for channel embedding snapshots; unset leaves channel search in Postgres
+CHANNEL_INDEX_DIR = os.getenv("CHANNEL_INDEX_DIR")
+# Channels with more chunks than this are searched in Postgres
+CHANNEL_INDEX_MAX_ROWS = int(os.getenv("CHANNEL_INDEX_MAX_ROWS", "50000"))
+# Bytes of vectors held across channels; the least recently searched are dropped beyond it
+CHANNEL_INDEX_MAX_BYTES = int(os.getenv("CHANNEL_INDEX_MAX_BYTES", str(1024 * 1024 * 1024)))
+# Seconds before a loaded channel is checked against the database for writes by other processes
+CHANNEL_INDEX_TTL = float(os.getenv("CHANNEL_INDEX_TTL", "60"))
+
+
+class ChannelMatrix:
+    """
+    One channel's chunks: their embeddings as rows of a float32 matrix, in
+    chunk id order, alongside ids, norms and the chunk columns a search
+    returns. Once saved, the matrix is memory-mapped read-only from its
+    snapshot; appended rows are held in a growable buffer until the next save.
+
+    A snapshot is append-only: raw vectors in one file and a JSON line per
+    row in another, of which a small manifest, replaced atomically, says how
+    many rows are valid. Saving writes only the rows past the manifest, so
+    processes that share the directory never see a file shrink under their
+    maps; a channel whose rows were rewritten starts a new generation of
+    files instead.
+    """
+
+    def __init__(self, channel_id: str, vectors: np.ndarray, ids: List[int], file_ids: List[str], file_chunks: List[int], texts: List[str]):
+        self.channel_id = channel_id
+        self.vectors = vectors
+        self.size = len(ids)
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.file_ids = list(file_ids)
+        self.file_chunks = list(file_chunks)
+        self.texts = list(texts)
+        self.norms = np.linalg.norm(vectors[:self.size], axis=1) if self.size else np.zeros(0, dtype=np.float32)
+        self.validated_at = time.monotonic()
+
+    @classmethod
+    def empty(cls, channel_id: str) -> "ChannelMatrix":
+        return cls(channel_id, np.empty((0, 0), dtype=np.float32), [], [], [], [])
+
+    @property
+    def max_id(self) -> int:
+        return int(self.ids[-1]) if self.size else 0
+
+    @property
+    def nbytes(self) -> int:
+        return self.vectors.nbytes
+
+    def append(self, rows: list[dict]):
+        if not rows:
+            return
+        new = np.stack([row['embedding'].to_numpy() for row in rows]).astype(np.float32, copy=False)
+        needed = self.size + len(new)
+        if not self.vectors.flags.writeable or needed > len(self.vectors):
+            capacity = max(needed, 2 * len(self.vectors), 64)
+            buffer = np.empty((capacity, new.shape[1]), dtype=np.float32)
+            if self.size:
+                buffer[:self.size] = self.vectors[:self.size]
+            self.vectors = buffer
+        self.vectors[self.size:needed] = new
+        self.ids = np.concatenate([self.ids, [row['id'] for row in rows]])
+        self.norms = np.concatenate([self.norms, np.linalg.norm(new, axis=1)])
+        self.file_ids += [row['file_id'] for row in rows]
+        self.file_chunks += [row['file_chunk'] for row in rows]
+        self.texts += [row['text'] for row in rows]
+        self.size = needed
+
+    def search(self, query_vector, top_k: int, include_embeddings: bool = False) -> List[Chunk]:
+        """The top_k chunks by cosine similarity, nearest first, as Postgres' `<=>` would order them."""
+        if not self.size:
+            return []
+        query = np.asarray(query_vector, dtype=np.float32)
+        matrix = self.vectors[:self.size]
+        scores = (matrix @ query) / np.maximum(self.norms * np.linalg.norm(query), 1e-12)
+        k = min(top_k, self.size)
+        nearest = np.argpartition(-scores, k - 1)[:k] if k < self.size else np.arange(self.size)
+        nearest = nearest[np.argsort(-scores[nearest], kind='stable')]
+        return [
+            Chunk(
+                id=int(self.ids[i]),
+                embedding=matrix[i].tolist() if include_embeddings else None,
+                file_id=self.file_ids[i],
+                file_chunk=self.file_chunks[i],
+                text=self.texts[i],
+                channel_id=self.channel_id
+            )
+            for i in nearest
+        ]
+
+    def save(self, directory: str):
+        """Write the rows the snapshot is missing, then map the matrix from it."""
+        if not self.size:
+            return
+        path = snapshot_path(directory, self.channel_id)
+        dim = self.vectors.shape[1]
+        with open(path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)  # Released when closed
+            manifest = previous = read_manifest(path)
+            if manifest and manifest["rows"] > self.size:
+                return  # Another process has saved more of the channel
+            if not manifest or manifest["dim"] != dim or not manifest["rows"] or int(self.ids[manifest["rows"] - 1]) != manifest["last_id"]:
+                # Nothing saved yet, or saved from rows since rewritten
+                manifest = {"generation": uuid.uuid4().hex, "dim": dim, "rows": 0, "meta_bytes": 0}
+            start = manifest["rows"]
+            vectors_path, meta_path = data_paths(path, manifest["generation"])
+            with open(vectors_path, "ab") as f:
+                f.truncate(start * dim * 4)  # Drops only what a save that didn't finish left past the manifest
+                f.write(np.ascontiguousarray(self.vectors[start:self.size]).tobytes())
+            meta = "".join(
+                json.dumps([int(self.ids[i]), self.file_ids[i], self.file_chunks[i], self.texts[i]]) + "\n"
+                for i in range(start, self.size)
+            ).encode()
+            with open(meta_path, "ab") as f:
+                f.truncate(manifest["meta_bytes"])
+                f.write(meta)
+            write_manifest(path, {**manifest, "rows": self.size, "meta_bytes": manifest["meta_bytes"] + len(meta), "last_id": self.max_id})
+            if previous and previous["generation"] != manifest["generation"]:
+                remove_files(data_paths(path, previous["generation"]))
+        self.vectors = np.memmap(vectors_path, dtype=np.float32, mode='r', shape=(self.size, dim))
+
+    @classmethod
+    def load(cls, directory: str, channel_id: str) -> "ChannelMatrix | None":
+        path = snapshot_path(directory, channel_id)
+        try:
+            manifest = read_manifest(path)
+            if not manifest:
+                return None
+            vectors_path, meta_path = data_paths(path, manifest["generation"])
+            vectors = np.memmap(vectors_path, dtype=np.float32, mode='r', shape=(manifest["rows"], manifest["dim"]))
+            with open(meta_path, "rb") as f:
+                rows = [json.loads(line) for line in f.read(manifest["meta_bytes"]).splitlines()]
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error loading channel index snapshot for {channel_id}: {e}")
+            return None
+        ids, file_ids, file_chunks, texts = zip(*rows) if rows else ((), (), (), ())
+        return cls(channel_id, vectors, ids, file_ids, file_chunks, texts)
+
+
+def snapshot_path(directory: str, channel_id: str) -> str:
+    return os.path.join(directory, f"chunks-{channel_id}")
+
+
+def data_paths(path: str, generation: str) -> tuple[str, str]:
+    """The vectors and row metadata files of one generation of a snapshot."""
+    return f"{path}.{generation}.f32", f"{path}.{generation}.jsonl"
+
+
+def read_manifest(path: str) -> dict | None:
+    try:
+        with open(path + ".json") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_manifest(path: str, manifest: dict):
+    """Replace the manifest atomically, through a temporary file no other writer uses."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, path + ".json")
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def remove_snapshot(directory: str, channel_id: str):
+    """Delete a channel's snapshot; processes that have it mapped keep their copy until they let go."""
+    path = snapshot_path(directory, channel_id)
+    with open(path + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        manifest = read_manifest(path)
+        try:
+            os.remove(path + ".json")
+        except FileNotFoundError:
+            pass
+    if manifest:
+        remove_files(data_paths(path, manifest["generation"]))
+
+
+def remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class ChannelIndex:
+    """
+    In-process exact search over the chunks of recently searched channels, so
+    channel-scoped RAG is a matrix product instead of a database round trip.
+    A channel is loaded from its snapshot, or from the database, on first
+    search, then kept in sync by reading only chunks with a higher id:
+    right away after this process adds chunks to it, and every
+    CHANNEL_INDEX_TTL seconds for writes by other processes. If rows have
+    disappeared (a file was deleted) the channel is read again in full.
+    Channels are dropped, least recently searched first, to keep their
+    matrices within max_bytes.
+    """
+
+    def __init__(self, layer, directory: str = CHANNEL_INDEX_DIR, max_rows: int = CHANNEL_INDEX_MAX_ROWS,
+                 max_bytes: int = CHANNEL_INDEX_MAX_BYTES, ttl: float = CHANNEL_INDEX_TTL):
+        self.layer = layer
+        self.directory = directory
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.channels: OrderedDict[str, ChannelMatrix | None] = OrderedDict()  # None: too large, search in Postgres
+        self.stale = set()
+        self.locks: dict[str, asyncio.Lock] = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def mark_stale(self, channel_id: str):
+        """Chunks were added to the channel; they are read before its next search."""
+        self.stale.add(channel_id)
+
+    def invalidate(self, channel_id: str):
+        """Chunks were removed from the channel; it is read again in full before its next search."""
+        self.channels.pop(channel_id, None)
+        self.stale.discard(channel_id)
+        remove_snapshot(self.directory, channel_id)
+
+    async def search(self, channel_id: str, query_vector: List[float], top_k: int = 10, include_embeddings: bool = False) -> List[Chunk] | None:
+        """The channel's nearest chunks, or None if the channel is too large to hold and should be searched in Postgres."""
+        matrix = await self._channel(channel_id)
+        if matrix is None:
+            return None
+        return matrix.search(query_vector, top_k, include_embeddings)
+
+    async def _channel(self, channel_id: str) -> ChannelMatrix | None:
+        lock = self.locks.setdefault(channel_id, asyncio.Lock())
+        async with lock:
+            if channel_id in self.channels:
+                matrix = self.channels[channel_id]
+                self.channels.move_to_end(channel_id)
+                if matrix is None or (channel_id not in self.stale and time.monotonic() - matrix.validated_at < self.ttl):
+                    return matrix
+            else:
+                matrix = await asyncio.to_thread(ChannelMatrix.load, self.directory, channel_id)
+
+            self.stale.discard(channel_id)
+            matrix = await self._sync(channel_id, matrix)
+            self.channels[channel_id] = matrix
+            while len(self.channels) > 1 and self.nbytes() > self.max_bytes:
+                evicted, _ = self.channels.popitem(last=False)
+                self.locks.pop(evicted, None)
+            return matrix
+
+    async def _sync(self, channel_id: str, matrix: ChannelMatrix | None) -> ChannelMatrix | None:
+        count = await self.layer.count_channel_chunks(channel_id)
+        if count > self.max_rows:
+            return None
+        if matrix is None or count < matrix.size:
+            matrix = ChannelMatrix.empty(channel_id)
+        rows = await self.layer.get_channel_chunks(channel_id, after_id=matrix.max_id)
+        if matrix.size + len(rows) != count:
+            # Rows below max_id were deleted (or the counts raced a write); start over
+            matrix = ChannelMatrix.empty(channel_id)
+            rows = await self.layer.get_channel_chunks(channel_id, after_id=0)
+        if rows:
+            matrix.append(rows)
+            await asyncio.to_thread(matrix.save, self.directory)
+        matrix.validated_at = time.monotonic()
+        return matrix
+
+    def nbytes(self) -> int:
+        return sum(matrix.nbytes for matrix in self.channels.values() if matrix is not None)
+
+    def stats(self) -> dict:
+        loaded = [matrix for matrix in self.channels.values() if matrix is not None]
+        return {
+            "channels": len(loaded),
+            "too_large": len(self.channels) - len(loaded),
+            "rows": sum(matrix.size for matrix in loaded),
+            "bytes": self.nbytes(),
+        }
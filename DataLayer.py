@@ -3,12 +3,17 @@ from psycopg.rows import dict_row
 from Models import *
 import json
 import uuid
+import base64
+import hashlib
+import html
+import numpy as np
 from datetime import datetime, timedelta
 from typing import List, Dict
 from dotenv import load_dotenv
 import os
 from psycopg_pool import ConnectionPool
 from pgvector.psycopg import register_vector
+from Cache import MetadataCache
 
 # load_dotenv()
 
@@ -36,7 +41,9 @@ CREATE TABLE channels (
     channel_type VARCHAR(20),
     description TEXT,
     members_count INTEGER DEFAULT 0,
-    creator_id VARCHAR(36) REFERENCES users(id)
+    creator_id VARCHAR(36) REFERENCES users(id),
+    -- Precomputed flag read on the send path
+    has_ai_member BOOLEAN DEFAULT FALSE
 );
 
 CREATE TABLE channel_memberships (
@@ -45,6 +52,13 @@ CREATE TABLE channel_memberships (
     PRIMARY KEY (user_id, channel_id)
 );
 
+-- Existing databases: add and backfill has_ai_member
+ALTER TABLE channels ADD COLUMN IF NOT EXISTS has_ai_member BOOLEAN DEFAULT FALSE;
+UPDATE channels c SET has_ai_member = EXISTS (
+    SELECT 1 FROM channel_memberships cm JOIN users u ON u.id = cm.user_id
+    WHERE cm.channel_id = c.id AND u.username = 'ai'
+);
+
 CREATE TABLE messages (
     id VARCHAR(36) PRIMARY KEY,
     sent TIMESTAMP,
@@ -59,6 +73,34 @@ CREATE TABLE messages (
     image TEXT
 );
 
+-- Keyset pagination of channel history
+CREATE INDEX messages_channel_sent_id_idx ON messages (channel_id, sent, id);
+
+-- Full-text search; text is only indexed separately when it differs from content
+ALTER TABLE messages ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (
+    to_tsvector('english', coalesce(content, '') ||
+        CASE WHEN text IS DISTINCT FROM content THEN ' ' || coalesce(text, '') ELSE '' END)
+) STORED;
+CREATE INDEX messages_search_vector_idx ON messages USING GIN (search_vector);
+
+-- Who reacted with what; messages.reactions holds the per-emoji counts
+CREATE TABLE message_reactions (
+    message_id VARCHAR(36) REFERENCES messages(id) ON DELETE CASCADE,
+    user_id VARCHAR(36) REFERENCES users(id),
+    emoji VARCHAR(64),
+    created_at TIMESTAMP DEFAULT now(),
+    PRIMARY KEY (message_id, user_id, emoji)
+);
+
+-- Existing databases: counts recorded before message_reactions existed name no
+-- reactors, so they could never be removed and a recount would zero them. They
+-- are dropped, and messages.reactions rebuilt from message_reactions
+UPDATE messages m SET reactions = COALESCE((
+    SELECT jsonb_object_agg(r.emoji, r.count)
+    FROM (SELECT emoji, count(*) AS count FROM message_reactions WHERE message_id = m.id GROUP BY emoji) r
+), '{}'::jsonb)
+WHERE m.reactions IS DISTINCT FROM '{}'::jsonb;
+
 CREATE TABLE files (
     id VARCHAR(36) PRIMARY KEY,
     created_at TIMESTAMP,
@@ -67,12 +109,948 @@ CREATE TABLE files (
     data BYTEA,
     size INTEGER
 );
+
+-- Keep file data uncompressed in TOAST so byte ranges are read chunk by chunk
+ALTER TABLE files ALTER COLUMN data SET STORAGE EXTERNAL;
+
+-- Hex SHA-256 of the file data, computed while the upload streams in
+ALTER TABLE files ADD COLUMN sha256 CHAR(64);
+
+-- File data is stored once per distinct content; files rows reference it
+-- by hash, and ref_count is the number of files rows doing so
+CREATE TABLE file_blobs (
+    sha256 CHAR(64) PRIMARY KEY,
+    created_at TIMESTAMP DEFAULT now(),
+    size BIGINT,
+    ref_count INTEGER NOT NULL DEFAULT 0,
+    data BYTEA
+);
+ALTER TABLE file_blobs ALTER COLUMN data SET STORAGE EXTERNAL;
+
+-- Move existing file data into blobs; files.data is no longer written
+UPDATE files SET sha256 = encode(sha256(data), 'hex') WHERE data IS NOT NULL;
+INSERT INTO file_blobs (sha256, size, ref_count, data)
+SELECT DISTINCT ON (sha256) sha256, octet_length(data), count(*) OVER (PARTITION BY sha256), data
+FROM files WHERE data IS NOT NULL ORDER BY sha256;
+UPDATE files SET data = NULL;
+ALTER TABLE files ADD FOREIGN KEY (sha256) REFERENCES file_blobs (sha256);
+CREATE INDEX files_sha256_idx ON files (sha256);
+
+-- Per-channel file listings, in upload order
+CREATE INDEX files_associated_channel_idx ON files (associated_channel, created_at);
+
+-- Approximate nearest-neighbour search over chunk embeddings; managed by
+-- DataLayer.create_vector_index (see VectorIndex.py), e.g.
+CREATE INDEX chunks_embedding_idx ON chunks USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64);
+-- Lets the planner search a small channel's chunks exactly instead
+CREATE INDEX chunks_channel_id_idx ON chunks (channel_id);
+
+-- Embeddings already paid for, by model and SHA-256 of the embedded text
+CREATE TABLE embedding_cache (
+    model VARCHAR(255),
+    text_sha256 CHAR(64),
+    embedding vector,
+    created_at TIMESTAMP DEFAULT now(),
+    PRIMARY KEY (model, text_sha256)
+);
+
+-- Presence shared by the API processes: each process's view of the users
+-- connected to it, written on status changes and announced as 'presence'
+-- events on the 'events' NOTIFY channel (see EventBus.py). Rows of processes that stop checking in are
+-- dropped. Unlogged: presence is rebuilt from live connections anyway
+CREATE UNLOGGED TABLE presence_workers (
+    worker_id VARCHAR(128) PRIMARY KEY,
+    seen_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+CREATE UNLOGGED TABLE presence (
+    user_id TEXT,
+    worker_id VARCHAR(128),
+    status SMALLINT NOT NULL,  -- 0 offline, 1 online, 2 away
+    last_seen TIMESTAMPTZ NOT NULL,
+    PRIMARY KEY (user_id, worker_id)
+);
+"""
+
+def encode_message_cursor(message: Message) -> str:
+    """Encode a message's (sent, id) position as an opaque pagination cursor."""
+    raw = f"{message.sent}|{message.id}".encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_message_cursor(cursor: str) -> tuple[datetime, str]:
+    """Decode a pagination cursor back into (sent, id). Raises ValueError if malformed."""
+    try:
+        sent, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+        return datetime.fromisoformat(sent), message_id
+    except Exception as e:
+        raise ValueError(f"Invalid message cursor: {cursor}") from e
+
+
+# Columns and joins shared by every query that hydrates full Message objects
+MESSAGE_COLUMNS = """
+    m.id as message_id,
+    m.sent,
+    m.text,
+    m.content,
+    m.channel_id,
+    m.reactions,
+    m.has_thread,
+    m.has_image,
+    m.thread_id,
+    m.image,
+    m.file_id,
+    f.filename as file_name,
+    f.content_type as file_content_type,
+    u.id as user_id,
+    u.created_at as user_created_at,
+    u.username,
+    u.password,
+    u.token,
+    u.status,
+    u.profile_picture
+"""
+
+MESSAGE_JOINS = """
+    FROM messages m
+    JOIN users u ON m.sender_id = u.id
+    LEFT JOIN files f ON m.file_id = f.id
+"""
+
+MESSAGE_SELECT = f"SELECT {MESSAGE_COLUMNS} {MESSAGE_JOINS}"
+
+
+def user_from_row(row: dict) -> User:
+    return User(**{**row, 'created_at': row['created_at'].isoformat()})
+
+
+def channel_from_row(row: dict) -> Channel:
+    return Channel(**{**row, 'created_at': row['created_at'].isoformat()})
+
+
+def message_from_row(row: dict) -> Message:
+    """Build a Message from a row selected with MESSAGE_COLUMNS."""
+    reactions = row['reactions']
+    if isinstance(reactions, str):
+        reactions = json.loads(reactions)
+    return Message(
+        id=row['message_id'],
+        sent=row['sent'].isoformat(),
+        text=row['text'],
+        content=row['content'],
+        channel_id=row['channel_id'],
+        reactions=reactions or {},
+        has_thread=row['has_thread'],
+        has_image=row['has_image'],
+        thread_id=row['thread_id'],
+        image=row['image'],
+        file_id=row['file_id'],
+        file_name=row['file_name'],
+        file_content_type=row['file_content_type'],
+        sender=User(
+            id=row['user_id'],
+            created_at=row['user_created_at'].isoformat(),
+            username=row['username'],
+            password=row['password'],
+            token=row['token'],
+            status=row['status'],
+            profile_picture=row['profile_picture']
+        )
+    )
+
+
+def file_description_from_row(row: dict) -> FileDescription:
+    return FileDescription(
+        id=row['id'],
+        filename=row['filename'],
+        content_type=row['content_type'],
+        size=row['size'],
+        created_at=row['created_at'].isoformat(),  # Convert datetime to string
+        channel_id=row['associated_channel']  # Map associated_channel to channel_id
+    )
+
+
+def as_vector(vector) -> np.ndarray:
+    """A query parameter for a vector column, sent in pgvector's binary format."""
+    return np.asarray(vector, dtype=np.float32)
+
+
+def chunk_from_row(row: dict) -> Chunk:
+    embedding = row.get('embedding')
+    return Chunk(
+        id=row['id'],
+        embedding=embedding.to_list() if embedding is not None else None,  # Only selected when asked for
+        file_id=row['file_id'],
+        file_chunk=row['file_chunk'],
+        text=row['text'],
+        channel_id=row['channel_id']
+    )
+
+
+def channel_messages_query(channel_id: str, before: str = None, after: str = None, limit: int = None) -> tuple[str, list, bool]:
+    """
+    Build the keyset-paginated channel history query.
+
+    Pages are keyed on (sent, id) so every page is an index range scan:
+    `before` returns the newest `limit` messages older than that cursor,
+    `after` the oldest `limit` messages newer than it, and neither returns
+    the newest `limit` messages in the channel.
+
+    `sent` is assigned by the application before the message commits, so a
+    message that commits after a newer one (a slow insert, or a group commit
+    window) can land behind an `after` cursor a client already holds and be
+    missed by polling. Clients that must see every message use the WebSocket
+    push, or poll from a cursor taken a few seconds back and skip duplicates.
+
+    Returns the query, its parameters, and whether rows come back newest
+    first and must be reversed.
+    """
+    conditions = ["m.channel_id = %s"]
+    params = [channel_id]
+    if before:
+        conditions.append("(m.sent, m.id) < (%s, %s)")
+        params.extend(decode_message_cursor(before))
+    if after:
+        conditions.append("(m.sent, m.id) > (%s, %s)")
+        params.extend(decode_message_cursor(after))
+
+    # Walk backwards from the newest end unless paging forward from a cursor
+    descending = limit is not None and not after
+    direction = "DESC" if descending else "ASC"
+    query = f"""
+        {MESSAGE_SELECT}
+        WHERE {" AND ".join(conditions)}
+        ORDER BY m.sent {direction}, m.id {direction}
+    """
+    if limit is not None:
+        query += " LIMIT %s"
+        params.append(limit)
+    return query, params, descending
+
+
+def messages_page(messages: list[Message], limit: int, after: str = None) -> tuple[list[Message], str | None, str | None]:
+    """
+    Trim a `limit + 1` row fetch to one page and work out its cursors.
+
+    The next cursor continues in the direction being paged (older messages
+    unless `after` was given) and is None once that end of the history is
+    reached. The newest cursor is the position of the page's newest message,
+    or `after` itself when nothing newer has arrived: passed back as `after`
+    it polls for messages sent since.
+    """
+    next_cursor = None
+    if len(messages) > limit:
+        if after:
+            messages = messages[:limit]
+            next_cursor = encode_message_cursor(messages[-1])
+        else:
+            messages = messages[1:]
+            next_cursor = encode_message_cursor(messages[0])
+    newest_cursor = encode_message_cursor(messages[-1]) if messages else after
+    return messages, next_cursor, newest_cursor
+
+
+def messages_for_users_query(usernames: List[str], start_time: datetime = None, end_time: datetime = None) -> tuple[str, list]:
+    query = f"""
+        {MESSAGE_SELECT}
+        WHERE u.username = ANY(%s)
+    """
+    params = [usernames]
+
+    # Add time constraints if provided
+    if start_time:
+        query += " AND m.sent >= %s"
+        params.append(start_time)
+    if end_time:
+        query += " AND m.sent <= %s"
+        params.append(end_time)
+
+    query += " ORDER BY m.sent ASC"
+    return query, params
+
+
+# ts_headline marks matches with these control characters, which are stripped
+# from the content first, so the snippet can be HTML-escaped before the
+# markers become <b> tags
+SNIPPET_START, SNIPPET_STOP = "\x02", "\x03"
+
+# Ranked full-text search served by the GIN index on messages.search_vector.
+# ts_rank_cd is normalized into [0, 1) and the headline is only computed for
+# the rows that survive the LIMIT.
+SEARCH_MESSAGES_QUERY = f"""
+    SELECT {MESSAGE_COLUMNS}, c.name as channel_name,
+        ts_rank_cd(m.search_vector, q.query, 32) as score,
+        ts_headline('english', translate(coalesce(m.content, m.text, ''), chr(2) || chr(3), ''), q.query,
+            'MaxFragments=2, MaxWords=25, MinWords=8, StartSel=' || chr(2) || ', StopSel=' || chr(3)) as snippet
+    {MESSAGE_JOINS}
+    JOIN channels c ON m.channel_id = c.id
+    CROSS JOIN websearch_to_tsquery('english', %s) AS q(query)
+    WHERE m.search_vector @@ q.query
+    ORDER BY score DESC, m.sent DESC, m.id
+    LIMIT %s OFFSET %s
+"""
+
+# For every hit, the `before` messages preceding it and the `after` messages
+# following it in the same channel. Each side is an index range scan on
+# (channel_id, sent, id) bounded by its LIMIT, all in a single statement.
+MESSAGE_CONTEXT_QUERY = f"""
+    SELECT ctx.hit_id, ctx.direction, {MESSAGE_COLUMNS}
+    FROM messages h
+    CROSS JOIN LATERAL (
+        (SELECT h.id AS hit_id, p.id AS context_id, -1 AS direction
+         FROM messages p
+         WHERE p.channel_id = h.channel_id AND (p.sent, p.id) < (h.sent, h.id)
+         ORDER BY p.sent DESC, p.id DESC
+         LIMIT %(before)s)
+        UNION ALL
+        (SELECT h.id, n.id, 1
+         FROM messages n
+         WHERE n.channel_id = h.channel_id AND (n.sent, n.id) > (h.sent, h.id)
+         ORDER BY n.sent ASC, n.id ASC
+         LIMIT %(after)s)
+    ) ctx
+    JOIN messages m ON m.id = ctx.context_id
+    JOIN users u ON m.sender_id = u.id
+    LEFT JOIN files f ON m.file_id = f.id
+    WHERE h.id = ANY(%(message_ids)s)
+    ORDER BY ctx.hit_id, m.sent, m.id
+"""
+
+
+def message_contexts_from_rows(message_ids: List[str], rows: list[dict]) -> dict[str, MessageContext]:
+    """Group MESSAGE_CONTEXT_QUERY rows by the message they surround."""
+    contexts = {message_id: MessageContext(message_id=message_id) for message_id in message_ids}
+    for row in rows:
+        context = contexts[row['hit_id']]
+        if row['direction'] < 0:
+            context.previous_messages.append(message_from_row(row))
+        else:
+            context.next_messages.append(message_from_row(row))
+    return contexts
+
+
+def snippet_html(snippet: str | None) -> str | None:
+    """A ts_headline snippet as HTML: the content escaped, the matches in <b> tags."""
+    if snippet is None:
+        return None
+    return html.escape(snippet).replace(SNIPPET_START, "<b>").replace(SNIPPET_STOP, "</b>")
+
+
+def search_result(row: dict, context: MessageContext) -> dict:
+    return {
+        'channel_id': row['channel_id'],
+        'channel_name': row['channel_name'],
+        'message': message_from_row(row),
+        'previous_message': context.previous_messages[-1] if context.previous_messages else None,
+        'next_message': context.next_messages[0] if context.next_messages else None,
+        'score': row['score'],
+        'snippet': snippet_html(row['snippet'])
+    }
+
+
+# Columns written for a new message, in the order of insert_message_params
+INSERT_MESSAGE_COLUMNS = """
+    INSERT INTO messages
+        (id, sent, text, content, channel_id, sender_id, reactions,
+         has_thread, has_image, thread_id, image, file_id)
+"""
+
+MESSAGE_VALUES_ROW = "(" + ", ".join(["%s"] * 12) + ")"
+
+
+def post_messages_query(count: int) -> str:
+    """
+    Inserts `count` messages in one multi-row INSERT and hydrates them with
+    their senders, files and the channel flags the send path needs, in one
+    statement; params are the rows' params concatenated.
+    """
+    return f"""
+    WITH m AS (
+        {INSERT_MESSAGE_COLUMNS}
+        VALUES {", ".join([MESSAGE_VALUES_ROW] * count)}
+        RETURNING *
+    )
+    SELECT {MESSAGE_COLUMNS}, c.channel_type, c.has_ai_member
+    FROM m
+    JOIN users u ON m.sender_id = u.id
+    JOIN channels c ON m.channel_id = c.id
+    LEFT JOIN files f ON m.file_id = f.id
+"""
+
+
+POST_MESSAGE_QUERY = post_messages_query(1)
+
+# The user whose membership makes a DM a conversation with the agent
+AI_USERNAME = "ai"
+
+ADD_MEMBER_TO_CHANNEL_QUERY = """
+    UPDATE channels 
+    SET members_count = members_count + 1,
+        has_ai_member = has_ai_member OR EXISTS (SELECT 1 FROM users WHERE id = %s AND username = %s)
+    WHERE id = %s
+"""
+
+
+def post_message_params(channel_id: str, sender_id: str, content: str, file_id: str = None) -> tuple:
+    return (
+        str(uuid.uuid4()),
+        datetime.utcnow(),
+        content,
+        content,
+        channel_id,
+        sender_id,
+        '{}',
+        False,
+        False,
+        None,
+        None,
+        file_id
+    )
+
+
+def posted_message_from_row(row: dict) -> PostedMessage:
+    return PostedMessage(
+        message=message_from_row(row),
+        channel_type=row['channel_type'],
+        channel_has_ai_member=row['has_ai_member']
+    )
+
+
+def insert_message_params(message: Message) -> tuple:
+    thread_id = message.thread_id if message.has_thread else None
+    return (
+        message.id,
+        message.sent,
+        message.text,
+        message.content,
+        message.channel_id,
+        message.sender.id,
+        json.dumps(message.reactions),
+        message.has_thread,
+        message.has_image,
+        thread_id,
+        message.image,
+        message.file_id
+    )
+
+
+# Files are streamed in pieces of this many bytes, which bounds per-download memory
+FILE_CHUNK_SIZE = int(os.getenv("FILE_CHUNK_SIZE", str(256 * 1024)))
+
+# Largest file accepted by an upload
+MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE", str(50 * 1024 * 1024)))
+
+
+class FileTooLargeError(ValueError):
+    pass
+
+
+class UnknownUserError(LookupError):
+    pass
+
+
+# Take a reference to an existing blob; returns no row if there isn't one
+ACQUIRE_BLOB_QUERY = """
+    UPDATE file_blobs
+    SET ref_count = ref_count + 1
+    WHERE sha256 = %s
+    RETURNING sha256
+"""
+
+INSERT_BLOB_QUERY = """
+    INSERT INTO file_blobs (sha256, size, ref_count, data)
+    VALUES (%s, %s, 1, %s)
+    ON CONFLICT (sha256) DO UPDATE SET ref_count = file_blobs.ref_count + 1
+"""
+
+# A new blob's data is streamed in as a hex bytea literal in COPY's text format
+COPY_BLOB_QUERY = """
+    COPY file_blobs (sha256, size, ref_count, data)
+    FROM STDIN
+"""
+
+
+def copy_blob_head(sha256: str, size: int) -> str:
+    """The fields of a new blob's COPY row up to the start of its data."""
+    return f"{sha256}\t{size}\t1\t\\\\x"
+
+
+INSERT_FILE_QUERY = """
+    INSERT INTO files (id, created_at, filename, content_type, size, sha256, associated_channel)
+    VALUES (%s, %s, %s, %s, %s, %s, %s)
+"""
+
+
+def insert_file_params(file_id: str, filename: str, content_type: str, size: int, sha256: str, associated_channel: str) -> tuple:
+    return (file_id, datetime.now(), filename, content_type, size, sha256, associated_channel)
+
+
+DELETE_FILE_QUERY = "DELETE FROM files WHERE id = %s RETURNING sha256, associated_channel"
+
+RELEASE_BLOB_QUERY = """
+    UPDATE file_blobs
+    SET ref_count = ref_count - 1
+    WHERE sha256 = %s
+    RETURNING ref_count
+"""
+
+DELETE_BLOB_QUERY = "DELETE FROM file_blobs WHERE sha256 = %s AND ref_count <= 0"
+
+FILE_QUERY = """
+    SELECT f.id, f.filename, f.content_type, b.data, f.size
+    FROM files f
+    JOIN file_blobs b ON b.sha256 = f.sha256
+    WHERE f.id = %s
+"""
+
+
+# File listings only ever read metadata, never the blob
+ASSOCIATED_FILES_QUERY = """
+    SELECT id, created_at, filename, content_type, size, associated_channel
+    FROM files
+    WHERE associated_channel = %s
+    ORDER BY created_at, id
+"""
+
+FILE_HANDLE_QUERY = """
+    SELECT f.id, f.created_at, f.filename, f.content_type, b.size, f.sha256, f.associated_channel
+    FROM files f
+    JOIN file_blobs b ON b.sha256 = f.sha256
+    WHERE f.id = %s
+"""
+
+FILE_DATA_QUERY = """
+    SELECT b.data
+    FROM files f
+    JOIN file_blobs b ON b.sha256 = f.sha256
+    WHERE f.id = %s
+"""
+
+
+class FileHandle:
+    """
+    A stored file's metadata. Its bytes stay in the database until read() or
+    iter_bytes() is called, which go through the data layer that opened the
+    handle (and so return awaitables when that layer is an AsyncDataLayer).
+    """
+
+    def __init__(self, layer, row: dict):
+        self.layer = layer
+        self.id = row['id']
+        self.created_at = row['created_at']
+        self.filename = row['filename']
+        self.content_type = row['content_type']
+        self.size = row['size']
+        self.sha256 = row['sha256']
+        self.associated_channel = row['associated_channel']
+
+    def read(self):
+        """The whole file."""
+        return self.layer.read_file(self.id)
+
+    def iter_bytes(self, start: int = 0, end: int = None):
+        """Bytes start..end (inclusive), FILE_CHUNK_SIZE at a time."""
+        return self.layer.iter_file(self.id, start, self.size - 1 if end is None else end)
+
+# substring() offsets are 1-based; with EXTERNAL storage only the TOAST
+# chunks covering the range are fetched
+FILE_CHUNK_QUERY = """
+    SELECT substring(b.data FROM %s FOR %s) AS data
+    FROM files f
+    JOIN file_blobs b ON b.sha256 = f.sha256
+    WHERE f.id = %s
+"""
+
+
+def file_chunk_params(file_id: str, start: int, length: int) -> tuple:
+    return (start + 1, length, file_id)
+
+
+# Give a file the chunks of an identical file that was already ingested, so
+# its content isn't embedded again; inserts nothing if there is none
+REUSE_CHUNKS_QUERY = """
+    INSERT INTO chunks (embedding, file_id, file_chunk, text, channel_id)
+    SELECT c.embedding, f.id, c.file_chunk, c.text, %(channel_id)s
+    FROM files f
+    CROSS JOIN LATERAL (
+        SELECT other.id
+        FROM files other
+        WHERE other.sha256 = f.sha256
+          AND other.id <> f.id
+          AND EXISTS (SELECT 1 FROM chunks WHERE file_id = other.id)
+        LIMIT 1
+    ) source
+    JOIN chunks c ON c.file_id = source.id
+    WHERE f.id = %(file_id)s
+    ON CONFLICT (file_id, file_chunk) DO NOTHING
+"""
+
+
+# Reactions are recorded once per (message, user, emoji) and the count in
+# messages.reactions changes in the same statement, under the row lock,
+# so concurrent reactions never overwrite each other
+ADD_REACTION_QUERY = """
+    WITH added AS (
+        INSERT INTO message_reactions (message_id, user_id, emoji)
+        VALUES (%s, %s, %s)
+        ON CONFLICT DO NOTHING
+        RETURNING message_id, emoji
+    )
+    UPDATE messages m
+    SET reactions = jsonb_set(COALESCE(m.reactions, '{}'::jsonb), ARRAY[added.emoji],
+        to_jsonb(COALESCE((m.reactions ->> added.emoji)::int, 0) + 1))
+    FROM added
+    WHERE m.id = added.message_id
+    RETURNING m.id, m.channel_id
 """
 
+REMOVE_REACTION_QUERY = """
+    WITH removed AS (
+        DELETE FROM message_reactions
+        WHERE message_id = %s AND user_id = %s AND emoji = %s
+        RETURNING message_id, emoji
+    )
+    UPDATE messages m
+    SET reactions = CASE
+        WHEN COALESCE((m.reactions ->> removed.emoji)::int, 0) > 1
+            THEN jsonb_set(m.reactions, ARRAY[removed.emoji], to_jsonb((m.reactions ->> removed.emoji)::int - 1))
+        ELSE COALESCE(m.reactions, '{}'::jsonb) - removed.emoji
+    END
+    FROM removed
+    WHERE m.id = removed.message_id
+    RETURNING m.id, m.channel_id
+"""
+
+
+# Violated by a reaction from a user that doesn't exist, rather than on a missing message
+REACTION_USER_CONSTRAINT = "message_reactions_user_id_fkey"
+
+RECORD_REACTION_QUERY = """
+    INSERT INTO message_reactions (message_id, user_id, emoji)
+    VALUES (%s, %s, %s)
+    ON CONFLICT DO NOTHING
+    RETURNING message_id, (SELECT channel_id FROM messages WHERE id = message_id) AS channel_id
+"""
+
+DELETE_REACTION_QUERY = """
+    DELETE FROM message_reactions
+    WHERE message_id = %s AND user_id = %s AND emoji = %s
+    RETURNING message_id, (SELECT channel_id FROM messages WHERE id = message_id) AS channel_id
+"""
+
+# Recount the given (message, emoji) pairs from message_reactions into
+# messages.reactions, one UPDATE for a whole batch; other emojis are kept
+# as they are and counts of zero are dropped
+RECOUNT_REACTIONS_QUERY = """
+    UPDATE messages m
+    SET reactions = (
+        SELECT COALESCE(jsonb_object_agg(emoji, total), '{}'::jsonb)
+        FROM (
+            SELECT key AS emoji, value::int AS total
+            FROM jsonb_each_text(COALESCE(m.reactions, '{}'::jsonb))
+            WHERE key <> ALL(touched.emojis)
+            UNION ALL
+            SELECT r.emoji, COUNT(*)
+            FROM message_reactions r
+            WHERE r.message_id = m.id AND r.emoji = ANY(touched.emojis)
+            GROUP BY r.emoji
+        ) counts
+    )
+    FROM (
+        SELECT d.message_id, array_agg(d.emoji) AS emojis
+        FROM unnest(%(message_ids)s::text[], %(emojis)s::text[]) AS d(message_id, emoji)
+        GROUP BY d.message_id
+    ) touched
+    WHERE m.id = touched.message_id
+"""
+
+
+CHANNELS_FOR_USER_QUERY = """
+    SELECT DISTINCT
+        c.*
+    FROM channels c
+    INNER JOIN channel_memberships cm ON c.id = cm.channel_id
+    WHERE cm.user_id = %s
+"""
+
+
+def channels_for_user_query(user_id: str, channel_type: ChannelType) -> tuple[str, tuple]:
+    if channel_type == ChannelType.ALL:
+        return CHANNELS_FOR_USER_QUERY + " ORDER BY c.created_at DESC", (user_id,)
+    return (
+        CHANNELS_FOR_USER_QUERY + " AND c.channel_type = %s ORDER BY c.created_at DESC",
+        (user_id, channel_type.value)
+    )
+
+
+USERS_IN_CHANNEL_QUERY = """
+    SELECT 
+        u.id,
+        u.created_at,
+        u.username,
+        u.password,
+        u.token,
+        u.status,
+        u.profile_picture
+    FROM users u
+    JOIN channel_memberships cm ON u.id = cm.user_id
+    WHERE cm.channel_id = %s
+"""
+
+INSERT_USER_QUERY = "INSERT INTO users (id, created_at, username, password, token, status, profile_picture) VALUES (%s, %s, %s, %s, %s, %s, %s)"
+
+INSERT_CHANNEL_QUERY = "INSERT INTO channels (id, created_at, name, channel_type, description, members_count, creator_id) VALUES (%s, %s, %s, %s, %s, %s, %s)"
+
+
+def insert_channel_params(channel: Channel) -> tuple:
+    return (channel.id, channel.created_at, channel.name, channel.channel_type, channel.description, channel.members_count, channel.creator_id)
+
+
+def new_channel(name: str, channel_type: str, creator_id: str, description: str, channel_id: str = None) -> Channel:
+    return Channel(
+        id=channel_id if channel_id else str(uuid.uuid4()),
+        created_at=datetime.now().isoformat(),
+        name=name,
+        channel_type=channel_type,
+        creator_id=creator_id,
+        description=description,
+        members_count=0,
+    )
+
+
+INSERT_CHUNK_QUERY = """
+    INSERT INTO chunks 
+    (embedding, file_id, file_chunk, text, channel_id)
+    VALUES (%b, %s, %s, %s, %s)
+    ON CONFLICT (file_id, file_chunk) DO NOTHING
+"""
+
+
+def chunk_params(chunk: Chunk) -> tuple:
+    return (
+        as_vector(chunk.embedding),
+        chunk.file_id,
+        chunk.file_chunk,
+        chunk.text,
+        chunk.channel_id
+    )
+
+
+# NOTIFY channel of the cross-process event bus (EventBus.py)
+EVENTS_CHANNEL = "events"
+
+# Postgres rejects NOTIFY payloads of 8000 bytes or more
+MAX_EVENT_PAYLOAD = 7900
+
+# One statement per batch of a process's status changes, as parallel arrays
+SAVE_PRESENCE_QUERY = """
+    INSERT INTO presence (user_id, worker_id, status, last_seen)
+    SELECT user_id, %s, status, to_timestamp(last_seen)
+    FROM unnest(%s::text[], %s::smallint[], %s::float8[]) AS changes (user_id, status, last_seen)
+    ON CONFLICT (user_id, worker_id) DO UPDATE SET
+        status = EXCLUDED.status,
+        last_seen = EXCLUDED.last_seen
+"""
+
+# Several payloads in one statement, queued in array order
+NOTIFY_MANY_QUERY = "SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) WITH ORDINALITY AS p (payload, n) ORDER BY n"
+
+TOUCH_PRESENCE_WORKER_QUERY = """
+    INSERT INTO presence_workers (worker_id) VALUES (%s)
+    ON CONFLICT (worker_id) DO UPDATE SET seen_at = now()
+"""
+
+# Forget processes that haven't checked in for the given number of seconds
+EXPIRE_PRESENCE_WORKERS_QUERY = """
+    DELETE FROM presence_workers
+    WHERE seen_at < now() - make_interval(secs => %s)
+    RETURNING worker_id
+"""
+
+DELETE_WORKER_PRESENCE_QUERY = "DELETE FROM presence WHERE worker_id = ANY(%s)"
+
+# The users other live processes have connected, as of now
+PRESENCE_SNAPSHOT_QUERY = """
+    SELECT p.user_id, p.worker_id, p.status
+    FROM presence p
+    JOIN presence_workers w ON w.worker_id = p.worker_id
+    WHERE p.worker_id <> %s AND p.status <> 0
+"""
+
+
+def presence_notifications(worker_id: str, changes: dict, max_payload: int = 7000) -> List[str]:
+    """'presence' event payloads announcing {user_id: status code} changes, split to stay under MAX_EVENT_PAYLOAD."""
+    payloads, batch, size = [], {}, 0
+    for user_id, status in changes.items():
+        entry_size = len(json.dumps({user_id: status}).encode())  # As escaped in the payload
+        if entry_size > max_payload:
+            print(f"Not announcing presence of a {len(user_id)}-character user id: too large for NOTIFY")
+            continue
+        if batch and size + entry_size > max_payload:
+            payloads.append(json.dumps({"type": "presence", "origin": worker_id, "statuses": batch}))
+            batch, size = {}, 0
+        batch[user_id] = status
+        size += entry_size
+    if batch:
+        payloads.append(json.dumps({"type": "presence", "origin": worker_id, "statuses": batch}))
+    return payloads
+
+
+# Bulk loading: chunks are streamed with binary COPY into a staging table,
+# then moved into chunks in one statement so conflicts can be skipped or updated
+CREATE_CHUNK_STAGING_QUERY = """
+    CREATE TEMP TABLE chunk_staging (
+        embedding vector,
+        file_id VARCHAR(36),
+        file_chunk INTEGER,
+        text TEXT,
+        channel_id VARCHAR(36)
+    ) ON COMMIT DROP
+"""
+
+COPY_CHUNKS_QUERY = "COPY chunk_staging (embedding, file_id, file_chunk, text, channel_id) FROM STDIN (FORMAT BINARY)"
+
+COPY_CHUNK_TYPES = ['vector', 'varchar', 'int4', 'text', 'varchar']
+
+
+def merge_chunks_query(upsert: bool = False) -> str:
+    """Move staged chunks into chunks; with upsert, re-ingested chunks replace the stored ones."""
+    conflict = """DO UPDATE SET
+        embedding = EXCLUDED.embedding,
+        text = EXCLUDED.text,
+        channel_id = EXCLUDED.channel_id""" if upsert else "DO NOTHING"
+    return f"""
+    INSERT INTO chunks (embedding, file_id, file_chunk, text, channel_id)
+    SELECT embedding, file_id, file_chunk, text, channel_id
+    FROM chunk_staging
+    ON CONFLICT (file_id, file_chunk) {conflict}
+"""
+
+
+CACHED_EMBEDDINGS_QUERY = """
+    SELECT text_sha256, embedding
+    FROM embedding_cache
+    WHERE model = %s AND text_sha256 = ANY(%s)
+"""
+
+INSERT_CACHED_EMBEDDING_QUERY = """
+    INSERT INTO embedding_cache (model, text_sha256, embedding)
+    VALUES (%s, %s, %b)
+    ON CONFLICT DO NOTHING
+"""
+
+
+# A channel's chunks in id order, for the in-process index (ChannelIndex.py)
+CHANNEL_CHUNKS_QUERY = """
+    SELECT id, embedding, file_id, file_chunk, text
+    FROM chunks
+    WHERE channel_id = %s AND id > %s
+    ORDER BY id
+"""
+
+CHANNEL_CHUNK_COUNT_QUERY = "SELECT count(*) AS count FROM chunks WHERE channel_id = %s"
+
+FILE_CHUNK_NUMBERS_QUERY = "SELECT file_chunk FROM chunks WHERE file_id = %s"
+
+
+# The nearest chunks are found on chunks alone, so the ANN index can serve
+# the ORDER BY ... LIMIT, and only then joined to their files. Embeddings are
+# left out of the results unless asked for: callers rarely need them back
+def similarity_search_query(in_channel: bool = False, include_embeddings: bool = False) -> str:
+    embedding_column = "\n        c.embedding," if include_embeddings else ""
+    channel_filter = "\n        WHERE channel_id = %s" if in_channel else ""
+    return f"""
+    SELECT 
+        c.id,{embedding_column}
+        c.file_id,
+        c.file_chunk,
+        c.text,
+        c.channel_id,
+        f.filename,
+        f.content_type
+    FROM (
+        SELECT *, embedding <=> %b AS distance
+        FROM chunks{channel_filter}
+        ORDER BY distance
+        LIMIT %s
+    ) c
+    JOIN files f ON c.file_id = f.id
+    ORDER BY c.distance
+"""
+
+
+# Search-time accuracy knobs for the ANN index on chunks.embedding; higher
+# is better recall and slower. Unset leaves pgvector's defaults (40 and 1)
+HNSW_EF_SEARCH = os.getenv("HNSW_EF_SEARCH")
+IVFFLAT_PROBES = os.getenv("IVFFLAT_PROBES")
+
+# The ANN index ignores the channel filter, so a channel-scoped search can come
+# back short when the channel is a small part of the table. Channels with at
+# most this many chunks are searched exactly instead; larger ones can set
+# HNSW_ITERATIVE_SCAN (strict_order or relaxed_order, pgvector 0.8+) so the
+# index scan keeps going until the filter is satisfied
+EXACT_CHANNEL_SEARCH_ROWS = int(os.getenv("EXACT_CHANNEL_SEARCH_ROWS", "20000"))
+HNSW_ITERATIVE_SCAN = os.getenv("HNSW_ITERATIVE_SCAN")
+
+# Applies a setting to the current transaction only
+SET_LOCAL_QUERY = "SELECT set_config(%s, %s, true)"
+
+
+def vector_search_settings(ef_search: int = None, probes: int = None, exact: bool = None,
+                           filtered: bool = False) -> list[tuple[str, str]]:
+    """
+    The SET_LOCAL_QUERY params for a similarity search. exact=True bypasses the
+    ANN index and exact=False forces it; by default the planner chooses.
+    filtered searches also get HNSW_ITERATIVE_SCAN when it is set.
+    """
+    settings = []
+    ef_search = ef_search or HNSW_EF_SEARCH
+    probes = probes or IVFFLAT_PROBES
+    if ef_search:
+        settings.append(('hnsw.ef_search', str(int(ef_search))))
+    if probes:
+        settings.append(('ivfflat.probes', str(int(probes))))
+    if exact:
+        settings.append(('enable_indexscan', 'off'))
+    elif exact is False:
+        settings.append(('enable_seqscan', 'off'))
+    if filtered and HNSW_ITERATIVE_SCAN:
+        settings.append(('hnsw.iterative_scan', HNSW_ITERATIVE_SCAN))
+    return settings
+
+
+VECTOR_INDEX_NAME = "chunks_embedding_idx"
+
+VECTOR_INDEX_QUERY = """
+    SELECT indexname, indexdef
+    FROM pg_indexes
+    WHERE tablename = 'chunks' AND indexname = %s
+"""
+
+
+def create_vector_index_query(name: str, method: str, m: int = 16, ef_construction: int = 64, lists: int = 100) -> str:
+    """CREATE INDEX CONCURRENTLY for an HNSW or IVFFlat index on chunks.embedding, using cosine distance like the searches."""
+    if method == "hnsw":
+        options = f"m = {int(m)}, ef_construction = {int(ef_construction)}"
+    elif method == "ivfflat":
+        options = f"lists = {int(lists)}"
+    else:
+        raise ValueError(f"Unknown vector index method: {method}")
+    return f"CREATE INDEX CONCURRENTLY {name} ON chunks USING {method} (embedding vector_cosine_ops) WITH ({options})"
+
+
+RECENT_MESSAGES_QUERY = f"""
+    {MESSAGE_SELECT}
+    WHERE m.sent > NOW() - make_interval(hours => %s)
+    ORDER BY m.sent ASC
+"""
+
+
 class DataLayer:
     def __init__(self):
         """Establish a connection to the database and print a message"""
         self.conn_string = f"host={DB_HOST} dbname={DB_NAME} user={DB_USER} password={DB_PASSWORD}"
+        # Users, channels and memberships are read far more often than written
+        self.cache = MetadataCache()
 
         try:
             self.pool = ConnectionPool(
@@ -80,11 +1058,11 @@ class DataLayer:
                 min_size=1, 
                 max_size=10,
                 timeout=30,
-                kwargs={'row_factory': dict_row}
+                kwargs={'row_factory': dict_row},
+                configure=register_vector  # Register vector type for every pooled connection
             )
             
             with self.pool.connection() as conn:
-                register_vector(conn)  # Register vector type for this connection
                 cursor = conn.cursor()
                 cursor.execute("SELECT count(*) FROM users")
                 count = cursor.fetchone()['count']
@@ -104,10 +1082,11 @@ class DataLayer:
             with self.pool.connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute(
-                    "INSERT INTO users (id, created_at, username, password, token, status, profile_picture) VALUES (%s, %s, %s, %s, %s, %s, %s)",
+                    INSERT_USER_QUERY,
                     (user.id, user.created_at, user.username, user.password, user.token, user.status, user.profile_picture)
                 )
                 conn.commit()
+                self.cache.invalidate_user(user.id, user.username)
                 return True  # Indicate success
         except Exception as e:
             print(f"Error adding user: {e}")
@@ -116,6 +1095,9 @@ class DataLayer:
 
     def get_user(self, user_id: str) -> User | None:
         """Get a user by their ID."""
+        user = self.cache.get_user(user_id)
+        if user:
+            return user
         try:
             with self.pool.connection() as conn:
                 cursor = conn.cursor()
@@ -123,8 +1105,9 @@ class DataLayer:
                 cursor.execute("SELECT * FROM users WHERE id = %s", (user_id,))
                 user_data = cursor.fetchone()
                 if user_data:
-                    user_data['created_at'] = user_data['created_at'].isoformat()
-                    return User(**user_data)
+                    user = user_from_row(user_data)
+                    self.cache.put_user(user)
+                    return user
                 return None
         except Exception as e:
             print(f"Error getting user: {e}")
@@ -133,33 +1116,27 @@ class DataLayer:
 
     def get_user_by_username(self, username: str) -> User | None:
         """Get a user by their username."""
+        user = self.cache.get_user_by_username(username)
+        if user:
+            return user
         with self.pool.connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM users WHERE username = %s", (username,))
             user_data = cursor.fetchone()
-            print(f"User data: {user_data}")
             if not user_data:
                 return None
-
-            return User(id=user_data['id'], 
-                created_at=str(user_data['created_at']), 
-                username=user_data['username'], 
-                password=user_data['password'], 
-                token=user_data['token'], 
-                status=user_data['status'], 
-                profile_picture=user_data['profile_picture']
-            )
+            user = user_from_row(user_data)
+            self.cache.put_user(user)
+            return user
 
 
     def add_channel(self, channel: Channel):
         try:
             with self.pool.connection() as conn:
                 cursor = conn.cursor()
-            cursor.execute(
-                "INSERT INTO channels (id, created_at, name, channel_type, description, members_count, creator_id) VALUES (%s, %s, %s, %s, %s, %s, %s)",
-                (channel.id, channel.created_at, channel.name, channel.channel_type, channel.description, channel.members_count, channel.creator_id)
-            )
-            conn.commit()
+                cursor.execute(INSERT_CHANNEL_QUERY, insert_channel_params(channel))
+                conn.commit()
+            self.cache.invalidate_channel(channel.id)
             return True  # Indicate success
         except Exception as e:
             print(f"Error adding channel: {e}")
@@ -168,14 +1145,18 @@ class DataLayer:
 
     def get_channel(self, channel_id: str) -> Channel | None:
         """Get a channel by its ID."""
+        channel = self.cache.get_channel(channel_id)
+        if channel:
+            return channel
         try:
             with self.pool.connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute("SELECT * FROM channels WHERE id = %s", (channel_id,))
                 channel_data = cursor.fetchone()
                 if channel_data:
-                    channel_data['created_at'] = channel_data['created_at'].isoformat()
-                    return Channel(**channel_data)
+                    channel = channel_from_row(channel_data)
+                    self.cache.put_channel(channel)
+                    return channel
                 return None
         except Exception as e:
             print(f"Error getting channel: {e}")
@@ -184,26 +1165,33 @@ class DataLayer:
     
     def get_channel_by_name(self, channel_name: str) -> Channel | None:
         """Get a channel by its name."""
+        channel = self.cache.get_channel_by_name(channel_name)
+        if channel:
+            return channel
         with self.pool.connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM channels WHERE name = %s", (channel_name,))
             channel_data = cursor.fetchone()
             if channel_data:
-                # Convert datetime to ISO format string
-                channel_data['created_at'] = channel_data['created_at'].isoformat()
-                return Channel(**channel_data)
+                channel = channel_from_row(channel_data)
+                self.cache.put_channel(channel, by_name=True)
+                return channel
             return None
 
 
     def get_channel_by_id(self, channel_id: str) -> Channel | None:
         """Get a channel by its ID."""
+        channel = self.cache.get_channel(channel_id)
+        if channel:
+            return channel
         with self.pool.connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM channels WHERE id = %s", (channel_id,))
             channel_data = cursor.fetchone()
             if channel_data:
-                channel_data['created_at'] = channel_data['created_at'].isoformat()
-                return Channel(**channel_data)
+                channel = channel_from_row(channel_data)
+                self.cache.put_channel(channel)
+                return channel
             return None
 
 
@@ -236,57 +1224,17 @@ class DataLayer:
             return False
 
 
-    def get_messages_in_channel(self, channel_id: str) -> list[Message]:
-        """Get all messages for a specific channel."""
+    def get_messages_in_channel(self, channel_id: str, before: str = None, after: str = None, limit: int = None) -> list[Message]:
+        """Get messages for a specific channel, oldest first. See channel_messages_query for paging."""
+        query, params, descending = channel_messages_query(channel_id, before, after, limit)
         try:
             with self.pool.connection() as conn:
                 cursor = conn.cursor()
-                cursor.execute("""
-                    SELECT 
-                        m.id as message_id,
-                        m.sent,
-                        m.text,
-                        m.content,
-                    m.channel_id,
-                    m.sender_id,
-                    m.reactions,
-                    m.has_thread,
-                    m.has_image,
-                    m.thread_id,
-                    m.image,
-                    m.file_id,
-                    f.filename as file_name,
-                    f.content_type as file_content_type,
-                    u.id as user_id,
-                    u.created_at,
-                    u.username,
-                    u.password,
-                    u.token,
-                    u.status,
-                    u.profile_picture
-                FROM messages m
-                JOIN users u ON m.sender_id = u.id
-                LEFT JOIN files f ON m.file_id = f.id
-                WHERE m.channel_id = %s
-                ORDER BY m.sent ASC
-            """, (channel_id,))
-            message_data = cursor.fetchall()
-            return [Message(
-                **{
-                    **msg,
-                    'id': msg['message_id'],
-                    'sent': msg['sent'].isoformat(),
-                    'sender': User(
-                        id=msg['user_id'],
-                        created_at=msg['created_at'].isoformat(),
-                        username=msg['username'],
-                        password=msg['password'],
-                        token=msg['token'],
-                        status=msg['status'],
-                        profile_picture=msg['profile_picture']
-                    )
-                }
-            ) for msg in message_data]
+                cursor.execute(query, params)
+                message_data = cursor.fetchall()
+                if descending:
+                    message_data.reverse()
+                return [message_from_row(msg) for msg in message_data]
         except Exception as e:
             print(f"Error getting messages in channel: {e}")
             return []
@@ -296,47 +1244,9 @@ class DataLayer:
         """Get all messages sent by a specific user."""
         with self.pool.connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("""
-                SELECT 
-                    m.id as message_id,
-                    m.sent,
-                    m.text,
-                    m.content,
-                    m.channel_id,
-                    m.reactions,
-                    m.has_thread,
-                    m.has_image,
-                    m.thread_id,
-                    m.image,
-                    m.file_id,
-                    u.id as user_id,
-                    u.created_at,
-                    u.username,
-                    u.password,
-                    u.token,
-                    u.status,
-                    u.profile_picture
-                FROM messages m
-                JOIN users u ON m.sender_id = u.id
-                WHERE m.sender_id = %s
-            """, (user_id,))
+            cursor.execute(f"{MESSAGE_SELECT} WHERE m.sender_id = %s", (user_id,))
             message_data = cursor.fetchall()
-            return [Message(
-                **{
-                    **msg,
-                    'id': msg['message_id'],
-                    'sent': msg['sent'].isoformat(),
-                    'sender': User(
-                        id=msg['user_id'],
-                        created_at=msg['created_at'].isoformat(),
-                        username=msg['username'],
-                        password=msg['password'],
-                        token=msg['token'],
-                        status=msg['status'],
-                        profile_picture=msg['profile_picture']
-                    )
-                }
-            ) for msg in message_data]
+            return [message_from_row(msg) for msg in message_data]
 
     def add_channel_membership(self, membership: ChannelMembership):
         try:
@@ -346,14 +1256,11 @@ class DataLayer:
                     cur.execute("INSERT INTO channel_memberships (user_id, channel_id) VALUES (%s, %s)", 
                               (membership.user_id, membership.channel_id))
                     
-                    # Update the channel's member count
-                    cur.execute("""
-                        UPDATE channels 
-                        SET members_count = members_count + 1 
-                        WHERE id = %s
-                    """, (membership.channel_id,))
+                    # Update the channel's member count and flags
+                    cur.execute(ADD_MEMBER_TO_CHANNEL_QUERY, (membership.user_id, AI_USERNAME, membership.channel_id))
                     
                     conn.commit()
+            self.cache.invalidate_membership(membership.user_id, membership.channel_id)
             return True
         except Exception as e:
             print(f"Error adding channel membership: {e}")
@@ -361,122 +1268,33 @@ class DataLayer:
 
     def get_users_in_channel(self, channel_id: str) -> list[User]:
         """Get all users in a specific channel."""
+        users = self.cache.get_channel_users(channel_id)
+        if users is not None:
+            return users
         with self.pool.connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("""
-                SELECT 
-                    u.id,
-                    u.created_at,
-                    u.username,
-                    u.password,
-                    u.token,
-                    u.status,
-                    u.profile_picture
-                FROM users u
-                JOIN channel_memberships cm ON u.id = cm.user_id
-                WHERE cm.channel_id = %s
-            """, (channel_id,))
-            user_data = cursor.fetchall()
-            return [User(**{**user, 'created_at': user['created_at'].isoformat()}) 
-                    for user in user_data]
-
+            cursor.execute(USERS_IN_CHANNEL_QUERY, (channel_id,))
+            users = [user_from_row(user) for user in cursor.fetchall()]
+            self.cache.put_channel_users(channel_id, users)
+            return users
 
     def get_channels_for_user(self, user_id: str, channel_type: ChannelType) -> list[Channel]:
         """Get all channels a specific user is part of."""
         with self.pool.connection() as conn:
             cursor = conn.cursor()
-            if channel_type == ChannelType.ALL:
-                query = """
-                    SELECT DISTINCT
-                    c.*
-                FROM channels c
-                INNER JOIN channel_memberships cm ON c.id = cm.channel_id
-                WHERE cm.user_id = %s
-                ORDER BY c.created_at DESC
-                """
-                params = (user_id,)
-            else:
-                query = """
-                    SELECT DISTINCT
-                        c.*
-                    FROM channels c
-                    INNER JOIN channel_memberships cm ON c.id = cm.channel_id
-                    WHERE cm.user_id = %s 
-                    AND c.channel_type = %s
-                    ORDER BY c.created_at DESC
-                """
-                params = (user_id, channel_type.value)
-
-            cursor.execute(query, params)
+            cursor.execute(*channels_for_user_query(user_id, channel_type))
             channel_data = cursor.fetchall()
-            return [Channel(**{**channel, 'created_at': channel['created_at'].isoformat()}) 
-                    for channel in channel_data]
+            return [channel_from_row(channel) for channel in channel_data]
 
 
     def get_message(self, message_id: str) -> Message | None:
         """Get a message by its ID."""
         with self.pool.connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("""
-                SELECT 
-                    m.id as message_id,
-                    m.sent,
-                    m.text,
-                    m.content,
-                    m.channel_id,
-                    COALESCE(m.reactions::text, '{}') as reactions,
-                    m.has_thread,
-                    m.has_image,
-                    m.thread_id,
-                    m.image,
-                    m.file_id,
-                    f.filename as file_name,
-                    f.content_type as file_content_type,
-                    u.id as user_id,
-                    u.created_at,
-                    u.username,
-                    u.password,
-                    u.token,
-                    u.status,
-                    u.profile_picture
-                FROM messages m
-                JOIN users u ON m.sender_id = u.id
-                LEFT JOIN files f ON m.file_id = f.id
-                WHERE m.id = %s
-            """, (message_id,))
-            
+            cursor.execute(f"{MESSAGE_SELECT} WHERE m.id = %s", (message_id,))
             msg = cursor.fetchone()
-            print(f"Query result: {msg}")
-            
             if msg:
-                # Parse the reactions JSON string
-                reactions = json.loads(msg['reactions']) if msg['reactions'] else {}
-                print(f"Parsed reactions: {reactions}")
-                
-                return Message(
-                    id=msg['message_id'],
-                    sent=msg['sent'].isoformat(),
-                    text=msg['text'],
-                    content=msg['content'],
-                    channel_id=msg['channel_id'],
-                    reactions=reactions,
-                    has_thread=msg['has_thread'],
-                    has_image=msg['has_image'],
-                    thread_id=msg['thread_id'],
-                    image=msg['image'],
-                    file_id=msg['file_id'],
-                    file_name=msg['file_name'],
-                    file_content_type=msg['file_content_type'],
-                    sender=User(
-                        id=msg['user_id'],
-                        created_at=msg['created_at'].isoformat(),
-                        username=msg['username'],
-                        password=msg['password'],
-                        token=msg['token'],
-                        status=msg['status'],
-                        profile_picture=msg['profile_picture']
-                    )
-                )
+                return message_from_row(msg)
             print(f"No message found with ID: {message_id}")
             return None
         
@@ -495,23 +1313,13 @@ class DataLayer:
         try:
             with self.pool.connection() as conn:
                 with conn.cursor() as cur:
-                    channel = Channel(
-                        id=channel_id if channel_id else str(uuid.uuid4()),
-                        created_at=datetime.now().isoformat(),
-                        name=name,
-                        channel_type=channel_type,
-                        creator_id=creator_id,
-                        description=description,
-                        members_count=0,
-                    )
+                    channel = new_channel(name, channel_type, creator_id, description, channel_id)
                     
                     # Create channel only
-                    cur.execute(
-                        "INSERT INTO channels (id, created_at, name, channel_type, description, members_count, creator_id) VALUES (%s, %s, %s, %s, %s, %s, %s)",
-                        (channel.id, channel.created_at, channel.name, channel.channel_type, channel.description, channel.members_count, channel.creator_id)
-                    )
+                    cur.execute(INSERT_CHANNEL_QUERY, insert_channel_params(channel))
                     
                     conn.commit()
+                    self.cache.invalidate_channel(channel.id)
                     return channel
         except Exception as e:
             print(f"Error creating channel: {e}")
@@ -527,34 +1335,14 @@ class DataLayer:
         """Send a message to a channel."""
         with self.pool.connection() as conn:
             cursor = conn.cursor()
-            thread_id = message.thread_id if message.has_thread else None
-            cursor.execute(
-                """INSERT INTO messages 
-                    (id, sent, text, content, channel_id, sender_id, reactions, 
-                     has_thread, has_image, thread_id, image, file_id)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)""",
-                (
-                    message.id,
-                    message.sent,
-                    message.text,
-                    message.content,
-                    message.channel_id,
-                    message.sender.id,
-                    json.dumps(message.reactions),
-                    message.has_thread,
-                    message.has_image,
-                    thread_id,
-                    message.image,
-                    message.file_id
-                )
-            )
+            cursor.execute(POST_MESSAGE_QUERY, insert_message_params(message))
+            row = cursor.fetchone()
             conn.commit()
-            return self.get_message(message.id)  # Return the full message with sender info
-        
+            return message_from_row(row)  # Return the full message with sender info
 
-    def get_channel_messages(self, channel_id: str) -> list[Message]:
-        """Get all messages for a specific channel."""
-        return self.get_messages_in_channel(channel_id)
+    def get_channel_messages(self, channel_id: str, before: str = None, after: str = None, limit: int = None) -> list[Message]:
+        """Get messages for a specific channel, optionally one page at a time."""
+        return self.get_messages_in_channel(channel_id, before=before, after=after, limit=limit)
 
     def search_channels(self, prefix: str) -> list[Channel]:
         """Search for channels by name prefix."""
@@ -562,180 +1350,62 @@ class DataLayer:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM channels WHERE LOWER(name) LIKE %s", (prefix.lower() + "%",))
             channel_data = cursor.fetchall()
-            return [Channel(
-                id=channel['id'],
-                created_at=channel['created_at'].isoformat(),
-                name=channel['name'],
-                channel_type=channel['channel_type'],
-                description=channel['description'],
-                members_count=channel['members_count'],
-                creator_id=channel['creator_id']
-            ) for channel in channel_data]
+            return [channel_from_row(channel) for channel in channel_data]
 
 
     def save_file(self, file_id: str, filename: str, content_type: str, data: bytes, associated_channel: str) -> bool:
+        sha256 = hashlib.sha256(data).hexdigest()
         with self.pool.connection() as conn:
             cursor = conn.cursor()
-            cursor.execute(
-                "INSERT INTO files (id, created_at, filename, content_type, data, size, associated_channel) VALUES (%s, %s, %s, %s, %s, %s, %s)",
-                (file_id, datetime.now(), filename, content_type, data, len(data), associated_channel)
-            )
+            cursor.execute(INSERT_BLOB_QUERY, (sha256, len(data), data))
+            cursor.execute(INSERT_FILE_QUERY, insert_file_params(file_id, filename, content_type, len(data), sha256, associated_channel))
             conn.commit()
             return True
 
     def get_associated_files(self, channel_id: str) -> list[FileDescription]:
         with self.pool.connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM files WHERE associated_channel = %s", (channel_id,))
+            cursor.execute(ASSOCIATED_FILES_QUERY, (channel_id,))
             file_data = cursor.fetchall()
-            return [FileDescription(
-                id=file['id'],
-                filename=file['filename'],
-                content_type=file['content_type'],
-                size=file['size'],
-                created_at=file['created_at'].isoformat(),  # Convert datetime to string
-                channel_id=file['associated_channel']  # Map associated_channel to channel_id
-            ) for file in file_data]
+            return [file_description_from_row(file) for file in file_data]
         
 
     def get_file(self, file_id: str) -> dict | None:
         with self.pool.connection() as conn:
             cursor = conn.cursor()
-            cursor.execute(
-                "SELECT * FROM files WHERE id = %s",
-                (file_id,)
-            )
-            file_data = cursor.fetchone()
-            if file_data:
-                return {
-                    'id': file_data['id'],
-                    'filename': file_data['filename'],
-                    'content_type': file_data['content_type'],
-                    'data': file_data['data'],
-                    'size': file_data['size']
-                }
-            return None
+            cursor.execute(FILE_QUERY, (file_id,))
+            return cursor.fetchone()
 
-
-    def search_messages(self, search_query: str) -> List[dict]:
+    def search_messages(self, search_query: str, limit: int = 20, offset: int = 0) -> List[dict]:
         """
-        Search for messages containing the search query using separate queries for clarity.
+        Full-text search for messages, best matches first, one page at a time.
+        Accepts web search syntax ("quoted phrases", or, -excluded).
         """
         with self.pool.connection() as conn:
             cursor = conn.cursor()
-            print(f"Searching for: '{search_query}'")
             
             # Query 1: Find matching messages
-            cursor.execute("""
-                SELECT 
-                    m.id as message_id,
-                    m.sent,
-                    m.text,
-                    m.content,
-                    m.channel_id,
-                    m.reactions,
-                    m.has_thread,
-                    m.has_image,
-                    m.thread_id,
-                    m.image,
-                    m.file_id,
-                    f.filename as file_name,
-                    f.content_type as file_content_type,
-                    c.name as channel_name,
-                    u.id as user_id,
-                    u.created_at as user_created_at,
-                    u.username,
-                    u.password,
-                    u.token,
-                    u.status,
-                    u.profile_picture
-                FROM messages m
-                JOIN channels c ON m.channel_id = c.id
-                JOIN users u ON m.sender_id = u.id
-                LEFT JOIN files f ON m.file_id = f.id
-                WHERE m.content ILIKE %s OR m.text ILIKE %s
-                ORDER BY m.sent DESC
-            """, (f"%{search_query}%", f"%{search_query}%"))
-            
+            cursor.execute(SEARCH_MESSAGES_QUERY, (search_query, limit, offset))
             results = cursor.fetchall()
-            print(f"Found {len(results)} matching messages")
-            
-            search_results = []
-            for result in results:
-                print(f"Processing message: {result['content']}")
-                
-                # Query 2: Find previous message in the same channel
-                cursor.execute("""
-                    SELECT * FROM messages 
-                    WHERE channel_id = %s 
-                    AND sent < %s 
-                    ORDER BY sent DESC 
-                    LIMIT 1
-                """, (result['channel_id'], result['sent']))
-                prev_msg = cursor.fetchone()
-                
-                # Query 3: Find next message in the same channel
-                cursor.execute("""
-                    SELECT * FROM messages 
-                    WHERE channel_id = %s 
-                    AND sent > %s 
-                    ORDER BY sent ASC 
-                    LIMIT 1
-                """, (result['channel_id'], result['sent']))
-                next_msg = cursor.fetchone()
-                
-                # Get full message objects for previous and next messages
-                prev_message = self.get_message(prev_msg['id']) if prev_msg else None
-                next_message = self.get_message(next_msg['id']) if next_msg else None
-                
-                # Construct current message
-                current_message = {
-                    'id': result['message_id'],
-                    'sent': result['sent'].isoformat(),
-                    'text': result['text'],
-                    'content': result['content'],
-                    'channel_id': result['channel_id'],
-                    'reactions': result['reactions'],
-                    'has_thread': result['has_thread'],
-                    'has_image': result['has_image'],
-                    'thread_id': result['thread_id'],
-                    'image': result['image'],
-                    'file_id': result['file_id'],
-                    'file_name': result['file_name'],
-                    'file_content_type': result['file_content_type'],
-                    'sender': {
-                        'id': result['user_id'],
-                        'created_at': result['user_created_at'].isoformat(),
-                        'username': result['username'],
-                        'password': result['password'],
-                        'token': result['token'],
-                        'status': result['status'],
-                        'profile_picture': result['profile_picture']
-                    }
-                }
-                
-                search_results.append({
-                    'channel_id': result['channel_id'],
-                    'channel_name': result['channel_name'],
-                    'message': current_message,
-                    'previous_message': prev_message.dict() if prev_message else None,
-                    'next_message': next_message.dict() if next_message else None,
-                    'score': 1.0  # Simple score for now
-                })
-            
-            return search_results
+            if not results:
+                return []
 
+            # Query 2: The previous and next message around every hit
+            message_ids = [result['message_id'] for result in results]
+            cursor.execute(MESSAGE_CONTEXT_QUERY, {'message_ids': message_ids, 'before': 1, 'after': 1})
+            contexts = message_contexts_from_rows(message_ids, cursor.fetchall())
+            return [search_result(result, contexts[result['message_id']]) for result in results]
 
-    def update_message_reactions(self, message_id: str, reactions: Dict[str, int]) -> bool:
-        """Update the reactions for a message"""
+
+    def get_message_context(self, message_ids: List[str], before: int = 5, after: int = 5) -> dict[str, MessageContext]:
+        """
+        Get the messages surrounding each of the given messages in its channel,
+        in a single query however many ids are given.
+        """
         with self.pool.connection() as conn:
             cursor = conn.cursor()
-            cursor.execute(
-                "UPDATE messages SET reactions = %s WHERE id = %s",
-                (json.dumps(reactions), message_id)
-            )
-            conn.commit()
-            return True
+            cursor.execute(MESSAGE_CONTEXT_QUERY, {'message_ids': message_ids, 'before': before, 'after': after})
+            return message_contexts_from_rows(message_ids, cursor.fetchall())
 
     def update_channel_members_count(self, channel_id: str, count: int) -> bool:
         """Update the members count for a channel."""
@@ -743,6 +1413,7 @@ class DataLayer:
             cursor = conn.cursor()
             cursor.execute("UPDATE channels SET members_count = %s WHERE id = %s", (count, channel_id))
             conn.commit()
+            self.cache.invalidate_channel(channel_id)
             return True
 
 
@@ -762,157 +1433,90 @@ class DataLayer:
             ON DELETE CASCADE
     )
     """
+
     def add_chunks(self, chunks: List[Chunk]):
         try:
             with self.pool.connection() as conn:
                 with conn.cursor() as cur:
-                    chunk_data = [
-                        (
-                            f'[{",".join(map(str, chunk.embedding))}]',
-                            chunk.file_id,
-                            chunk.file_chunk,
-                            chunk.text,
-                            chunk.channel_id
-                        ) 
-                        for chunk in chunks
-                    ]
-                    
-                    cur.executemany(
-                        """
-                        INSERT INTO chunks 
-                        (embedding, file_id, file_chunk, text, channel_id)
-                        VALUES (%s::vector, %s, %s, %s, %s)
-                        """,
-                        chunk_data
-                    )
+                    cur.executemany(INSERT_CHUNK_QUERY, [chunk_params(chunk) for chunk in chunks])
                     conn.commit()
             return True
         except Exception as e:
             print(f"Error adding chunks: {e}")
             return False
 
-    def similarity_search(self, query_vector: List[float], top_k: int = 10) -> List[Chunk]:
+    def similarity_search(self, query_vector: List[float], top_k: int = 10, ef_search: int = None, probes: int = None,
+                          exact: bool = None, include_embeddings: bool = False) -> List[Chunk]:
         try:
-            with self.pool.connection() as conn:
-                with conn.cursor() as cur:
-                    vector_str = f'[{",".join(map(str, query_vector))}]'
-                    cur.execute("""
-                        SELECT 
-                            c.id,
-                            c.embedding::text,  -- Convert to text for proper parsing
-                            c.file_id,
-                            c.file_chunk,
-                            c.text,
-                            f.filename,
-                            f.content_type
-                        FROM chunks c
-                        JOIN files f ON c.file_id = f.id
-                        ORDER BY c.embedding <=> %s::vector
-                        LIMIT %s
-                    """, (vector_str, top_k))
-                    chunks = cur.fetchall()
-                    
-                    # Convert database results to Chunk objects
-                    return [Chunk(
-                        id=chunk['id'],
-                        embedding=list(map(float, chunk['embedding'].strip('[]').split(','))),  # Properly parse the vector string
-                        file_id=chunk['file_id'],
-                        file_chunk=chunk['file_chunk'],
-                        text=chunk['text']
-                    ) for chunk in chunks]
+            query = similarity_search_query(include_embeddings=include_embeddings)
+            return self._vector_search(query, (as_vector(query_vector), top_k), ef_search, probes, exact)
         except Exception as e:
             print(f"Error in similarity search: {e}")
             return []
 
-    def similarity_search_in_channel(self, query_vector: List[float], channel_id: str, top_k: int = 10) -> List[Chunk]:
+    def similarity_search_in_channel(self, query_vector: List[float], channel_id: str, top_k: int = 10,
+                                     ef_search: int = None, probes: int = None, exact: bool = None,
+                                     include_embeddings: bool = False) -> List[Chunk]:
         try:
-            with self.pool.connection() as conn:
-                with conn.cursor() as cur:
-                    vector_str = f'[{",".join(map(str, query_vector))}]'
-                    cur.execute("""
-                        SELECT 
-                            c.id,
-                            c.embedding::text,
-                            c.file_id,
-                            c.file_chunk,
-                            c.text,
-                            c.channel_id,
-                            f.filename,
-                            f.content_type
-                        FROM chunks c
-                        JOIN files f ON c.file_id = f.id
-                        WHERE c.channel_id = %s
-                        ORDER BY c.embedding <=> %s::vector
-                        LIMIT %s
-                    """, (channel_id, vector_str, top_k))
-                    chunks = cur.fetchall()
-                    
-                    return [Chunk(
-                        id=chunk['id'],
-                        embedding=list(map(float, chunk['embedding'].strip('[]').split(','))),
-                        file_id=chunk['file_id'],
-                        file_chunk=chunk['file_chunk'],
-                        text=chunk['text'],
-                        channel_id=chunk['channel_id']
-                    ) for chunk in chunks]
+            if exact is None:
+                exact = self.count_channel_chunks(channel_id) <= EXACT_CHANNEL_SEARCH_ROWS or None
+            query = similarity_search_query(in_channel=True, include_embeddings=include_embeddings)
+            return self._vector_search(query, (as_vector(query_vector), channel_id, top_k), ef_search, probes, exact,
+                                       filtered=True)
         except Exception as e:
             print(f"Error in channel similarity search: {e}")
             return []
 
+    def count_channel_chunks(self, channel_id: str) -> int:
+        with self.pool.connection() as conn:
+            return conn.execute(CHANNEL_CHUNK_COUNT_QUERY, (channel_id,)).fetchone()['count']
+
+    def _vector_search(self, query: str, params: tuple, ef_search: int = None, probes: int = None, exact: bool = None,
+                       filtered: bool = False) -> List[Chunk]:
+        with self.pool.connection() as conn:
+            with conn.cursor(binary=True) as cur:
+                for setting in vector_search_settings(ef_search, probes, exact, filtered):
+                    cur.execute(SET_LOCAL_QUERY, setting)
+                cur.execute(query, params)
+                return [chunk_from_row(chunk) for chunk in cur.fetchall()]
+
+    def get_vector_index(self) -> dict | None:
+        """The name and definition of the ANN index on chunks.embedding, if there is one."""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(VECTOR_INDEX_QUERY, (VECTOR_INDEX_NAME,))
+            return cursor.fetchone()
+
+    def create_vector_index(self, method: str = "hnsw", m: int = 16, ef_construction: int = 64, lists: int = None):
+        """
+        Build (or rebuild) the ANN index on chunks.embedding without blocking
+        writes. The new index is built alongside the old one and swapped in, so
+        searches stay indexed throughout. IVFFlat lists default to rows / 1000,
+        and IVFFlat indexes should be rebuilt once the table has grown a lot.
+        """
+        with psycopg.connect(self.conn_string, autocommit=True, row_factory=dict_row) as conn:
+            if method == "ivfflat" and lists is None:
+                lists = max(10, conn.execute("SELECT count(*) AS n FROM chunks").fetchone()['n'] // 1000)
+            building = f"{VECTOR_INDEX_NAME}_new"
+            conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {building}")
+            conn.execute(create_vector_index_query(building, method, m, ef_construction, lists))
+            conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {VECTOR_INDEX_NAME}")
+            conn.execute(f"ALTER INDEX {building} RENAME TO {VECTOR_INDEX_NAME}")
+            conn.execute("ANALYZE chunks")
+
+    def drop_vector_index(self):
+        with psycopg.connect(self.conn_string, autocommit=True) as conn:
+            conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {VECTOR_INDEX_NAME}")
+
     def get_recent_messages(self, hours: int = 24) -> list[Message]:
         """Get all messages from the past specified hours."""
         try:
             with self.pool.connection() as conn:
                 cursor = conn.cursor()
-                
-                query = f"""
-                    SELECT 
-                        m.id as message_id,
-                        m.sent,
-                        m.text,
-                        m.content,
-                        m.channel_id,
-                        m.reactions,
-                        m.has_thread,
-                        m.has_image,
-                        m.thread_id,
-                        m.image,
-                        m.file_id,
-                        u.id as user_id,
-                        u.created_at,
-                        u.username,
-                        u.password,
-                        u.token,
-                        u.status,
-                        u.profile_picture
-                    FROM messages m
-                    JOIN users u ON m.sender_id = u.id
-                    WHERE m.sent > NOW() - INTERVAL '{hours} hours'
-                    ORDER BY m.sent ASC
-                """
-                
-                cursor.execute(query)
+                cursor.execute(RECENT_MESSAGES_QUERY, (hours,))
                 message_data = cursor.fetchall()
                 print(f"Query executed. Found {len(message_data)} messages")
-                
-                messages = [Message(
-                    **{
-                        **msg,
-                        'id': msg['message_id'],
-                        'sent': msg['sent'].isoformat(),
-                        'sender': User(
-                            id=msg['user_id'],
-                            created_at=msg['created_at'].isoformat(),
-                            username=msg['username'],
-                            password=msg['password'],
-                            token=msg['token'],
-                            status=msg['status'],
-                            profile_picture=msg['profile_picture']
-                        )
-                    }
-                ) for msg in message_data]
-                
-                return messages
+                return [message_from_row(msg) for msg in message_data]
                 
         except Exception as e:
             print(f"Error in get_recent_messages: {e}")
@@ -931,63 +1535,9 @@ class DataLayer:
         try:
             with self.pool.connection() as conn:
                 cursor = conn.cursor()
-                
-                # Build the query dynamically based on provided parameters
-                query = """
-                    SELECT 
-                        m.id as message_id,
-                        m.sent,
-                        m.text,
-                        m.content,
-                        m.channel_id,
-                        m.reactions,
-                        m.has_thread,
-                        m.has_image,
-                        m.thread_id,
-                        m.image,
-                        m.file_id,
-                        u.id as user_id,
-                        u.created_at,
-                        u.username,
-                        u.password,
-                        u.token,
-                        u.status,
-                        u.profile_picture
-                    FROM messages m
-                    JOIN users u ON m.sender_id = u.id
-                    WHERE u.username = ANY(%s)
-                """
-                params = [user_ids]
-                
-                # Add time constraints if provided
-                if start_time:
-                    query += " AND m.sent >= %s"
-                    params.append(start_time)
-                if end_time:
-                    query += " AND m.sent <= %s"
-                    params.append(end_time)
-                
-                query += " ORDER BY m.sent ASC"
-                
-                cursor.execute(query, params)
+                cursor.execute(*messages_for_users_query(user_ids, start_time, end_time))
                 message_data = cursor.fetchall()
-                
-                return [Message(
-                    **{
-                        **msg,
-                        'id': msg['message_id'],
-                        'sent': msg['sent'].isoformat(),
-                        'sender': User(
-                            id=msg['user_id'],
-                            created_at=msg['created_at'].isoformat(),
-                            username=msg['username'],
-                            password=msg['password'],
-                            token=msg['token'],
-                            status=msg['status'],
-                            profile_picture=msg['profile_picture']
-                        )
-                    }
-                ) for msg in message_data]
+                return [message_from_row(msg) for msg in message_data]
                 
         except Exception as e:
             print(f"Error getting messages for users: {e}")
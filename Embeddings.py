@@ -0,0 +1,125 @@
+import asyncio
+import hashlib
+import os
+import random
+from typing import List
+import numpy as np
+from Cache import TTLCache
+from Models import Chunk
+
+# Chunks sent per embedding request, requests in flight at once, and attempts per request
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+EMBED_ATTEMPTS = int(os.getenv("EMBED_ATTEMPTS", "4"))
+# Embeddings held in memory in front of the embedding_cache table, as float32 arrays (6KB each at 1536 dimensions)
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "10000"))
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class CachedEmbeddings:
+    """
+    Async stand-in for an embeddings model that never embeds the same text
+    twice: vectors are looked up by (model, sha256(text)) in a memory LRU, then
+    in the embedding_cache table, and only the rest are sent to the model.
+    The memory LRU holds float32 arrays, an eighth the size of lists of floats.
+    """
+
+    def __init__(self, embeddings, dl, model: str = None, max_size: int = EMBEDDING_CACHE_SIZE):
+        self.embeddings = embeddings
+        self.dl = dl
+        self.model = model or embeddings.model
+        self.memory = TTLCache(max_size, ttl=float("inf"))  # (model, text hash) -> float32 vector
+        self.lookups = 0
+        self.database_hits = 0
+        self.embedded = 0
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        hashes = [text_hash(text) for text in texts]
+        self.lookups += len(texts)
+        vectors = {}
+        for key in dict.fromkeys(hashes):
+            vector = self.memory.get((self.model, key))
+            if vector is not None:
+                vectors[key] = vector.tolist()
+
+        missing = [key for key in dict.fromkeys(hashes) if key not in vectors]
+        if missing:
+            stored = await self.dl.get_cached_embeddings(self.model, missing)
+            self.database_hits += len(stored)
+            self._remember(stored)
+            vectors.update(stored)
+
+        # Each distinct text is embedded once, however often it repeats in the batch
+        to_embed = {key: text for key, text in zip(hashes, texts) if key not in vectors}
+        if to_embed:
+            self.embedded += len(to_embed)
+            fresh = dict(zip(to_embed, await self.embeddings.aembed_documents(list(to_embed.values()))))
+            await self.dl.put_cached_embeddings(self.model, fresh)
+            self._remember(fresh)
+            vectors.update(fresh)
+
+        return [vectors[key] for key in hashes]
+
+    def _remember(self, vectors: dict):
+        for key, vector in vectors.items():
+            self.memory.set((self.model, key), np.asarray(vector, dtype=np.float32))
+
+    def stats(self) -> dict:
+        return {
+            "memory": self.memory.stats(),
+            "lookups": self.lookups,
+            "database_hits": self.database_hits,
+            "embedded": self.embedded,
+            "hit_rate": (self.lookups - self.embedded) / self.lookups if self.lookups else 0.0,
+        }
+
+
+async def embed_with_retry(embeddings, texts: List[str], attempts: int = EMBED_ATTEMPTS, base_delay: float = 1.0) -> List[List[float]]:
+    """Embed one batch of texts, backing off exponentially (with jitter) between failed attempts."""
+    for attempt in range(attempts):
+        try:
+            return await embeddings.aembed_documents(texts)
+        except Exception as e:
+            if attempt == attempts - 1:
+                raise
+            delay = base_delay * 2 ** attempt + random.uniform(0, base_delay)
+            print(f"Error embedding batch of {len(texts)}, retrying in {delay:.1f}s: {e}")
+            await asyncio.sleep(delay)
+
+
+async def embed_and_store_chunks(embeddings, dl, texts: List[str], file_id: str, channel_id: str = None,
+                                 batch_size: int = EMBED_BATCH_SIZE, concurrency: int = EMBED_CONCURRENCY,
+                                 upsert: bool = False) -> int:
+    """
+    Embed a file's chunk texts in batches, with at most `concurrency` batches
+    in flight, and bulk load each batch with COPY as soon as it is embedded;
+    with upsert, a re-ingested file's stored chunks are replaced. A chunk's
+    file_chunk is its position in `texts`, so an ingest that failed part way
+    can be rerun: chunks already stored are neither embedded nor written again.
+    Returns the number of chunks written; raises if any batch can't be embedded or stored.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    stored = set() if upsert else await dl.get_file_chunk_numbers(file_id)
+    missing = [(number, text) for number, text in enumerate(texts) if number not in stored]
+
+    async def embed_and_store(start: int):
+        batch = missing[start:start + batch_size]
+        async with semaphore:
+            vectors = await embed_with_retry(embeddings, [text for _, text in batch])
+        chunks = [
+            Chunk(embedding=vector, file_id=file_id, file_chunk=number, text=text, channel_id=channel_id)
+            for (number, text), vector in zip(batch, vectors)
+        ]
+        written = await dl.copy_chunks(chunks, upsert=upsert)
+        if written is None:
+            raise RuntimeError(f"Failed to store {len(chunks)} chunks from chunk {batch[0][0]}")
+        return written
+
+    written = await asyncio.gather(*[embed_and_store(start) for start in range(0, len(missing), batch_size)])
+    return sum(written)
@@ -0,0 +1,175 @@
+import asyncio
+import inspect
+import json
+import os
+import socket
+from collections import defaultdict
+from DataLayer import EVENTS_CHANNEL, MAX_EVENT_PAYLOAD
+
+# Seconds published events wait to be sent to the other processes together
+EVENT_FLUSH_INTERVAL = float(os.getenv("EVENT_FLUSH_INTERVAL", "0.01"))
+# Most events waiting for this process's handlers, and waiting to be sent; beyond them events are dropped
+EVENT_INBOX_SIZE = int(os.getenv("EVENT_INBOX_SIZE", "10000"))
+EVENT_OUTBOX_SIZE = int(os.getenv("EVENT_OUTBOX_SIZE", "10000"))
+# Seconds before sending is retried after a failure
+EVENT_RETRY_DELAY = 1.0
+
+# Identifies this process in the events it publishes
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+class EventBus:
+    """
+    Compact events shared by every process using the database, over Postgres
+    LISTEN/NOTIFY with one listening connection per process.
+
+    publish() hands an event to this process's handlers and queues it for
+    NOTIFY; queued events are sent in order, a batch per statement. Events
+    from other processes arrive on the listener and go through the same
+    handlers, one at a time and in the order Postgres delivered them. Every
+    event carries its `origin` process, so a handler can skip events whose
+    effects its own process has already applied.
+
+    NOTIFY is not durable: events sent while the listener is reconnecting are
+    lost, so on_listening callbacks run each time listening (re)starts, in
+    order with the events, for handlers to resynchronize from the database.
+    They also run once the handlers catch up after events were dropped from a
+    full inbox. Events that don't fit in a full outbox are dropped and logged.
+    """
+
+    def __init__(self, layer, worker_id: str = WORKER_ID, flush_interval: float = EVENT_FLUSH_INTERVAL,
+                 inbox_size: int = EVENT_INBOX_SIZE, outbox_size: int = EVENT_OUTBOX_SIZE):
+        self.layer = layer
+        self.worker_id = worker_id
+        self.flush_interval = flush_interval
+        self.inbox_size = inbox_size
+        self.outbox_size = outbox_size
+        self.handlers = defaultdict(list)  # event type -> handlers, may be async
+        self.listening_callbacks = []
+        self.inbox = None  # events waiting for the handlers, once started; None marks a (re)connect
+        self.outbox = []  # payloads waiting to be sent
+        self.flush_task = None
+        self.tasks = []
+        self.resync = False  # Events were dropped from the inbox
+        self.published = 0
+        self.received = 0
+        self.dropped = 0
+
+    def subscribe(self, event_type: str, handler):
+        self.handlers[event_type].append(handler)
+
+    def on_listening(self, callback):
+        self.listening_callbacks.append(callback)
+
+    def publish(self, event_type: str, **data):
+        event = {"type": event_type, "origin": self.worker_id, **data}
+        payload = json.dumps(event)
+        if len(payload.encode()) > MAX_EVENT_PAYLOAD:
+            print(f"Not publishing {event_type} event of {len(payload)} bytes: too large for NOTIFY")
+        elif len(self.outbox) >= self.outbox_size:
+            self.dropped += 1
+            print(f"Not publishing {event_type} event: {len(self.outbox)} events are waiting to be sent")
+        else:
+            self.outbox.append(payload)
+            if self.flush_task is None:
+                self.flush_task = asyncio.create_task(self._flush_later(self.flush_interval))
+        self.published += 1
+        self._receive(event)
+
+    def _receive(self, event: dict | None):
+        """Queue an event, or None for a (re)connect, for the handlers."""
+        if self.inbox is None:
+            return
+        try:
+            self.inbox.put_nowait(event)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if not self.resync:
+                print(f"Dropping events: {self.inbox.qsize()} are waiting for handlers; resynchronizing once they catch up")
+            self.resync = True
+
+    async def _flush_later(self, delay: float):
+        try:
+            await asyncio.sleep(delay)
+            sent = await self.flush()
+        finally:
+            self.flush_task = None
+        if self.outbox:
+            self.flush_task = asyncio.create_task(self._flush_later(self.flush_interval if sent else EVENT_RETRY_DELAY))
+
+    async def flush(self) -> bool:
+        """Send the queued events; returns False if they couldn't be sent and were requeued."""
+        payloads, self.outbox = self.outbox, []
+        if not payloads:
+            return True
+        try:
+            await self.layer.notify(EVENTS_CHANNEL, payloads)
+            return True
+        except Exception as e:
+            print(f"Error sending {len(payloads)} events, retrying: {e}")
+            self.outbox = payloads + self.outbox
+            if len(self.outbox) > self.outbox_size:
+                dropped = len(self.outbox) - self.outbox_size
+                self.dropped += dropped
+                print(f"Dropping the oldest {dropped} events waiting to be sent")
+                del self.outbox[:dropped]
+            return False
+
+    async def start(self):
+        """Start listening for other processes' events and handling events."""
+        self.inbox = asyncio.Queue(maxsize=self.inbox_size)
+        self.tasks = [asyncio.create_task(self._listen()), asyncio.create_task(self._dispatch())]
+
+    async def stop(self):
+        """Send what is still queued and stop listening."""
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self.flush()
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        self.inbox = None
+
+    async def _listen(self):
+        while True:
+            try:
+                async for payload in self.layer.listen(EVENTS_CHANNEL):
+                    if payload is None:
+                        self._receive(None)
+                        continue
+                    event = json.loads(payload)
+                    if event.get("origin") != self.worker_id:
+                        self.received += 1
+                        self._receive(event)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Event listener failed, reconnecting: {e}")
+                await asyncio.sleep(1)
+
+    async def _dispatch(self):
+        while True:
+            event = await self.inbox.get()
+            await self._handle(event)
+            if self.resync and self.inbox.empty():
+                self.resync = False
+                await self._handle(None)
+
+    async def _handle(self, event: dict | None):
+        callbacks = self.listening_callbacks if event is None else self.handlers.get(event["type"], ())
+        for callback in callbacks:
+            try:
+                result = callback() if event is None else callback(event)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                print(f"Error handling {'listening' if event is None else event['type']} event: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "published": self.published,
+            "received": self.received,
+            "dropped": self.dropped,
+            "queued": self.inbox.qsize() if self.inbox is not None else 0,
+        }
@@ -0,0 +1,75 @@
+import asyncio
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_all_start_methods, get_context
+from typing import List
+import pdfplumber
+from Cache import ByteCache
+
+# API worker processes on this machine (as uvicorn reads it), each with its own extraction pool
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+# Processes extracting PDF text per API worker, and the fewest pages worth handing a process on their own
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", str(max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY))))
+MIN_PAGES_PER_TASK = int(os.getenv("MIN_PAGES_PER_TASK", "8"))
+
+# Extracted page text of recently ingested PDFs, by content hash
+page_cache = ByteCache(max_bytes=int(os.getenv("PDF_TEXT_CACHE_BYTES", str(64 * 1024 * 1024))), max_item_bytes=16 * 1024 * 1024)
+
+_executor = None
+
+
+def executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # Forking the server process would copy its event loop, threads and connections. The fork
+        # server imports only this module rather than the server's __main__; each process still
+        # runs __main__ as __mp_main__, which is why main.py defers its side effects to startup
+        if "forkserver" in get_all_start_methods():
+            context = get_context("forkserver")
+            context.set_forkserver_preload(["Extraction"])
+        else:
+            context = get_context("spawn")
+        _executor = ProcessPoolExecutor(max_workers=PDF_EXTRACT_WORKERS, mp_context=context)
+    return _executor
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)  # Don't block the event loop
+        _executor = None
+
+
+def count_pages(data: bytes) -> int:
+    with pdfplumber.open(io.BytesIO(data)) as pdf:
+        return len(pdf.pages)
+
+
+def extract_pages(data: bytes, start: int, end: int) -> List[str]:
+    """Text of pages start..end-1 (0-based); runs in a worker process."""
+    with pdfplumber.open(io.BytesIO(data)) as pdf:
+        return [page.extract_text() or "" for page in pdf.pages[start:end]]
+
+
+async def extract_pdf_pages(data: bytes) -> List[str]:
+    """
+    Text of every page of a PDF, in order. Page ranges are extracted in
+    parallel in the process pool, so a large PDF neither blocks the event
+    loop nor is limited to one core.
+    """
+    loop = asyncio.get_running_loop()
+    page_count = await loop.run_in_executor(executor(), count_pages, data)
+    per_task = max(MIN_PAGES_PER_TASK, -(-page_count // PDF_EXTRACT_WORKERS))
+    ranges = [(start, min(start + per_task, page_count)) for start in range(0, page_count, per_task)]
+    parts = await asyncio.gather(*[loop.run_in_executor(executor(), extract_pages, data, start, end) for start, end in ranges])
+    return [text for part in parts for text in part]
+
+
+async def pdf_pages(file) -> List[str]:
+    """Page texts of a stored PDF (a FileHandle), extracted once per distinct content while cached."""
+    pages = page_cache.get(file.sha256)
+    if pages is None:
+        pages = await extract_pdf_pages(await file.read())
+        page_cache.set(file.sha256, pages, sum(len(text) for text in pages))
+    return pages
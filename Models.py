@@ -38,6 +38,7 @@ class Channel(BaseModel):
     description: str
     members_count: int = 0
     creator_id: str
+    has_ai_member: bool = False
 
 
 class ChannelMembership(BaseModel):
@@ -60,12 +61,25 @@ class Message(BaseModel):
     file_name: Optional[str] = None
     file_content_type: Optional[str] = None
 
+class PostedMessage(BaseModel):
+    """A newly saved message plus the channel flags the send path acts on."""
+    message: Message
+    channel_type: ChannelType
+    channel_has_ai_member: bool = False
+
+class MessageContext(BaseModel):
+    message_id: str
+    previous_messages: List[Message] = []  # Oldest first
+    next_messages: List[Message] = []  # Oldest first
+
 class Heartbeat(BaseModel):
     user_id: str
     channel_id: Optional[str] = None
 
 class SearchRequest(BaseModel):
     search_query: str
+    limit: int = Field(20, ge=1, le=100)
+    offset: int = Field(0, ge=0)
 
 class SearchResult(BaseModel):
     channel_id: str
@@ -74,6 +88,7 @@ class SearchResult(BaseModel):
     previous_message: Optional[Message] = None
     next_message: Optional[Message] = None
     score: float
+    snippet: Optional[str] = None
     
 
 class FileDescription(BaseModel):
@@ -86,8 +101,8 @@ class FileDescription(BaseModel):
 
 class Chunk(BaseModel):
     id: Optional[int] = None
-    embedding: List[float]
+    embedding: Optional[List[float]] = None
     file_id: str
     file_chunk: int
     text: str
-    channel_id: str
+    channel_id: Optional[str] = None
@@ -1,42 +1,258 @@
 import websockets
 import asyncio
+from array import array
 from datetime import datetime
-from Models import UserStatus
+from Models import UserStatus, Message
 from collections import defaultdict
+import inspect
 import json
-from pydantic import BaseModel
+import sys
+import time
 from dotenv import load_dotenv
 import os
 
 load_dotenv()
 
 ALLOWED_ORIGINS = os.getenv("ALLOWED_ORIGINS")
+# Outbound messages buffered per connection before a client is considered too slow
+SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+# Users one connection may watch for presence changes
+PRESENCE_WATCH_LIMIT = int(os.getenv("PRESENCE_WATCH_LIMIT", "5000"))
+# Share presence between the API processes through Postgres (see the presence tables in DataLayer.py)
+PRESENCE_SHARED = os.getenv("PRESENCE_SHARED", "").lower() in ("1", "true")
+# Seconds between writes of local status changes, and of silence after which a process's users are dropped
+PRESENCE_SYNC_INTERVAL = float(os.getenv("PRESENCE_SYNC_INTERVAL", "0.1"))
+PRESENCE_WORKER_TIMEOUT = float(os.getenv("PRESENCE_WORKER_TIMEOUT", "30"))
+# Writes a batch of status changes gets before it is dropped
+PRESENCE_SYNC_ATTEMPTS = int(os.getenv("PRESENCE_SYNC_ATTEMPTS", "3"))
+# Longest user id a client may identify as, like users.id
+MAX_USER_ID_LENGTH = 36
 
-class HeartbeatRecord(BaseModel):
-    user_id: str
-    timestamp: datetime
-    connected: bool
-
-    @classmethod
-    def default_record(cls, user_id: str):
-        return cls(
-            user_id=user_id,
-            timestamp=datetime(1970, 1, 1),
-            connected=False
-        )
+# Seconds without a heartbeat before a connected user is away, then offline
+PRESENCE_AWAY_AFTER = float(os.getenv("PRESENCE_AWAY_AFTER", "30"))
+PRESENCE_OFFLINE_AFTER = float(os.getenv("PRESENCE_OFFLINE_AFTER", "300"))
+# Resolution of the expiry timer wheel, in seconds
+PRESENCE_TICK = float(os.getenv("PRESENCE_TICK", "1"))
+
+OFFLINE, ONLINE, AWAY = 0, 1, 2
+STATUSES = (UserStatus.OFFLINE, UserStatus.ONLINE, UserStatus.AWAY)
+STATUS_CODES = {status: code for code, status in enumerate(STATUSES)}
+# A user connected to several processes has the best of their statuses
+STATUS_RANK = {UserStatus.OFFLINE: 0, UserStatus.AWAY: 1, UserStatus.ONLINE: 2}
+NOT_SCHEDULED = -1
+
+
+class PresenceStore:
+    """
+    Presence of every user who has sent a heartbeat, kept in flat arrays
+    indexed by a slot per (interned) user id, so a heartbeat allocates
+    nothing once the user has a slot and looking up an unknown user adds
+    nothing.
+
+    Expiry runs on a timer wheel: a bucket of slots per tick, each slot
+    filed under the tick it may next change status at. advance() empties
+    the buckets that have come due, moving ONLINE users to AWAY and AWAY
+    users to OFFLINE, and filing users who have sent a heartbeat since
+    under their new expiry; its cost is one visit per user per
+    PRESENCE_AWAY_AFTER seconds, never a scan of all users.
+    """
+
+    def __init__(self, away_after: float = PRESENCE_AWAY_AFTER, offline_after: float = PRESENCE_OFFLINE_AFTER, tick: float = PRESENCE_TICK):
+        if tick <= 0:
+            raise ValueError(f"Presence tick must be positive, got {tick}")
+        self.away_after = away_after
+        self.offline_after = max(offline_after, away_after)
+        self.tick = tick
+        self.slots: dict[str, int] = {}  # user_id -> slot
+        self.user_ids: list[str] = []  # slot -> user_id
+        self.last_seen = array('d')  # slot -> time of last heartbeat
+        self.connections = array('I')  # slot -> open connections
+        self.status = bytearray()  # slot -> OFFLINE / ONLINE / AWAY
+        self.due = array('q')  # slot -> wheel tick it is filed under
+        # Every delay fits in one revolution, so a bucket only holds slots due at its tick
+        self.wheel = [set() for _ in range(int(self.offline_after / tick) + 2)]
+        self.current_tick = self._tick(time.time())
+
+    def _tick(self, timestamp: float) -> int:
+        return int(timestamp // self.tick)
+
+    def _slot(self, user_id: str) -> int:
+        slot = self.slots.get(user_id)
+        if slot is None:
+            slot = len(self.user_ids)
+            user_id = sys.intern(user_id)
+            self.slots[user_id] = slot
+            self.user_ids.append(user_id)
+            self.last_seen.append(0.0)
+            self.connections.append(0)
+            self.status.append(OFFLINE)
+            self.due.append(NOT_SCHEDULED)
+        return slot
+
+    def _schedule(self, slot: int, at: float):
+        self._unschedule(slot)
+        due = self._tick(at) + 1
+        self.due[slot] = due
+        self.wheel[due % len(self.wheel)].add(slot)
+
+    def _unschedule(self, slot: int):
+        if self.due[slot] != NOT_SCHEDULED:
+            self.wheel[self.due[slot] % len(self.wheel)].discard(slot)
+            self.due[slot] = NOT_SCHEDULED
+
+    def _set_status(self, slot: int, status: int, changes: list):
+        if self.status[slot] != status:
+            self.status[slot] = status
+            changes.append((self.user_ids[slot], STATUSES[status]))
+
+    def heartbeat(self, user_id: str, now: float = None) -> list[tuple[str, UserStatus]]:
+        """Record a heartbeat; returns the (user_id, status) changes it caused."""
+        now = time.time() if now is None else now
+        slot = self._slot(user_id)
+        self.last_seen[slot] = now
+        changes = []
+        # An online user's expiry stays filed where it is; when it comes due
+        # advance() files it again from the latest heartbeat
+        if self.connections[slot] and self.status[slot] != ONLINE:
+            self._set_status(slot, ONLINE, changes)
+            self._schedule(slot, now + self.away_after)
+        return changes
+
+    def connect(self, user_id: str, now: float = None) -> list[tuple[str, UserStatus]]:
+        slot = self._slot(user_id)
+        self.connections[slot] += 1
+        return self.heartbeat(user_id, now)
+
+    def disconnect(self, user_id: str) -> list[tuple[str, UserStatus]]:
+        """A connection closed; the user is offline once their last one has, keeping their last heartbeat."""
+        slot = self.slots.get(user_id)
+        changes = []
+        if slot is None or not self.connections[slot]:
+            return changes
+        self.connections[slot] -= 1
+        if not self.connections[slot]:
+            self._unschedule(slot)
+            self._set_status(slot, OFFLINE, changes)
+        return changes
+
+    def advance(self, now: float = None) -> list[tuple[str, UserStatus]]:
+        """Apply every expiry due by now; returns the (user_id, status) changes."""
+        now = time.time() if now is None else now
+        now_tick = self._tick(now)
+        changes = []
+        # After a stall longer than a revolution every bucket is visited once, acting only on what is due
+        first = max(self.current_tick + 1, now_tick - len(self.wheel) + 1)
+        for tick in range(first, now_tick + 1):
+            bucket = self.wheel[tick % len(self.wheel)]
+            if not bucket:
+                continue
+            for slot in [slot for slot in bucket if self.due[slot] <= now_tick]:
+                idle = now - self.last_seen[slot]
+                if idle >= self.offline_after:
+                    self._unschedule(slot)
+                    self._set_status(slot, OFFLINE, changes)
+                elif idle >= self.away_after:
+                    self._set_status(slot, AWAY, changes)
+                    self._schedule(slot, self.last_seen[slot] + self.offline_after)
+                else:
+                    self._schedule(slot, self.last_seen[slot] + self.away_after)
+            if not bucket:
+                self.wheel[tick % len(self.wheel)] = set()  # Emptied sets keep their capacity
+        self.current_tick = max(self.current_tick, now_tick)
+        return changes
+
+    def get_status(self, user_id: str) -> UserStatus:
+        slot = self.slots.get(user_id)
+        return UserStatus.OFFLINE if slot is None else STATUSES[self.status[slot]]
+
+
+    def get_last_heartbeat(self, user_id: str) -> datetime:
+        slot = self.slots.get(user_id)
+        return datetime.fromtimestamp(self.last_seen[slot]) if slot is not None else datetime(1970, 1, 1)
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self.user_ids),
+            "online": self.status.count(ONLINE),
+            "away": self.status.count(AWAY),
+        }
+
+
+class ClientConnection:
+    """
+    A connected websocket client with its channel subscriptions and the
+    users whose presence it watches.
+    Outbound messages go through a bounded queue drained by a dedicated task,
+    so publishing never waits on a slow client.
+    """
+
+    def __init__(self, websocket, queue_size: int = SEND_QUEUE_SIZE):
+        self.websocket = websocket
+        self.user_id = None
+        self.channels = set()
+        self.watching = set()
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.sender = None
+
+    def send(self, payload: str) -> bool:
+        """Queue a payload for delivery. Returns False if the queue is full."""
+        try:
+            self.queue.put_nowait(payload)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def drain(self):
+        while True:
+            payload = await self.queue.get()
+            await self.websocket.send(payload)
 
 
 class UserPresence:
     """
     Open a websocket server.
-    Allow users to connect and send heartbeat messages.
+    Allow users to connect and send heartbeat messages, to subscribe to
+    channels to have new messages pushed to them, and to watch users to have
+    their status changes pushed.
+
+    Client messages are JSON objects with a `type`:
+        {"type": "heartbeat", "user_id": ...}  (the default when `type` is missing)
+        {"type": "subscribe", "user_id": ..., "channel_id": ...}
+        {"type": "unsubscribe", "channel_id": ...}
+        {"type": "watch_presence", "user_ids": [...]}
+        {"type": "unwatch_presence", "user_ids": [...]}
+
+    Watching replies with the users' current statuses, and every later
+    change arrives the same way: {"type": "presence", "statuses": {user_id: status}}.
+
+    With a shared_store (an AsyncDataLayer) presence spans processes: every
+    process binds the port with SO_REUSEPORT, writes the status changes of
+    its own connections to Postgres, announced as 'presence' events on the
+    store's event bus, and keeps the statuses other processes announce
+    alongside its own.
     """
 
-    def __init__(self, port: int):
+    def __init__(self, port: int, authorize_subscription=None, shared_store=None):
         self.port = port
         self.server = None
-        # Default to a record with epoch time and disconnected status
-        self.users = defaultdict(lambda: HeartbeatRecord.default_record(""))
+        self.presence = PresenceStore()
+        self.tasks = []
+        self.shared_store = shared_store
+        self.worker_id = None
+        # user_id -> {worker_id: status code}, for users connected to other processes
+        self.remote = {}
+        # user_id -> status, local changes not yet written to the shared store
+        self.unsynced = {}
+        if shared_store is not None:
+            self.worker_id = shared_store.events.worker_id
+            shared_store.events.subscribe("presence", self.on_presence_event)
+            shared_store.events.on_listening(self.reload_presence)
+        # channel_id -> connections subscribed to it
+        self.subscriptions = defaultdict(set)
+        # user_id -> connections watching their presence
+        self.watchers = defaultdict(set)
+        # Optional (user_id, channel_id) -> bool check, may be async
+        self.authorize_subscription = authorize_subscription
 
 
     async def start(self):
@@ -46,56 +262,308 @@ class UserPresence:
             "0.0.0.0",  # Listen on all interfaces
             self.port,
             # Add CORS headers
-            origins=ALLOWED_ORIGINS
+            origins=ALLOWED_ORIGINS,
+            # Every process accepts a share of the connections
+            reuse_port=self.shared_store is not None
         )
         print(f"WebSocket server is now running on port {self.port}")
+        self.tasks.append(asyncio.create_task(self.expire_presence()))
+        if self.shared_store is not None:
+            self.tasks.append(asyncio.create_task(self.sync_presence()))
         # No need to run_forever() as this will be run by the calling context
 
 
+    async def stop(self):
+        """Stop the server; with a shared store, this process's users are announced offline."""
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        if self.server is not None:
+            self.server.close()
+        if self.shared_store is not None:
+            try:
+                connected = {user_id: UserStatus.OFFLINE for user_id in self.presence.user_ids if self.presence.get_status(user_id) != UserStatus.OFFLINE}
+                if connected:
+                    await self.shared_store.save_presence(self.worker_id, self.presence_rows(connected))
+                await self.shared_store.remove_presence_worker(self.worker_id)
+            except Exception as e:
+                print(f"Error clearing shared presence: {e}")
+
+
+    async def expire_presence(self):
+        while True:
+            await asyncio.sleep(self.presence.tick)
+            self.publish_presence(self.presence.advance())
+
+
+    def presence_rows(self, statuses: dict) -> dict[str, tuple[int, float]]:
+        return {user_id: (STATUS_CODES[status], self.presence.get_last_heartbeat(user_id).timestamp()) for user_id, status in statuses.items()}
+
+
+    async def sync_presence(self):
+        """Write local status changes to the shared store in batches, and check this process in."""
+        checked_in = 0.0
+        failures = 0
+        while True:
+            await asyncio.sleep(PRESENCE_SYNC_INTERVAL)
+            changes, self.unsynced = self.unsynced, {}
+            if changes:
+                try:
+                    await self.shared_store.save_presence(self.worker_id, self.presence_rows(changes))
+                    failures = 0
+                except Exception as e:
+                    failures += 1
+                    if failures >= PRESENCE_SYNC_ATTEMPTS:
+                        print(f"Error syncing presence, dropping {len(changes)} status changes: {e}")
+                        failures = 0
+                    else:
+                        print(f"Error syncing presence, retrying: {e}")
+                        self.unsynced = {**changes, **self.unsynced}
+            if time.monotonic() - checked_in > PRESENCE_WORKER_TIMEOUT / 3:
+                try:
+                    dead = await self.shared_store.touch_presence_worker(self.worker_id, PRESENCE_WORKER_TIMEOUT)
+                    checked_in = time.monotonic()
+                    self.forget_workers(dead)
+                except Exception as e:
+                    print(f"Error checking in for shared presence: {e}")
+
+
+    async def reload_presence(self):
+        """Take the other processes' users from a snapshot, as the event bus starts listening (again)."""
+        self.load_remote(await self.shared_store.get_presence_snapshot(self.worker_id))
+
+
+    def on_presence_event(self, event: dict):
+        if event["origin"] != self.worker_id:
+            self.apply_remote(event["origin"], event["statuses"])
+
+
+    def load_remote(self, rows: list[dict]):
+        previous = self.remote
+        self.remote = {}
+        for row in rows:
+            self.remote.setdefault(row['user_id'], {})[row['worker_id']] = row['status']
+        self.push_presence(previous.keys() | self.remote.keys())
+
+
+    def apply_remote(self, worker_id: str, statuses: dict[str, int]):
+        for user_id, status in statuses.items():
+            if status != OFFLINE:
+                self.remote.setdefault(user_id, {})[worker_id] = status
+            elif user_id in self.remote:
+                self.remote[user_id].pop(worker_id, None)
+                if not self.remote[user_id]:
+                    del self.remote[user_id]
+        self.push_presence(statuses)
+
+
+    def forget_workers(self, worker_ids: list[str]):
+        """Drop the users of processes that stopped checking in."""
+        if not worker_ids:
+            return
+        changed = []
+        for user_id, workers in list(self.remote.items()):
+            if any(workers.pop(worker_id, None) is not None for worker_id in worker_ids):
+                changed.append(user_id)
+                if not workers:
+                    del self.remote[user_id]
+        self.push_presence(changed)
+
+
     async def handle_connection(self, websocket):
         client_address = f"{websocket.remote_address[0]}:{websocket.remote_address[1]}"
         print(f"New WebSocket connection attempt from {client_address}")
+        connection = ClientConnection(websocket)
+        connection.sender = asyncio.create_task(connection.drain())
         try:
             while True:
                 message = await websocket.recv()
-                print(f"Raw message received from {client_address}: {message}")
                 data = json.loads(message)
-                user_id = data['user_id']
-                self.users[user_id] = HeartbeatRecord(
-                    user_id=user_id,
-                    timestamp=datetime.now(),
-                    connected=True
-                )
-                print(f"Heartbeat processed for user {user_id} at {self.users[user_id].timestamp}")
+                message_type = data.get('type', 'heartbeat')
+                if message_type == 'heartbeat':
+                    user_id = data['user_id']
+                    if connection.user_id == user_id:
+                        self.publish_presence(self.presence.heartbeat(user_id))
+                    elif not self.identify(connection, user_id):
+                        connection.send(json.dumps({"type": "error", "message": "Invalid user_id"}))
+                elif message_type == 'subscribe':
+                    await self.subscribe(connection, data.get('user_id', connection.user_id), data['channel_id'])
+                elif message_type == 'unsubscribe':
+                    self.unsubscribe(connection, data['channel_id'])
+                elif message_type == 'watch_presence':
+                    self.watch(connection, data['user_ids'])
+                elif message_type == 'unwatch_presence':
+                    self.unwatch(connection, data['user_ids'])
+                else:
+                    connection.send(json.dumps({"type": "error", "message": f"Unknown message type: {message_type}"}))
         except websockets.exceptions.ConnectionClosed as e:
             print(f"WebSocket connection closed for {client_address}: code={e.code} reason='{e.reason}'")
-            # Mark user as disconnected but keep their last timestamp
-            if 'user_id' in locals():
-                record = self.users[user_id]
-                self.users[user_id] = HeartbeatRecord(
-                    user_id=user_id,
-                    timestamp=record.timestamp,
-                    connected=False
-                )
         except Exception as e:
             print(f"Error handling connection from {client_address}: {str(e)}")
             import traceback
             traceback.print_exc()
+        finally:
+            for channel_id in list(connection.channels):
+                self.unsubscribe(connection, channel_id)
+            self.unwatch(connection, list(connection.watching))
+            connection.sender.cancel()
+            # Mark user as disconnected but keep their last timestamp
+            if connection.user_id is not None:
+                self.publish_presence(self.presence.disconnect(connection.user_id))
+
+
+    def identify(self, connection: ClientConnection, user_id: str) -> bool:
+        """Associate a connection with a user, who is online while it is open. Returns False for an invalid user id."""
+        if not isinstance(user_id, str) or not 0 < len(user_id) <= MAX_USER_ID_LENGTH:
+            return False
+        if connection.user_id is not None:
+            self.publish_presence(self.presence.disconnect(connection.user_id))
+        connection.user_id = user_id
+        self.publish_presence(self.presence.connect(user_id))
+        return True
+
+
+    async def subscribe(self, connection: ClientConnection, user_id: str, channel_id: str):
+        if user_id is None:
+            connection.send(json.dumps({"type": "error", "channel_id": channel_id, "message": "Send a heartbeat or user_id before subscribing"}))
+            return
+        if self.authorize_subscription is not None:
+            allowed = self.authorize_subscription(user_id, channel_id)
+            if inspect.isawaitable(allowed):
+                allowed = await allowed
+            if not allowed:
+                connection.send(json.dumps({"type": "error", "channel_id": channel_id, "message": "Not a member of this channel"}))
+                return
+        if connection.user_id != user_id and not self.identify(connection, user_id):
+            connection.send(json.dumps({"type": "error", "channel_id": channel_id, "message": "Invalid user_id"}))
+            return
+        connection.channels.add(channel_id)
+        self.subscriptions[channel_id].add(connection)
+        connection.send(json.dumps({"type": "subscribed", "channel_id": channel_id}))
+
+
+    def unsubscribe(self, connection: ClientConnection, channel_id: str):
+        connection.channels.discard(channel_id)
+        subscribers = self.subscriptions.get(channel_id)
+        if subscribers is not None:
+            subscribers.discard(connection)
+            if not subscribers:
+                del self.subscriptions[channel_id]
+
+
+    def publish(self, channel_id: str, event: dict) -> int:
+        """
+        Push an event to every connection subscribed to a channel.
+        The payload is serialized once and queued without awaiting; clients
+        whose send queue is full are disconnected and must resync over HTTP.
+        Returns the number of connections the event was queued for.
+        """
+        subscribers = self.subscriptions.get(channel_id)
+        if not subscribers:
+            return 0
+        payload = json.dumps(event)
+        delivered = 0
+        for connection in list(subscribers):
+            if connection.send(payload):
+                delivered += 1
+            else:
+                self.drop_slow_connection(connection)
+        return delivered
+
+
+    def watch(self, connection: ClientConnection, user_ids: list[str]):
+        """Start pushing these users' status changes to a connection, and send their current statuses."""
+        user_ids = [user_id for user_id in user_ids if user_id not in connection.watching]
+        if len(connection.watching) + len(user_ids) > PRESENCE_WATCH_LIMIT:
+            connection.send(json.dumps({"type": "error", "message": f"Can watch at most {PRESENCE_WATCH_LIMIT} users"}))
+            return
+        for user_id in user_ids:
+            connection.watching.add(user_id)
+            self.watchers[user_id].add(connection)
+        connection.send(json.dumps({"type": "presence", "statuses": self.get_user_statuses(user_ids)}))
+
+
+    def unwatch(self, connection: ClientConnection, user_ids: list[str]):
+        for user_id in user_ids:
+            connection.watching.discard(user_id)
+            watchers = self.watchers.get(user_id)
+            if watchers is not None:
+                watchers.discard(connection)
+                if not watchers:
+                    del self.watchers[user_id]
+
+
+    def publish_presence(self, changes: list[tuple[str, UserStatus]]) -> int:
+        """Push local status changes to watchers, and queue them for the other processes."""
+        if self.shared_store is not None:
+            for user_id, status in changes:
+                self.unsynced[user_id] = status
+        return self.push_presence(user_id for user_id, _ in changes)
+
+
+    def push_presence(self, user_ids) -> int:
+        """
+        Push the users' statuses to the connections watching them, one
+        payload per connection however many of its users changed.
+        Returns the number of connections updated.
+        """
+        updates = defaultdict(dict)  # connection -> {user_id: status}
+        for user_id in user_ids:
+            watchers = self.watchers.get(user_id)
+            if watchers:
+                status = self.get_status(user_id).value
+                for connection in watchers:
+                    updates[connection][user_id] = status
+        for connection, statuses in updates.items():
+            if not connection.send(json.dumps({"type": "presence", "statuses": statuses})):
+                self.drop_slow_connection(connection)
+        return len(updates)
+
+
+    def publish_message(self, message: Message) -> int:
+        """Push a newly saved message to the channel's subscribers."""
+        return self.publish(message.channel_id, {
+            "type": "message",
+            "channel_id": message.channel_id,
+            "message": message.model_dump(mode="json", exclude={"sender": {"password", "token"}})
+        })
+
+
+    def publish_reaction(self, event: dict) -> int:
+        """Push a reaction added (delta 1) or removed (delta -1) to the channel's subscribers."""
+        return self.publish(event["channel_id"], {
+            "type": "reaction",
+            **{key: event[key] for key in ("channel_id", "message_id", "user_id", "emoji", "delta")}
+        })
+
+
+    def has_subscribers(self, channel_id: str) -> bool:
+        return bool(self.subscriptions.get(channel_id))
+
+
+    def drop_slow_connection(self, connection: ClientConnection):
+        print(f"Dropping slow WebSocket client for user {connection.user_id}: send queue full")
+        for channel_id in list(connection.channels):
+            self.unsubscribe(connection, channel_id)
+        self.unwatch(connection, list(connection.watching))
+        asyncio.create_task(connection.websocket.close(code=1013, reason="send queue full"))
 
 
     def get_last_heartbeat(self, user_id: str) -> datetime:
-        return self.users[user_id].timestamp
+        return self.presence.get_last_heartbeat(user_id)
+
+    def get_status(self, user_id: str) -> UserStatus:
+        """The user's status here, or the best reported by another process they're connected to."""
+        status = self.presence.get_status(user_id)
+        for code in self.remote.get(user_id, {}).values():
+            if STATUS_RANK[STATUSES[code]] > STATUS_RANK[status]:
+                status = STATUSES[code]
+        return status
 
     def get_user_status(self, user_id: str) -> UserStatus:
-        record = self.users[user_id]
-        now = datetime.now()
-        
-        if not record.connected:
-            return UserStatus.OFFLINE
-        
-        # If last heartbeat was more than 30 seconds ago but still connected, consider user away
-        if (now - record.timestamp).total_seconds() > 30:
-            return UserStatus.AWAY
-        
-        return UserStatus.ONLINE
+        self.publish_presence(self.presence.advance())
+        return self.get_status(user_id)
 
+    def get_user_statuses(self, user_ids: list[str]) -> dict[str, UserStatus]:
+        self.publish_presence(self.presence.advance())
+        return {user_id: self.get_status(user_id) for user_id in user_ids}
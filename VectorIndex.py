@@ -0,0 +1,87 @@
+import argparse
+import statistics
+import time
+from DataLayer import DataLayer
+
+SAMPLE_QUERIES_QUERY = "SELECT embedding FROM chunks ORDER BY random() LIMIT %s"
+
+
+def timed_search(dl: DataLayer, query_vector, top_k: int, **settings) -> tuple[set, float]:
+    start = time.perf_counter()
+    chunks = dl.similarity_search(query_vector, top_k=top_k, **settings)
+    return {chunk.id for chunk in chunks}, (time.perf_counter() - start) * 1000
+
+
+def recall_report(dl: DataLayer, queries: int = 50, top_k: int = 10, ef_search: list[int] = (), probes: list[int] = ()) -> list[dict]:
+    """
+    Recall@top_k and latency of the ANN index at each setting, against exact
+    search, over chunk embeddings sampled as queries. The index is forced for
+    the ANN rows, since on a small table the planner would rather scan it.
+    """
+    with dl.pool.connection() as conn:
+        cursor = conn.cursor(binary=True)
+        cursor.execute(SAMPLE_QUERIES_QUERY, (queries,))
+        sample = [row['embedding'].to_numpy() for row in cursor.fetchall()]
+
+    exact_results, exact_latencies = [], []
+    for query_vector in sample:
+        ids, latency = timed_search(dl, query_vector, top_k, exact=True)
+        exact_results.append(ids)
+        exact_latencies.append(latency)
+    rows = [{"setting": "exact", "recall": 1.0, "p50_ms": statistics.median(exact_latencies), "max_ms": max(exact_latencies)}]
+
+    settings = [("ef_search", value) for value in ef_search] + [("probes", value) for value in probes]
+    for name, value in settings or [("default", None)]:
+        recalls, latencies = [], []
+        for query_vector, expected in zip(sample, exact_results):
+            ids, latency = timed_search(dl, query_vector, top_k, exact=False, **({name: value} if value else {}))
+            recalls.append(len(ids & expected) / len(expected) if expected else 1.0)
+            latencies.append(latency)
+        rows.append({
+            "setting": f"{name}={value}" if value else name,
+            "recall": statistics.mean(recalls),
+            "p50_ms": statistics.median(latencies),
+            "max_ms": max(latencies),
+        })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the ANN index on chunk embeddings')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    create = subparsers.add_parser('create', help='Build or rebuild the index')
+    create.add_argument('--method', choices=['hnsw', 'ivfflat'], default='hnsw')
+    create.add_argument('--m', type=int, default=16, help='HNSW connections per node')
+    create.add_argument('--ef-construction', type=int, default=64, help='HNSW build-time candidate list size')
+    create.add_argument('--lists', type=int, default=None, help='IVFFlat lists (default rows / 1000)')
+
+    subparsers.add_parser('drop', help='Drop the index')
+    subparsers.add_parser('show', help='Show the current index')
+
+    report = subparsers.add_parser('report', help='Recall vs latency against exact search')
+    report.add_argument('--queries', type=int, default=50)
+    report.add_argument('--top-k', type=int, default=10)
+    report.add_argument('--ef-search', type=lambda s: [int(v) for v in s.split(',')], default=[])
+    report.add_argument('--probes', type=lambda s: [int(v) for v in s.split(',')], default=[])
+    args = parser.parse_args()
+
+    dl = DataLayer()
+    if args.command == 'create':
+        start = time.perf_counter()
+        dl.create_vector_index(args.method, m=args.m, ef_construction=args.ef_construction, lists=args.lists)
+        print(f"Built {args.method} index in {time.perf_counter() - start:.1f}s")
+    elif args.command == 'drop':
+        dl.drop_vector_index()
+        print("Dropped vector index")
+    elif args.command == 'show':
+        index = dl.get_vector_index()
+        print(index['indexdef'] if index else "No vector index")
+    else:
+        print(f"{'setting':<16}{'recall':>8}{'p50 ms':>10}{'max ms':>10}")
+        for row in recall_report(dl, args.queries, args.top_k, args.ef_search, args.probes):
+            print(f"{row['setting']:<16}{row['recall']:>8.3f}{row['p50_ms']:>10.2f}{row['max_ms']:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
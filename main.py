@@ -1,6 +1,6 @@
-from fastapi import FastAPI, HTTPException, Depends, Query, File, UploadFile, BackgroundTasks, Form
+from fastapi import FastAPI, HTTPException, Depends, Query, File, UploadFile, BackgroundTasks, Form, Header, Request
 from fastapi.security import OAuth2PasswordBearer
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import List, Optional
 from enum import Enum
 from datetime import datetime, timedelta
@@ -8,16 +8,19 @@ import jwt
 import uuid
 import bcrypt
 from typing import Dict
-from DataLayer import DataLayer
+from DataLayer import DataLayer, AI_USERNAME, MAX_FILE_SIZE, FileTooLargeError, UnknownUserError
+from AsyncDataLayer import AsyncDataLayer
 from Models import *
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, Response as FastAPIResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse, Response as FastAPIResponse
 import shutil
 import os
+import asyncio
 import hashlib
-from UserPresence import UserPresence
-import tempfile
-import pdfplumber
+import mimetypes
+from email.utils import formatdate, parsedate_to_datetime
+from UserPresence import UserPresence, PRESENCE_SHARED
+from Cache import ByteCache
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.schema import Document
 from langchain.docstore.document import Document
@@ -25,37 +28,73 @@ from langchain_openai import OpenAIEmbeddings
 from langchain_openai import ChatOpenAI
 from dotenv import load_dotenv
 from Agent import Agent
+from Embeddings import CachedEmbeddings, embed_and_store_chunks
+import Extraction
 
 load_dotenv()  # This should be at the start of the file
 
 app = FastAPI()
-dl = DataLayer()
+dl = AsyncDataLayer()
 
 # Get API key from environment variable
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY2")
-print(OPENAI_API_KEY)
 if not OPENAI_API_KEY:
     raise ValueError("OPENAI_API_KEY environment variable is not set")
 
-embeddings = OpenAIEmbeddings(
+embeddings = CachedEmbeddings(OpenAIEmbeddings(
     api_key=OPENAI_API_KEY,
     model="text-embedding-3-small"
-)
+), dl)
 llm = ChatOpenAI(
     api_key=OPENAI_API_KEY,
     model="gpt-4-turbo-preview"  # Updated to the correct model name
 )
 
 
-agent = Agent(dl)
+# The agent's tools run synchronously inside its graph, so it keeps a blocking DataLayer.
+# It is created at startup: PDF extraction processes import this module too, and shouldn't open a pool
+agent = None
 
 @app.on_event("startup")
 async def startup_event():
+    global agent
+    agent = Agent(DataLayer())
+    await dl.open()
+    await dl.events.start()
     print("Starting UserPresence WebSocket server...")
     await up.start()
     print("UserPresence WebSocket server started")
 
-up = UserPresence(port=8887)
+@app.on_event("shutdown")
+async def shutdown_event():
+    await up.stop()
+    await dl.close()
+    Extraction.shutdown()
+
+up = UserPresence(port=8887, authorize_subscription=dl.is_channel_member, shared_store=dl if PRESENCE_SHARED else None)
+
+
+async def on_message_event(event: dict):
+    """Push messages sent through other processes to this process's subscribers; our own were pushed when sent."""
+    if event["origin"] != dl.events.worker_id and up.has_subscribers(event["channel_id"]):
+        message = await dl.get_message(event["message_id"])
+        if message:
+            up.publish_message(message)
+
+dl.events.subscribe("message", on_message_event)
+dl.events.subscribe("reaction", up.publish_reaction)
+
+# Headroom over MAX_FILE_SIZE for the multipart framing and form fields of an upload
+UPLOAD_OVERHEAD = 64 * 1024
+
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    """Turn away uploads that declare a body too large to hold an acceptable file, before it is read."""
+    if request.url.path == "/upload_file":
+        content_length = request.headers.get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > MAX_FILE_SIZE + UPLOAD_OVERHEAD:
+            return JSONResponse(status_code=413, content={"detail": f"File is larger than {MAX_FILE_SIZE} bytes"})
+    return await call_next(request)
 
 
 # Add CORS middleware
@@ -97,6 +136,7 @@ async def register(
     # Save the uploaded file
     with open(file_path, "wb") as buffer:
         shutil.copyfileobj(profile_picture.file, buffer)
+    picture_cache.invalidate(picture_filename)
     
     # Hash the password before storing
     hashed_password = bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
@@ -110,7 +150,7 @@ async def register(
         profile_picture=profile_picture_url  # Store the complete URL path
     )
     
-    add_response = dl.add_user(to_add)
+    add_response = await dl.add_user(to_add)
     if not add_response:
         os.remove(file_path)
         return Response(message="User already exists", ok=False)
@@ -126,7 +166,7 @@ class LoginResponse(Response):
 
 @app.post("/login")
 async def login(request: LoginRequest) -> LoginResponse:
-    actual_user = dl.get_user_by_username(request.username)
+    actual_user = await dl.get_user_by_username(request.username)
     if actual_user is None:
         return LoginResponse(message="Invalid username or password", ok=False, user=None)
     
@@ -163,11 +203,11 @@ async def create_channel(request: CreateChannelRequest) -> ChannelResponse:
     dm_name = request.name
 
     # if channel already exists, return the existing channel
-    existing_channel = dl.get_channel_by_id(channel_id)
+    existing_channel = await dl.get_channel_by_id(channel_id)
     if existing_channel:
         return ChannelResponse(message="Channel already exists", ok=True, channel=existing_channel)
 
-    channel = dl.create_channel(
+    channel = await dl.create_channel(
         name=dm_name,
         channel_type=request.channel_type,
         creator_id=request.creator_id,
@@ -187,16 +227,16 @@ class JoinChannelResponse(Response):
 @app.post("/join_channel")
 async def join_channel(request: JoinChannelRequest) -> JoinChannelResponse:
     # Get the channel
-    user = dl.get_user_by_username(request.username)
+    user = await dl.get_user_by_username(request.username)
     if not user:
         return JoinChannelResponse(message="User not found", ok=False, channel_membership=None)
 
-    channel = dl.get_channel_by_name(request.channel_name)
+    channel = await dl.get_channel_by_name(request.channel_name)
     if not channel:
         return JoinChannelResponse(message="Channel not found", ok=False, channel_membership=None)
 
     # Create membership
-    membership = dl.join_channel(user.id, channel.id)
+    membership = await dl.join_channel(user.id, channel.id)
     if not membership:
         raise HTTPException(status_code=500, detail="Failed to join channel")
 
@@ -211,7 +251,7 @@ class MyChannelsResponse(Response):
 
 @app.post("/my_channels")
 async def my_channels(request: MyChannelsRequest) -> MyChannelsResponse:
-    channels = dl.get_my_channels(request.user_id, request.channel_type)
+    channels = await dl.get_my_channels(request.user_id, request.channel_type)
     return MyChannelsResponse(message="Channels fetched successfully", ok=True, channels=channels)
 
 class GetChannelMessagesRequest(BaseModel):
@@ -219,11 +259,29 @@ class GetChannelMessagesRequest(BaseModel):
 
 class GetChannelMessagesResponse(Response):
     messages: List[Message]
+    next_cursor: Optional[str] = None
+    newest_cursor: Optional[str] = None
 
 @app.get("/get_channel_messages")
-async def get_channel_messages(channel_id: str = Query(...)) -> GetChannelMessagesResponse:
-    messages = dl.get_channel_messages(channel_id)
-    return GetChannelMessagesResponse(message="Messages fetched successfully", ok=True, messages=messages)
+async def get_channel_messages(
+    channel_id: str = Query(...),
+    before: Optional[str] = Query(None),
+    after: Optional[str] = Query(None),
+    limit: int = Query(50, ge=1, le=200)
+) -> GetChannelMessagesResponse:
+    """
+    Get a page of messages in a channel, oldest first.
+    Without a cursor the newest page is returned; pass `next_cursor` back as
+    `before` to load older history. Pass `newest_cursor` back as `after` to
+    catch up on newer messages: it is returned even when none have arrived,
+    and while `next_cursor` is set there are more to page through.
+    """
+    try:
+        messages, next_cursor, newest_cursor = await dl.get_channel_messages_page(channel_id, before=before, after=after, limit=limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return GetChannelMessagesResponse(message="Messages fetched successfully", ok=True, messages=messages,
+                                      next_cursor=next_cursor, newest_cursor=newest_cursor)
 
 class SendMessageRequest(BaseModel):
     channel_id: str
@@ -236,63 +294,104 @@ class SendMessageResponse(Response):
 
 @app.post("/send_message")
 async def send_message(request: SendMessageRequest, background_tasks: BackgroundTasks) -> SendMessageResponse:
-    # Get the full user object
-    user = dl.get_user(request.user_id)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    message = Message(
-        id=str(uuid.uuid4()),
-        sent=datetime.utcnow().isoformat(),
-        text=request.content,
-        sender=user,
-        content=request.content,
+    # Insert and hydrate the message, and read the channel's flags, in one round-trip
+    posted = await dl.post_message(
         channel_id=request.channel_id,
-        reactions={},
-        has_thread=False,
-        has_image=False,
-        thread_id=None,
-        image=None,
-        file_id=request.file_id,
-        file_name=None,
-        file_content_type=None
+        sender_id=request.user_id,
+        content=request.content,
+        file_id=request.file_id
     )
-    
-    saved_message = dl.send_message(message)
+    if not posted:
+        raise HTTPException(status_code=404, detail="User, channel or file not found")
+
+    saved_message = posted.message
+    up.publish_message(saved_message)
 
     # if the message starts with @ai, add the agent response to background tasks
-    if message.content.startswith("@ai"):
-        background_tasks.add_task(agent_response, message)
-
-    channel = dl.get_channel(message.channel_id)
-    if channel.channel_type == ChannelType.DM:
-        # if the other user is ai, add the agent response to background tasks
-        all_users = dl.get_users_in_channel(message.channel_id)
-        for user in all_users:
-            if user.username == "ai":
-                print("Adding conversation response to background tasks")
-                background_tasks.add_task(conversation_response, message)
+    if saved_message.content.startswith("@ai"):
+        background_tasks.add_task(agent_response, saved_message)
+
+    # if the other user in a DM is ai, add the conversation response to background tasks
+    if posted.channel_type == ChannelType.DM and posted.channel_has_ai_member and saved_message.sender.username != AI_USERNAME:
+        print("Adding conversation response to background tasks")
+        background_tasks.add_task(conversation_response, saved_message)
 
     return SendMessageResponse(message="Message sent successfully", ok=True, sent_message=saved_message)
 
 
+# Pictures and uploaded files never change once written, so clients may keep them for a year
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Hot profile pictures, so rendering a chat view doesn't read them from disk every time
+picture_cache = ByteCache(max_bytes=int(os.getenv("PICTURE_CACHE_BYTES", str(32 * 1024 * 1024))))
+# Bytes charged per cached picture on top of its data, for its key and validators
+PICTURE_ENTRY_BYTES = 512
+
+def validator_headers(etag: str, last_modified: float) -> dict:
+    return {
+        'ETag': etag,
+        'Last-Modified': formatdate(last_modified, usegmt=True),
+        'Cache-Control': IMMUTABLE_CACHE_CONTROL,
+    }
+
+def is_not_modified(request: Request, etag: str, last_modified: float) -> bool:
+    """Whether a conditional GET can be answered with a 304. If-None-Match wins over If-Modified-Since."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def load_picture(file_path: str, max_bytes: int) -> dict:
+    """A picture's validators, and its bytes if it is small enough to keep in memory."""
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as picture_file:
+        while chunk := picture_file.read(64 * 1024):
+            sha256.update(chunk)
+        size = picture_file.tell()
+        picture_file.seek(0)
+        data = picture_file.read() if size <= max_bytes else None
+    return {
+        'etag': f'"{sha256.hexdigest()}"',
+        'last_modified': os.stat(file_path).st_mtime,
+        'data': data,
+    }
+
 # let's make pictures available - query parameter
 @app.get("/get_picture")
-async def get_picture(picture_url: str = Query(...)):
+async def get_picture(request: Request, picture_url: str = Query(...)):
+    """
+    Serve a profile picture with a strong ETag and an immutable Cache-Control;
+    revalidations get a 304. Small pictures are served from memory.
+    """
     file_path = f"pictures/{picture_url}"
-    
-    # Check if file exists
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="Picture not found")
-        
-    try:
-        return FileResponse(
-            file_path,
-            media_type="image/*",  # Let the system detect the correct media type
-            filename=picture_url   # Original filename for download
-        )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error retrieving picture: {str(e)}")
+    picture = picture_cache.get(picture_url)
+    if picture is None:
+        # Check if file exists
+        if not os.path.exists(file_path):
+            raise HTTPException(status_code=404, detail="Picture not found")
+        try:
+            picture = await asyncio.to_thread(load_picture, file_path, picture_cache.max_item_bytes - PICTURE_ENTRY_BYTES)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error retrieving picture: {str(e)}")
+        # Pictures too big to hold still have their validators cached, at a nominal size
+        picture_cache.set(picture_url, picture, len(picture['data'] or b'') + PICTURE_ENTRY_BYTES)
+
+    headers = validator_headers(picture['etag'], picture['last_modified'])
+    if is_not_modified(request, picture['etag'], picture['last_modified']):
+        return FastAPIResponse(status_code=304, headers=headers)
+
+    media_type = mimetypes.guess_type(picture_url)[0] or "image/*"
+    if picture['data'] is None:
+        return FileResponse(file_path, media_type=media_type, filename=picture_url, headers=headers)
+    headers['Content-Disposition'] = f'attachment; filename="{picture_url}"'
+    return FastAPIResponse(content=picture['data'], media_type=media_type, headers=headers)
 
 class ReactionRequest(BaseModel):
     message_id: str
@@ -301,41 +400,21 @@ class ReactionRequest(BaseModel):
 
 @app.post("/add_reaction")
 async def add_reaction(request: ReactionRequest) -> Response:
-    print(f"Adding reaction '{request.reaction}' to message {request.message_id}")
-    
-    message = dl.get_message(request.message_id)
-    if not message:
-        print(f"Message {request.message_id} not found")
+    try:
+        added = await dl.add_reaction(request.message_id, request.user_id, request.reaction)
+    except UnknownUserError:
+        raise HTTPException(status_code=404, detail="User not found")
+    if added is None:
         raise HTTPException(status_code=404, detail="Message not found")
-    
-    # Initialize reactions dict if it doesn't exist
-    if not hasattr(message, 'reactions'):
-        message.reactions = {}
-    
-    # Increment the reaction count
-    if request.reaction in message.reactions:
-        message.reactions[request.reaction] += 1
-    else:
-        message.reactions[request.reaction] = 1
-    
-    # Save the updated reactions
-    success = dl.update_message_reactions(request.message_id, message.reactions)
-    if not success:
-        raise HTTPException(status_code=500, detail="Failed to update reactions")
-    
+    if not added:
+        return Response(message="Reaction already added", ok=False)
     return Response(message="Reaction added", ok=True)
 
 @app.post("/remove_reaction")
 async def remove_reaction(request: ReactionRequest) -> Response:
-    message = dl.get_message(request.message_id)
-    if not message:
-        raise HTTPException(status_code=404, detail="Message not found")
-    
-    if request.reaction in message.reactions:
-        message.reactions[request.reaction] = max(0, message.reactions[request.reaction] - 1)
-        if message.reactions[request.reaction] == 0:
-            del message.reactions[request.reaction]
-    
+    removed = await dl.remove_reaction(request.message_id, request.user_id, request.reaction)
+    if not removed:
+        return Response(message="Reaction not found", ok=False)
     return Response(message="Reaction removed", ok=True)
 
 
@@ -344,7 +423,7 @@ class SearchChannelsResponse(Response):
 
 @app.get("/search_channels")
 async def search_channels(prefix: str = Query(...)) -> SearchChannelsResponse:
-    channels = dl.search_channels(prefix)
+    channels = await dl.search_channels(prefix)
     return SearchChannelsResponse(
         message="Channels found successfully", 
         ok=True, 
@@ -359,8 +438,8 @@ class AddThreadRequest(BaseModel):
 
 @app.post("/add_thread")
 async def add_thread(request: AddThreadRequest) -> Response:
-    message = dl.get_message(request.message_id)
-    channel = dl.get_channel(request.channel_id)
+    message = await dl.get_message(request.message_id)
+    channel = await dl.get_channel(request.channel_id)
 
     if not message:
         return Response(message="Message not found", ok=False)
@@ -375,20 +454,20 @@ async def add_thread(request: AddThreadRequest) -> Response:
     message.thread_id = channel.id
 
     # Add the original message sender to the thread channel
-    dl.join_channel(message.sender.id, channel.id)
+    await dl.join_channel(message.sender.id, channel.id)
     
     # Update member count
     channel.members_count += 1
-    dl.update_channel_members_count(channel.id, channel.members_count)
+    await dl.update_channel_members_count(channel.id, channel.members_count)
 
-    dl.add_thread(message)
+    await dl.add_thread(message)
 
     return Response(message="Thread added successfully", ok=True)
 
 
 @app.get("/get_channel/{channel_id}")
 async def get_channel(channel_id: str) -> ChannelResponse:
-    channel = dl.get_channel(channel_id)
+    channel = await dl.get_channel(channel_id)
     if not channel:
         raise HTTPException(status_code=404, detail="Channel not found")
     return ChannelResponse(message="Channel found successfully", ok=True, channel=channel)
@@ -402,7 +481,7 @@ class GetUserResponse(Response):
 
 @app.post("/get_user")
 async def get_user(request: GetUserRequest) -> GetUserResponse:
-    user = dl.get_user(request.user_id)
+    user = await dl.get_user(request.user_id)
     return GetUserResponse(message="User found successfully", ok=True, user=user)
 
 
@@ -418,12 +497,29 @@ async def user_status(request: UserStatusRequest) -> UserStatusResponse:
     return UserStatusResponse(message="User status fetched successfully", ok=True, user_status=user_status)
 
 
+class UserStatusesRequest(BaseModel):
+    user_ids: List[str] = []
+    channel_id: Optional[str] = None
+
+class UserStatusesResponse(Response):
+    user_statuses: Dict[str, UserStatus]
+
+@app.post("/user_statuses")
+async def user_statuses(request: UserStatusesRequest) -> UserStatusesResponse:
+    """Statuses of the given users and/or every member of a channel, in one call."""
+    user_ids = list(request.user_ids)
+    if request.channel_id is not None:
+        user_ids += [user.id for user in await dl.get_users_in_channel(request.channel_id)]
+    statuses = up.get_user_statuses(list(dict.fromkeys(user_ids)))
+    return UserStatusesResponse(message="User statuses fetched successfully", ok=True, user_statuses=statuses)
+
+
 class FileUploadRequest(BaseModel):
     file: UploadFile
     associated_channel: str
 
 class FileUploadResponse(Response):
-    file_id: str
+    file_id: Optional[str] = None
 
 
 @app.post("/upload_file")
@@ -434,16 +530,15 @@ async def upload_file(
     """
     Upload a file and get a file ID back.
     The file ID can then be used in a message to reference this file.
+    The file is streamed into storage in chunks; files over MAX_FILE_SIZE get a 413.
     """
     try:
         file_id = str(uuid.uuid4())
-        file_content = await file.read()  # Read binary content directly
-        
-        success = dl.save_file(
+        success = await dl.save_file_stream(
             file_id=file_id,
             filename=file.filename,
             content_type=file.content_type,
-            data=file_content,  # Pass binary data directly
+            stream=file,
             associated_channel=associated_channel
         )
         
@@ -456,6 +551,8 @@ async def upload_file(
             file_id=file_id
         )
         
+    except FileTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except Exception as e:
         return FileUploadResponse(
             message=f"Error uploading file: {str(e)}",
@@ -472,52 +569,93 @@ class AssociatedFilesResponse(Response):
 
 @app.post("/associated_files")
 async def associated_files(request: AssociatedFilesRequest) -> AssociatedFilesResponse:
-    files = dl.get_associated_files(request.channel_id)
+    files = await dl.get_associated_files(request.channel_id)
     return AssociatedFilesResponse(message="Files fetched successfully", ok=True, files=files)
 
+def parse_byte_range(range_header: str, size: int) -> tuple[int, int] | None:
+    """
+    Parse a single "bytes=start-end", "bytes=start-" or "bytes=-suffix" range
+    into inclusive offsets. Returns None for headers we don't serve ranges
+    for (other units, multiple ranges), so the whole file is sent instead.
+    Raises a 416 if the range lies outside the file.
+    """
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if not first:
+            start, end = max(size - int(last), 0), size - 1
+        else:
+            start, end = int(first), min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={'Content-Range': f'bytes */{size}'})
+    return start, end
+
 @app.get("/download_file/{file_id}")
-async def download_file(file_id: str):
+async def download_file(request: Request, file_id: str, range: Optional[str] = Header(None)):
     """
-    Download a file by its ID.
+    Download a file by its ID. The file is streamed in chunks, and a Range
+    header gets a 206 with just those bytes so downloads can resume and seek.
+    The content hash is the ETag, so revalidations get a 304.
     """
-    file_data = dl.get_file(file_id)
-    if not file_data:
+    file = await dl.get_file_handle(file_id)
+    if not file:
         raise HTTPException(status_code=404, detail="File not found")
-        
-    return FastAPIResponse(
-        content=file_data['data'],
-        media_type=file_data['content_type'],
-        headers={
-            'Content-Disposition': f'attachment; filename="{file_data["filename"]}"'
-        }
-    )
 
-class SearchRequest(BaseModel):
-    search_query: str
-
-class SearchResult(BaseModel):
-    channel_id: str
-    channel_name: str
-    message: Message
-    previous_message: Optional[Message] = None
-    next_message: Optional[Message] = None
-    score: float
+    etag = f'"{file.sha256}"'
+    last_modified = file.created_at.timestamp()
+    if is_not_modified(request, etag, last_modified):
+        return FastAPIResponse(status_code=304, headers=validator_headers(etag, last_modified))
+
+    size = file.size
+    # A range is only for the version of the file the client already has part of
+    if_range = request.headers.get("if-range")
+    if if_range and if_range != etag and if_range != formatdate(last_modified, usegmt=True):
+        range = None
+    byte_range = parse_byte_range(range, size) if range else None
+    start, end = byte_range or (0, size - 1)
+    headers = {
+        **validator_headers(etag, last_modified),
+        'Content-Disposition': f'attachment; filename="{file.filename}"',
+        'Accept-Ranges': 'bytes',
+        'Content-Length': str(end - start + 1),
+    }
+    if byte_range:
+        headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+
+    return StreamingResponse(
+        file.iter_bytes(start, end),
+        status_code=206 if byte_range else 200,
+        media_type=file.content_type,
+        headers=headers
+    )
 
 class SearchResponse(Response):
     results: List[SearchResult]
+    next_offset: Optional[int] = None
 
 @app.post("/search")
 async def search(request: SearchRequest) -> SearchResponse:
     """
-    Search for messages containing the search query.
-    Returns messages with context (previous and next messages) and relevance score.
+    Full-text search for messages, ranked by relevance.
+    Returns messages with context (previous and next messages), relevance score
+    and a highlighted snippet. Pass `next_offset` back as `offset` for the next page.
     """
     try:
-        search_results = dl.search_messages(request.search_query)
+        # Fetch one extra hit to know whether there is another page
+        search_results = await dl.search_messages(request.search_query, limit=request.limit + 1, offset=request.offset)
+        next_offset = None
+        if len(search_results) > request.limit:
+            search_results = search_results[:request.limit]
+            next_offset = request.offset + request.limit
         return SearchResponse(
             message="Search completed successfully",
             ok=True,
-            results=[SearchResult(**result) for result in search_results]
+            results=[SearchResult(**result) for result in search_results],
+            next_offset=next_offset
         )
     except Exception as e:
         return SearchResponse(
@@ -530,17 +668,23 @@ async def search(request: SearchRequest) -> SearchResponse:
 class RAGIngestRequest(BaseModel):
     file_id: str
     channel_id: Optional[str] = None
+    reingest: bool = False  # Embed again and replace the file's stored chunks
 @app.post("/rag_ingest")
 async def rag_ingest(request: RAGIngestRequest) -> Response:
     try:
+        # Identical content that was already ingested doesn't need embedding again
+        reused = 0 if request.reingest else await dl.reuse_chunks(request.file_id, request.channel_id)
+        if reused:
+            return Response(message=f"Successfully processed {reused} chunks", ok=True)
+
         # Get the file from storage
-        file = dl.get_file(request.file_id)
+        file = await dl.get_file_handle(request.file_id)
         if not file:
             return Response(message="File not found", ok=False)
 
         # Check file type
-        content_type = file['content_type'].lower()
-        file_extension = os.path.splitext(file['filename'])[1].lower()
+        content_type = file.content_type.lower()
+        file_extension = os.path.splitext(file.filename)[1].lower()
 
         # Validate file type
         allowed_types = {
@@ -556,24 +700,17 @@ async def rag_ingest(request: RAGIngestRequest) -> Response:
         documents = []
         
         if content_type == 'application/pdf' or file_extension == '.pdf':
-            # Handle PDF
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as temp_file:
-                temp_file.write(file['data'])
-                temp_filename = temp_file.name
-
-            with pdfplumber.open(temp_filename) as pdf:
-                for i, page in enumerate(pdf.pages):
-                    text = page.extract_text()
-                    if text:
-                        documents.append(Document(
-                            page_content=text,
-                            metadata={"page": i + 1}
-                        ))
-            os.unlink(temp_filename)
+            # Handle PDF, in the extraction process pool
+            for i, text in enumerate(await Extraction.pdf_pages(file)):
+                if text:
+                    documents.append(Document(
+                        page_content=text,
+                        metadata={"page": i + 1}
+                    ))
             
         else:
             # Handle TXT and MD
-            text = file['data'].decode('utf-8')
+            text = (await file.read()).decode('utf-8')
             documents.append(Document(
                 page_content=text,
                 metadata={"page": 1}
@@ -583,24 +720,17 @@ async def rag_ingest(request: RAGIngestRequest) -> Response:
         text_splitter = RecursiveCharacterTextSplitter(chunk_size=4_000, chunk_overlap=500)
         text_chunks = text_splitter.split_documents(documents)
 
-        # Create embeddings
-        chunks = [
-            Chunk(
-                embedding=embeddings.embed_query(chunk.page_content), 
-                file_id=request.file_id, 
-                file_chunk=i,
-                text=chunk.page_content,
-                channel_id=request.channel_id
-            ) for i, chunk in enumerate(text_chunks)
-        ]
-
-        # Store chunks in database
-        success = dl.add_chunks(chunks)
-        
-        if not success:
-            return Response(message="Failed to store chunks", ok=False)
+        # Embed in concurrent batches, storing each batch as it completes
+        stored = await embed_and_store_chunks(
+            embeddings,
+            dl,
+            [chunk.page_content for chunk in text_chunks],
+            file_id=request.file_id,
+            channel_id=request.channel_id,
+            upsert=request.reingest
+        )
 
-        return Response(message=f"Successfully processed {len(chunks)} chunks", ok=True)
+        return Response(message=f"Successfully processed {stored} chunks", ok=True)
 
     except Exception as e:
         print(f"Error in RAG ingest: {e}")
@@ -618,18 +748,18 @@ class RAGSearchResponse(Response):
 async def rag_search(request: RAGSearchRequest) -> RAGSearchResponse:
     try:
         # Get embedding for the query
-        query_vector = embeddings.embed_query(request.query)
+        query_vector = await embeddings.aembed_query(request.query)
         
         if request.channel_id:
             # Get similar chunks from the specific channel
-            chunks = dl.similarity_search_in_channel(
+            chunks = await dl.similarity_search_in_channel(
                 query_vector, 
                 request.channel_id,
                 top_k=3
             )
         else:
             # Get similar chunks from all channels
-            chunks = dl.similarity_search(query_vector, top_k=3)
+            chunks = await dl.similarity_search(query_vector, top_k=3)
         
         if not chunks:
             return RAGSearchResponse(
@@ -675,12 +805,11 @@ async def agent_response(message, n_previous_messages=5):
     """
     Given a message, the agent composes a response to it.
     """
-    ai_user = dl.get_user('1')
+    ai_user = await dl.get_user('1')
 
     # select previous n messages in the channel
-    channel = dl.get_channel(message.channel_id)
-    messages = dl.get_channel_messages(message.channel_id)
-    previous_messages = messages[-n_previous_messages:]
+    channel = await dl.get_channel(message.channel_id)
+    previous_messages = await dl.get_channel_messages(message.channel_id, limit=n_previous_messages)
 
     recent_history = "# Recent messages\n" + "\n".join([f"{message.sender.username}: {message.content}" for message in previous_messages])
 
@@ -725,8 +854,7 @@ async def agent_response(message, n_previous_messages=5):
 
 async def conversation_response(message, n_previous_messages=25):
     # Get recent messages
-    messages = dl.get_channel_messages(message.channel_id)
-    recent_messages = messages[-n_previous_messages:]
+    recent_messages = await dl.get_channel_messages(message.channel_id, limit=n_previous_messages)
     
     # Format conversation history
     conversation_history = "\n".join([
@@ -742,11 +870,11 @@ async def conversation_response(message, n_previous_messages=25):
     {message.content}
     """
 
-    # Run agent without await since it's not async
-    result = agent.run(context_prompt)
+    # The agent is synchronous, so run it off the event loop
+    result = await asyncio.to_thread(agent.run, context_prompt)
 
     # Send response
-    ai_user = dl.get_user('1')
+    ai_user = await dl.get_user('1')
     if result:
         send_message_request = SendMessageRequest(
             channel_id=message.channel_id,
@@ -756,6 +884,21 @@ async def conversation_response(message, n_previous_messages=25):
         await send_message(send_message_request, BackgroundTasks())
 
 
+@app.get("/cache_stats")
+async def cache_stats() -> dict:
+    """Sizes and hit rates of the in-process caches, and chunk bulk loading throughput."""
+    return {
+        "metadata": dl.cache.stats(),
+        "pictures": picture_cache.stats(),
+        "embeddings": embeddings.stats(),
+        "channel_index": dl.channel_index.stats() if dl.channel_index else None,
+        "chunk_copy": dl.copy_stats(),
+    }
+
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="localhost", port=8080, workers=4)  # Add workers parameter
\ No newline at end of file
+    # Workers need the app as an import string, and shared presence so they can all bind the
+    # presence port; without PRESENCE_SHARED=1 a single process serves everything, otherwise
+    # WEB_CONCURRENCY processes do, which also divides the cores for PDF extraction between them
+    uvicorn.run("main:app", host="localhost", port=8080, workers=Extraction.WEB_CONCURRENCY if PRESENCE_SHARED else 1)
\ No newline at end of file
@@ -0,0 +1,48 @@
+import os
+import pytest
+from fastapi import HTTPException
+
+# main refuses to import without an API key; nothing here calls the API
+os.environ.setdefault("OPENAI_API_KEY2", "test")
+from main import parse_byte_range
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", (0, 99)),
+    ("bytes=10-19", (10, 19)),
+    ("bytes=50-", (50, 99)),
+    ("bytes=-10", (90, 99)),
+    ("bytes=0-0", (0, 0)),
+    ("bytes=99-99", (99, 99)),
+    # An end past the file, or a suffix longer than it, is clamped to the file
+    ("bytes=90-500", (90, 99)),
+    ("bytes=-500", (0, 99)),
+    (" BYTES = 5-6", (5, 6)),
+])
+def test_satisfiable_ranges(header, expected):
+    assert parse_byte_range(header, 100) == expected
+
+
+@pytest.mark.parametrize("header", [
+    "items=0-10",
+    "bytes=0-10,20-30",
+    "bytes=a-b",
+    "bytes=5-x",
+    "bytes=-",
+])
+def test_unserved_ranges_send_whole_file(header):
+    assert parse_byte_range(header, 100) is None
+
+
+@pytest.mark.parametrize("header, size", [
+    ("bytes=100-", 100),
+    ("bytes=100-200", 100),
+    ("bytes=20-10", 100),
+    ("bytes=-0", 100),
+    ("bytes=0-", 0),
+])
+def test_unsatisfiable_ranges(header, size):
+    with pytest.raises(HTTPException) as e:
+        parse_byte_range(header, size)
+    assert e.value.status_code == 416
+    assert e.value.headers == {'Content-Range': f'bytes */{size}'}
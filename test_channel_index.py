@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+from pgvector import Vector
+from ChannelIndex import ChannelMatrix
+
+DIM = 16
+
+
+def make_rows(vectors, start=0):
+    # Rows as CHANNEL_CHUNKS_QUERY returns them, with chunk ids from 1
+    return [
+        {'id': i + 1, 'embedding': Vector(vectors[i].tolist()), 'file_id': f"f{i}", 'file_chunk': i, 'text': f"chunk {i}"}
+        for i in range(start, len(vectors))
+    ]
+
+
+def make_matrix(vectors):
+    matrix = ChannelMatrix.empty("c1")
+    matrix.append(make_rows(vectors))
+    return matrix
+
+
+def cosine_order(vectors, query, top_k):
+    # Chunk ids ordered by pgvector's `<=>`: 1 - cosine similarity, in float64
+    vectors, query = np.asarray(vectors, dtype=np.float64), np.asarray(query, dtype=np.float64)
+    distances = 1 - (vectors @ query) / (np.linalg.norm(vectors, axis=1) * np.linalg.norm(query))
+    return [int(i) + 1 for i in np.argsort(distances, kind='stable')[:top_k]]
+
+
+@pytest.mark.parametrize("top_k", [1, 5, 50, 200, 500])
+def test_search_matches_cosine_order(top_k):
+    rng = np.random.default_rng(top_k)
+    vectors = rng.normal(size=(200, DIM)).astype(np.float32)
+    matrix = make_matrix(vectors)
+    for _ in range(5):
+        query = rng.normal(size=DIM).astype(np.float32)
+        assert [chunk.id for chunk in matrix.search(query.tolist(), top_k)] == cosine_order(vectors, query, top_k)
+
+
+def test_search_ignores_magnitude():
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(50, DIM)).astype(np.float32)
+    # Scaling rows changes inner products but not cosine distance
+    vectors *= rng.uniform(0.01, 100, size=(50, 1)).astype(np.float32)
+    query = rng.normal(size=DIM).astype(np.float32) * 1000
+    matrix = make_matrix(vectors)
+    assert [chunk.id for chunk in matrix.search(query.tolist(), 10)] == cosine_order(vectors, query, 10)
+
+
+def test_search_returns_chunk_columns():
+    vectors = np.eye(3, DIM, dtype=np.float32)
+    [chunk] = make_matrix(vectors).search(vectors[1].tolist(), 1, include_embeddings=True)
+    assert (chunk.id, chunk.file_id, chunk.file_chunk, chunk.text, chunk.channel_id) == (2, "f1", 1, "chunk 1", "c1")
+    assert chunk.embedding == vectors[1].tolist()
+
+
+def test_empty_matrix():
+    assert ChannelMatrix.empty("c1").search([1.0] * DIM, 5) == []
+
+
+def test_saved_matrix_searches_the_same(tmp_path):
+    rng = np.random.default_rng(1)
+    vectors = rng.normal(size=(100, DIM)).astype(np.float32)
+    matrix = make_matrix(vectors[:60])
+    matrix.save(str(tmp_path))
+    # The second save appends to the first snapshot rather than rewriting it
+    matrix.append(make_rows(vectors, 60))
+    matrix.save(str(tmp_path))
+    loaded = ChannelMatrix.load(str(tmp_path), "c1")
+    query = rng.normal(size=DIM).astype(np.float32)
+    expected = cosine_order(vectors, query, 20)
+    assert [chunk.id for chunk in matrix.search(query.tolist(), 20)] == expected
+    assert [chunk.id for chunk in loaded.search(query.tolist(), 20)] == expected
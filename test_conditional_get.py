@@ -0,0 +1,44 @@
+import os
+from email.utils import formatdate
+from fastapi import Request
+
+# main refuses to import without an API key; nothing here calls the API
+os.environ.setdefault("OPENAI_API_KEY2", "test")
+from main import is_not_modified
+
+ETAG = '"abc123"'
+MODIFIED = 1_700_000_000.5
+
+
+def make_request(**headers):
+    raw = [(name.replace("_", "-").encode(), value.encode()) for name, value in headers.items()]
+    return Request({"type": "http", "headers": raw})
+
+
+def test_no_validators():
+    assert not is_not_modified(make_request(), ETAG, MODIFIED)
+
+
+def test_etag_match():
+    assert is_not_modified(make_request(if_none_match=ETAG), ETAG, MODIFIED)
+    assert is_not_modified(make_request(if_none_match=f'"other", W/{ETAG}'), ETAG, MODIFIED)
+    assert is_not_modified(make_request(if_none_match="*"), ETAG, MODIFIED)
+    assert not is_not_modified(make_request(if_none_match='"other"'), ETAG, MODIFIED)
+
+
+def test_if_modified_since():
+    # HTTP dates have whole seconds, so the fraction of the mtime is ignored
+    assert is_not_modified(make_request(if_modified_since=formatdate(MODIFIED, usegmt=True)), ETAG, MODIFIED)
+    assert is_not_modified(make_request(if_modified_since=formatdate(MODIFIED + 60, usegmt=True)), ETAG, MODIFIED)
+    assert not is_not_modified(make_request(if_modified_since=formatdate(MODIFIED - 60, usegmt=True)), ETAG, MODIFIED)
+    assert not is_not_modified(make_request(if_modified_since="not a date"), ETAG, MODIFIED)
+
+
+def test_etag_mismatch_wins_over_date():
+    request = make_request(if_none_match='"other"', if_modified_since=formatdate(MODIFIED + 60, usegmt=True))
+    assert not is_not_modified(request, ETAG, MODIFIED)
+
+
+def test_etag_match_wins_over_date():
+    request = make_request(if_none_match=ETAG, if_modified_since=formatdate(MODIFIED - 60, usegmt=True))
+    assert is_not_modified(request, ETAG, MODIFIED)
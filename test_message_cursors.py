@@ -0,0 +1,71 @@
+from datetime import datetime, timedelta, timezone
+import pytest
+from DataLayer import decode_message_cursor, encode_message_cursor, messages_page
+from Models import Message, User, UserStatus
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+SENDER = User(id="u1", created_at=START.isoformat(), username="alice", password="", token="",
+              status=UserStatus.ONLINE, profile_picture="")
+
+
+def make_messages(count):
+    # Oldest first, as messages_page receives them
+    return [Message(id=f"m{i}", sent=(START + timedelta(seconds=i)).isoformat(), text="", sender=SENDER,
+                    content="", channel_id="c1") for i in range(count)]
+
+
+def test_cursor_round_trip():
+    message = make_messages(1)[0]
+    assert decode_message_cursor(encode_message_cursor(message)) == (START, "m0")
+
+
+def test_cursor_keeps_ids_with_separator():
+    message = make_messages(1)[0].model_copy(update={"id": "a|b"})
+    assert decode_message_cursor(encode_message_cursor(message)) == (START, "a|b")
+
+
+@pytest.mark.parametrize("cursor", ["", "not a cursor", "bm8tc2VwYXJhdG9y"])
+def test_malformed_cursor(cursor):
+    with pytest.raises(ValueError):
+        decode_message_cursor(cursor)
+
+
+def test_backward_page_has_more():
+    # limit + 1 rows: the extra, oldest row only signals that there is more
+    messages = make_messages(4)
+    page, next_cursor, newest_cursor = messages_page(messages, 3)
+    assert [m.id for m in page] == ["m1", "m2", "m3"]
+    assert next_cursor == encode_message_cursor(messages[1])
+    assert newest_cursor == encode_message_cursor(messages[3])
+
+
+def test_backward_page_reaches_start():
+    messages = make_messages(2)
+    page, next_cursor, newest_cursor = messages_page(messages, 3)
+    assert page == messages
+    assert next_cursor is None
+    assert newest_cursor == encode_message_cursor(messages[1])
+
+
+def test_forward_page_has_more():
+    messages = make_messages(4)
+    page, next_cursor, newest_cursor = messages_page(messages, 3, "cursor")
+    assert [m.id for m in page] == ["m0", "m1", "m2"]
+    assert next_cursor == encode_message_cursor(messages[2])
+    assert newest_cursor == next_cursor
+
+
+def test_short_forward_page_returns_newest():
+    messages = make_messages(2)
+    page, next_cursor, newest_cursor = messages_page(messages, 3, "cursor")
+    assert page == messages
+    assert next_cursor is None
+    assert newest_cursor == encode_message_cursor(messages[1])
+
+
+def test_empty_forward_page_keeps_cursor():
+    assert messages_page([], 3, "cursor") == ([], None, "cursor")
+
+
+def test_empty_channel():
+    assert messages_page([], 3) == ([], None, None)
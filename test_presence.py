@@ -0,0 +1,88 @@
+import time
+import pytest
+from Models import UserStatus
+from UserPresence import PresenceStore
+
+ONLINE, AWAY, OFFLINE = UserStatus.ONLINE, UserStatus.AWAY, UserStatus.OFFLINE
+
+
+def make_store():
+    # A wheel of int(5 / 1) + 2 = 7 buckets
+    return PresenceStore(away_after=2, offline_after=5, tick=1), time.time()
+
+
+def test_rejects_non_positive_tick():
+    with pytest.raises(ValueError):
+        PresenceStore(tick=0)
+    with pytest.raises(ValueError):
+        PresenceStore(tick=-1)
+
+
+def test_online_away_offline():
+    store, t = make_store()
+    assert store.connect("alice", now=t) == [("alice", ONLINE)]
+    assert store.advance(t + 1) == []
+    assert store.advance(t + 3) == [("alice", AWAY)]
+    assert store.advance(t + 4) == []
+    assert store.advance(t + 7) == [("alice", OFFLINE)]
+    assert store.get_status("alice") == OFFLINE
+    assert store.advance(t + 20) == []
+
+
+def test_heartbeats_keep_user_online():
+    store, t = make_store()
+    store.connect("alice", now=t)
+    # Many revolutions of the wheel, so due ticks wrap around it
+    for second in range(1, 30):
+        assert store.heartbeat("alice", now=t + second) == []
+        assert store.advance(t + second) == []
+    assert store.get_status("alice") == ONLINE
+    assert store.advance(t + 29 + 3) == [("alice", AWAY)]
+
+
+def test_heartbeat_brings_away_user_back():
+    store, t = make_store()
+    store.connect("alice", now=t)
+    store.advance(t + 3)
+    assert store.heartbeat("alice", now=t + 4) == [("alice", ONLINE)]
+    assert store.advance(t + 5) == []
+    assert store.advance(t + 7) == [("alice", AWAY)]
+
+
+def test_stall_longer_than_a_revolution():
+    store, t = make_store()
+    store.connect("alice", now=t)
+    store.connect("bob", now=t + 60)
+    assert store.advance(t + 61) == [("alice", OFFLINE)]
+    assert store.get_status("bob") == ONLINE
+    assert store.advance(t + 63) == [("bob", AWAY)]
+
+
+def test_connections_are_counted():
+    store, t = make_store()
+    store.connect("alice", now=t)
+    assert store.connect("alice", now=t) == []
+    assert store.disconnect("alice") == []
+    assert store.get_status("alice") == ONLINE
+    assert store.disconnect("alice") == [("alice", OFFLINE)]
+    assert store.disconnect("alice") == []
+    assert store.disconnect("nobody") == []
+    # Nothing is left scheduled for a disconnected user
+    assert store.advance(t + 10) == []
+
+
+def test_reconnect():
+    store, t = make_store()
+    store.connect("alice", now=t)
+    store.disconnect("alice")
+    assert store.connect("alice", now=t + 1) == [("alice", ONLINE)]
+    assert store.advance(t + 2) == []
+    assert store.advance(t + 4) == [("alice", AWAY)]
+    assert store.stats() == {"users": 1, "online": 0, "away": 1}
+
+
+def test_heartbeat_without_connection_does_not_go_online():
+    store, t = make_store()
+    assert store.heartbeat("alice", now=t) == []
+    assert store.get_status("alice") == OFFLINE
+    assert store.get_status("nobody") == OFFLINE